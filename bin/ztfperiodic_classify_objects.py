@@ -12,32 +12,23 @@ import tables
 import pandas as pd
 import numpy as np
 import h5py
-from scipy.signal import lombscargle
 
 import matplotlib
 matplotlib.use('Agg')
 matplotlib.rcParams.update({'font.size': 16})
 matplotlib.rcParams['contour.negative_linestyle'] = 'solid'
-from matplotlib.colors import LogNorm
-import matplotlib.pyplot as plt
 
 from astropy import units as u
 from astropy.coordinates import SkyCoord
-from astroquery.sdss import SDSS
-import astropy.constants as const
-import astropy.io.fits
 
 import ztfperiodic
 from ztfperiodic.utils import convert_to_hex
 from ztfperiodic.utils import get_kowalski_features
 from ztfperiodic.utils import get_kowalski_features_list
 from ztfperiodic.utils import get_kowalski_features_objids
+from ztfperiodic.utils import load_id_boundaries
 from ztfperiodic.classify import classify
-
-try:
-    from penquins import Kowalski
-except:
-    print("penquins not installed... need to use matchfiles.")
+from ztfperiodic.querypool import QueryPool
 
 def parse_commandline():
     """
@@ -69,10 +60,12 @@ def parse_commandline():
     parser.add_option("--Ncatindex",default=0,type=int)
 
     parser.add_option("-q","--query_type",default="ids")
+    parser.add_option("--boundaries_file",default=None)
     parser.add_option("-i","--ids_file",default="/home/michael.coughlin/ZTF/ZTFVariability/ids/ids.20fields.npy")
 
     parser.add_option("-u","--user")
     parser.add_option("-w","--pwd")
+    parser.add_option("--Nconnections",default=4,type=int)
 
     opts, args = parser.parse_args()
 
@@ -162,26 +155,24 @@ fil = 'all'
 print('Organizing lightcurves...')
 if opts.lightcurve_source == "Kowalski":
 
-    kow = []
-    nquery = 10
-    cnt = 0
-    while cnt < nquery:
-        try:
-            kow = Kowalski(username=opts.user, password=opts.pwd)
-            break
-        except:
-            time.sleep(5)
-        cnt = cnt + 1
-    if cnt == nquery:
-        raise Exception('Kowalski connection failed...')
+    # independent feature queries run concurrently, one per connection
+    kow = QueryPool.connect(opts.user, opts.pwd,
+                            nconnections=opts.Nconnections)
 
     if opts.source_type == "quadrant":
         if opts.query_type == "skiplimit":
+            # batches are read as _id ranges, see get_kowalski_features
+            boundaries = None
+            if opts.boundaries_file is not None:
+                boundaries = load_id_boundaries(opts.boundaries_file).get(dbname)
+            if (boundaries is not None) and (len(boundaries) != Ncatalog+1):
+                boundaries = None
             ids, features = get_kowalski_features(kow,
                                                   num_batches=Ncatalog,
                                                   nb=Ncatindex,
                                                   featuresetname=modeltype,
-                                                  dbname=dbname) 
+                                                  dbname=dbname,
+                                                  id_boundaries=boundaries)
         elif opts.query_type == "ids":
             objids = np.load(opts.ids_file)
             nlightcurves = len(objids)
@@ -190,7 +181,8 @@ if opts.lightcurve_source == "Kowalski":
 
             ids, features = get_kowalski_features_objids(objids, kow, 
                                                          featuresetname=modeltype,
-                                                         dbname=dbname)
+                                                         dbname=dbname,
+                                                         Nthreads=opts.Nconnections)
     elif opts.source_type == "catalog":
 
         amaj, amin, phi = None, None, None
@@ -140,6 +140,17 @@ if opts.lightcurve_source == "Kowalski":
 
             Ncatalog = int(np.ceil(float(nlightcurves)/opts.Nmax))
 
+        # _id boundaries of the batches, looked up once for all jobs
+        boundaries_file = os.path.join(condorDir, 'boundaries.h5')
+        if (opts.query_type == "skiplimit") and opts.doQuadrantScale:
+            boundaries = ztfperiodic.utils.get_kowalski_id_boundaries(
+                kow, dbname, {}, nlightcurves, Ncatalog)
+            ztfperiodic.utils.save_id_boundaries(boundaries_file,
+                                                 {dbname: boundaries})
+        boundaries_flag = ""
+        if os.path.isfile(boundaries_file):
+            boundaries_flag = "--boundaries_file %s" % boundaries_file
+
         for ii in range(Ncatalog):
             modelFiles_tmp = []
             for modelFile in modelFiles:
@@ -156,7 +167,7 @@ if opts.lightcurve_source == "Kowalski":
             if opts.doDocker:
                 fid1.write('nvidia-docker run --runtime=nvidia python-ztfperiodic --outputDir %s --program_ids 1,2,3 --field %d --ccd %d --quadrant %d --user %s --pwd %s --batch_size %d -l Kowalski --source_type quadrant --Ncatalog %d --Ncatindex %d --algorithm %s --doRemoveTerrestrial --doPlots %s\n'%(outputDir, field, ccd, quadrant, opts.user, opts.pwd,opts.batch_size, Ncatalog, ii, opts.algorithm, extra_flags))
             else:
-                fid1.write('%s %s/ztfperiodic_classify_objects.py --outputDir %s --user %s --pwd %s -l Kowalski --source_type quadrant --Ncatalog %d --Ncatindex %d --algorithm %s --dbname %s --doPlots --modelFiles %s --query_type %s --ids_file %s\n'%(opts.python, dir_path, outputDir, opts.user, opts.pwd, Ncatalog, ii, opts.algorithm, dbname, ",".join(modelFiles_tmp),opts.query_type,ids_file))
+                fid1.write('%s %s/ztfperiodic_classify_objects.py --outputDir %s --user %s --pwd %s -l Kowalski --source_type quadrant --Ncatalog %d --Ncatindex %d --algorithm %s --dbname %s --doPlots --modelFiles %s --query_type %s --ids_file %s %s\n'%(opts.python, dir_path, outputDir, opts.user, opts.pwd, Ncatalog, ii, opts.algorithm, dbname, ",".join(modelFiles_tmp),opts.query_type,ids_file,boundaries_flag))
         
             fid.write('JOB %d condor.sub\n'%(job_number))
             fid.write('RETRY %d 3\n'%(job_number))
@@ -197,7 +208,7 @@ fid.write('output = logs/out.$(jobNumber)\n');
 fid.write('error = logs/err.$(jobNumber)\n');
 if opts.lightcurve_source == "Kowalski":
     if opts.source_type == "quadrant":
-        fid.write('arguments = --outputDir %s --Ncatalog $(Ncatalog) --Ncatindex $(Ncatindex) --user %s --pwd %s -l Kowalski --doPlots --algorithm %s --dbname %s --modelFiles $(modelFiles) --query_type %s --ids_file %s\n'%(outputDir,opts.user,opts.pwd,opts.algorithm,dbname,opts.query_type,ids_file))
+        fid.write('arguments = --outputDir %s --Ncatalog $(Ncatalog) --Ncatindex $(Ncatindex) --user %s --pwd %s -l Kowalski --doPlots --algorithm %s --dbname %s --modelFiles $(modelFiles) --query_type %s --ids_file %s %s\n'%(outputDir,opts.user,opts.pwd,opts.algorithm,dbname,opts.query_type,ids_file,boundaries_flag))
     elif opts.source_type == "catalog":
         fid.write('arguments = --outputDir %s --user %s --pwd %s -l Kowalski --source_type catalog --catalog_file %s --doPlots --Ncatalog $(Ncatalog) --Ncatindex $(Ncatindex) --algorithm %s --dbname %s --modelFiles $(modelFiles)\n'%(outputDir,opts.user,opts.pwd,opts.catalog_file,opts.algorithm,dbname))
 fid.write('requirements = OpSys == "LINUX"\n');
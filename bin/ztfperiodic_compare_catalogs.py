@@ -1,9 +1,7 @@
 #!/usr/bin/env python
 
 import os, sys
-import glob
 import optparse
-import copy
 import time
 import h5py
 
@@ -17,10 +15,9 @@ import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 from matplotlib.colors import LogNorm
 from matplotlib.colors import Normalize
-import matplotlib.patches as patches
 
 import astropy
-from astropy.table import Table, vstack, hstack
+from astropy.table import Table
 from astropy.coordinates import Angle
 from astropy.io import ascii
 from astropy import units as u
@@ -30,7 +27,9 @@ from astroquery.simbad import Simbad
 Simbad.ROW_LIMIT = -1
 Simbad.TIMEOUT = 300000
 
-from ztfperiodic.utils import angular_distance
+from ztfperiodic.crossmatch import CatalogIndex
+from ztfperiodic.catalogs import catalog_filenames, consolidate_catalogs
+from ztfperiodic.catalogs import load_consolidated_catalog, COLUMN_NAMES
 from ztfperiodic.utils import convert_to_hex
 
 def parse_commandline():
@@ -65,6 +64,9 @@ def parse_commandline():
 
     parser.add_option("--crossmatch_distance",default=1.0,type=float)
 
+    parser.add_option("--doParallel",  action="store_true", default=False)
+    parser.add_option("-n","--Ncore",default=8,type=int)
+
     opts, args = parser.parse_args()
 
     return opts
@@ -165,9 +167,9 @@ def read_catalog(catalog_file):
 
     return tab
 
-def load_catalog(catalog,doFermi=False,doSimbad=False,
+def load_catalog(catalog,consolidatedFile,doFermi=False,doSimbad=False,
                          doField=False,field=-1,
-                         algorithm='ECE'):
+                         algorithm='ECE',doParallel=False,Ncore=8):
 
     customSimbad=Simbad() 
     customSimbad.add_votable_fields("otype(V)")
@@ -175,64 +177,33 @@ def load_catalog(catalog,doFermi=False,doSimbad=False,
     customSimbad.add_votable_fields("otype(N)")
     customSimbad.add_votable_fields("otype(S)")
 
-    if doFermi:
-        filenames = sorted(glob.glob(os.path.join(catalog,"*/*.dat")))[::-1] + \
-                    sorted(glob.glob(os.path.join(catalog,"*/*.h5")))[::-1]
-    elif doField:
-        filenames = sorted(glob.glob(os.path.join(catalog,"%d_*.dat" % field)))[::-1] + \
-                    sorted(glob.glob(os.path.join(catalog,"%d_*.h5" % field)))[::-1]
-    else:
-        filenames = sorted(glob.glob(os.path.join(catalog,"*.dat")))[::-1] + \
-                    sorted(glob.glob(os.path.join(catalog,"*.h5")))[::-1]
-                     
-    h5names = ["objid", "ra", "dec",
-               "stats0", "stats1", "stats2", "stats3", "stats4",
-               "stats5", "stats6", "stats7", "stats8", "stats9",
-               "stats10", "stats11", "stats12", "stats13", "stats14",
-               "stats15", "stats16", "stats17", "stats18", "stats19",
-               "stats20", "stats21"] 
-
-    h5periodnames = ["objid", "period", "sig", "pdot", 
-                     "periodicstats0", "periodicstats1", "periodicstats2",
-                     "periodicstats3", "periodicstats4", "periodicstats5",
-                     "periodicstats6", "periodicstats7", "periodicstats8",
-                     "periodicstats9", "periodicstats10", "periodicstats11",
-                     "periodicstats12", "periodicstats13"]
-
-    cnt = 0
-    #filenames = filenames[:500]
-    for ii, filename in enumerate(filenames):
-        if np.mod(ii,100) == 0:
-            print(filename)
-            print('Loading file %d/%d' % (ii, len(filenames)))
-
-        filenameSplit = filename.split("/")
-        catnum = filenameSplit[-1].replace(".dat","").replace(".h5","").split("_")[-1]
-
-        try:
-            with h5py.File(filename, 'r') as f:
-                name = f['names'].value
-                filters = f['filters'].value
-                stats = f['stats'].value 
-                periodic_stats = f['stats_%s' % algorithm].value
-        except:
-            continue
-        data_tmp = Table(rows=stats, names=h5names)
-        data_tmp['name'] = name
-        data_tmp['filt'] = filters
-        data_period_tmp = Table(rows=periodic_stats, names=h5periodnames)
-        data_period_tmp.remove_column('objid')
-        data_tmp = hstack([data_tmp, data_period_tmp], join_type='inner')
-        if len(data_tmp) == 0: continue
-
-        data_tmp['name'] = data_tmp['name'].astype(str)
-        data_tmp['filt'] = data_tmp['filt'].astype(str)
-        data_tmp['catnum'] = int(catnum) * np.ones(data_tmp["ra"].shape)
-
-        coord = SkyCoord(data_tmp["ra"], data_tmp["dec"], unit=u.degree)
-        simbad = ["N/A"] * len(coord)
-        if doSimbad:
-            print('Querying simbad: %d/%d' %(ii,len(filenames)))
+    # the job catalogs are merged once into a single column-wise file
+    if not os.path.isfile(consolidatedFile):
+        filenames = catalog_filenames(catalog, doFermi=doFermi,
+                                      doField=doField, field=field)
+        consolidate_catalogs(filenames, consolidatedFile,
+                             algorithm=algorithm,
+                             doParallel=doParallel, Ncore=Ncore)
+    columns = load_consolidated_catalog(consolidatedFile)
+
+    if len(columns["ra"]) == 0:
+        print('No data in %s available...' % catalog)
+        return []
+
+    data = Table([columns[name] for name in COLUMN_NAMES],
+                 names=COLUMN_NAMES, copy=False)
+
+    simbad = np.array(["N/A"] * len(data), dtype=object)
+    if doSimbad:
+        # simbad is queried for the objects of one job catalog at a time
+        file_offsets = columns["file_offsets"]
+        nfiles = len(file_offsets) - 1
+        for ii in range(nfiles):
+            start, stop = file_offsets[ii], file_offsets[ii+1]
+            coord = SkyCoord(data["ra"][start:stop], data["dec"][start:stop],
+                             unit=u.degree)
+
+            print('Querying simbad: %d/%d' %(ii,nfiles))
             doQuery = True
             result_table = None
             nquery = 1
@@ -259,20 +230,9 @@ def load_catalog(catalog,doFermi=False,doSimbad=False,
                 coords2 = SkyCoord(ra=ra,
                                    dec=dec, frame='icrs')
                 idx,sep,_ = coords2.match_to_catalog_sky(coord)
-                for jj, ii in enumerate(idx):
-                    simbad[ii] = result_table[jj]["OTYPE_S"]
-        data_tmp['simbad'] = simbad
-        data_tmp['simbad'] = data_tmp['simbad'].astype(str)
-
-        if cnt == 0:
-            data = copy.copy(data_tmp)
-        else:
-            data = vstack([data,data_tmp])
-        cnt = cnt + 1
- 
-    if len(data) == 0:
-        print('No data in %s available...' % catalog)
-        return []
+                for jj, kk in enumerate(idx):
+                    simbad[start + kk] = result_table[jj]["OTYPE_S"]
+    data['simbad'] = simbad.astype(str)
 
     sig = data["sig"]
     idx = np.arange(len(sig))/len(sig)
@@ -304,9 +264,11 @@ if opts.doObjectFile:
                       names=['objid', 'ra', 'dec', 'period'])
 else:
     if not os.path.isfile(cat1file):
-        cat1 = load_catalog(opts.catalog1,doFermi=opts.doFermi,doSimbad=opts.doSimbad,
+        cat1 = load_catalog(opts.catalog1,cat1file.replace(".fits",".h5"),
+                                    doFermi=opts.doFermi,doSimbad=opts.doSimbad,
                                     doField=opts.doField,field=opts.field,
-                                    algorithm=opts.algorithm1)
+                                    algorithm=opts.algorithm1,
+                                    doParallel=opts.doParallel,Ncore=opts.Ncore)
         cat1.write(cat1file, format='fits')
     else:
         cat1 = Table.read(cat1file, format='fits')
@@ -322,10 +284,12 @@ if opts.doCrossMatch:
         cat2 = Table.read(cat2file, format='fits')
 else:
     if not os.path.isfile(cat2file):
-        cat2 = load_catalog(opts.catalog2,doFermi=opts.doFermi,
+        cat2 = load_catalog(opts.catalog2,cat2file.replace(".fits",".h5"),
+                            doFermi=opts.doFermi,
                             doSimbad=opts.doSimbad,
                             doField=opts.doField,field=opts.field,
-                            algorithm=opts.algorithm2)
+                            algorithm=opts.algorithm2,
+                            doParallel=opts.doParallel,Ncore=opts.Ncore)
         cat2.write(cat2file, format='fits')
     else:
         cat2 = Table.read(cat2file, format='fits')
@@ -334,17 +298,16 @@ else:
     print('Keeping %.5f %% of objects in catalog 2' % (100*len(idx2)/len(cat2)))
 
 if opts.doCrossMatch:
-    for row2 in cat2:
-        dist = angular_distance(row2["ra"], row2["dec"], cat1["ra"], cat1["dec"])
-        ellipse = patches.Ellipse((row2["ra"], row2["dec"]),
-                                  row2["amaj"], row2["amin"],
-                                  angle=row2["phi"])
-        idx = np.where(dist <= row2["amaj"])[0]
-        if len(idx) == 0: continue
-        print('For source %s' % row2["name"])
-        for jj in idx:
-            if not ellipse.contains_point((cat1["ra"][jj],cat1["dec"][jj])):
-                continue
+    # the ellipses are amaj x amin across, i.e. semi-axes of amaj/2, amin/2
+    index1 = CatalogIndex(np.array(cat1["ra"]), np.array(cat1["dec"]))
+    idys, idxs = index1.query_ellipse(np.array(cat2["ra"]),
+                                      np.array(cat2["dec"]),
+                                      np.array(cat2["amaj"])/2.0,
+                                      np.array(cat2["amin"])/2.0,
+                                      np.array(cat2["phi"]))
+    for ii in np.unique(idys):
+        print('For source %s' % cat2["name"][ii])
+        for jj in idxs[idys == ii]:
             print(cat1["objid"][jj], cat1["ra"][jj], cat1["dec"][jj])
 
 
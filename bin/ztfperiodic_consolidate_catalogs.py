@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+import os
+import time
+import optparse
+
+from ztfperiodic.catalogs import catalog_filenames
+from ztfperiodic.catalogs import consolidate_catalogs
+
+def parse_commandline():
+    """
+    Parse the options given on the command-line.
+    """
+    parser = optparse.OptionParser()
+
+    parser.add_option("-c","--catalog",default="/home/michael.coughlin/ZTF/output_quadrants_Primary_DR3/catalog/ECE_ELS_EAOV")
+    parser.add_option("-o","--outputFile",default="/home/michael.coughlin/ZTF/output_quadrants_Primary_DR3/catalog/compare/catalog_ECE.h5")
+    parser.add_option("-a","--algorithm",default="ECE")
+
+    parser.add_option("--doFermi",  action="store_true", default=False)
+    parser.add_option("--doField",  action="store_true", default=False)
+    parser.add_option("-f","--field",default=853,type=int)
+
+    parser.add_option("--doParallel",  action="store_true", default=False)
+    parser.add_option("-n","--Ncore",default=8,type=int)
+    parser.add_option("-b","--batch_size",default=100,type=int)
+
+    opts, args = parser.parse_args()
+
+    return opts
+
+# Parse command line
+opts = parse_commandline()
+
+outputDir = os.path.dirname(os.path.abspath(opts.outputFile))
+if not os.path.isdir(outputDir):
+    os.makedirs(outputDir)
+
+start_time = time.time()
+
+filenames = catalog_filenames(opts.catalog, doFermi=opts.doFermi,
+                              doField=opts.doField, field=opts.field)
+nobjects = consolidate_catalogs(filenames, opts.outputFile,
+                                algorithm=opts.algorithm,
+                                doParallel=opts.doParallel,
+                                Ncore=opts.Ncore,
+                                batch_size=opts.batch_size)
+
+end_time = time.time()
+print('Consolidated %d objects in %.2f seconds' % (nobjects,
+                                                   end_time - start_time))
@@ -18,7 +18,6 @@ matplotlib.rcParams.update({'font.size': 16})
 matplotlib.rcParams['contour.negative_linestyle'] = 'solid'
 from matplotlib.colors import LogNorm
 import matplotlib.pyplot as plt
-import matplotlib.patches as patches
 
 from astropy import units as u
 from astropy.coordinates import SkyCoord
@@ -26,7 +25,7 @@ from astropy.coordinates import SkyCoord
 import ztfperiodic
 from ztfperiodic.period import CE
 from ztfperiodic.lcstats import calc_stats
-from ztfperiodic.utils import angular_distance
+from ztfperiodic.crossmatch import CatalogIndex
 from ztfperiodic.utils import convert_to_hex
 from ztfperiodic.periodsearch import find_periods
 
@@ -133,48 +132,27 @@ opts = parse_commandline()
 names_1, ras_1, decs_1, errs_1, amaj_1, amin_1, phi_1 = read_catalog(opts.catalog_file_1)
 names_2, ras_2, decs_2, errs_2, amaj_2, amin_2, phi_2 = read_catalog(opts.catalog_file_2)
 
-idxs = []
-idys = []
+# catalog 2 is indexed once, and all of catalog 1 is matched against it
+index_2 = CatalogIndex(ras_2, decs_2)
 
 if not amaj_1 is None:
-    for ii, (name, ra, dec, err, amaj, amin, phi) in enumerate(zip(names_1, ras_1, decs_1, errs_1, amaj_1, amin_1, phi_1)):
-
-        # 1 degree
-        if amaj >= 30/60: continue
-
-        if np.mod(ii,100) == 0:
-            print('%d/ %d' % (ii, len(ras_1)))
-
-        dist = angular_distance(ra, dec, ras_2, decs_2)
-        ellipse = patches.Ellipse((ra, dec), 2*amaj, 2*amin, angle=phi)
-        idx = np.where(dist <= 2*amaj)[0]
-        for jj in idx:
-            if not ellipse.contains_point((ras_2[jj],decs_2[jj])):
-                continue
-            idxs.append(jj)
-            idys.append(ii)
-
-            print(name, ra, dec, names_2[jj], ras_2[jj], decs_2[jj])
-
+    # 1 degree
+    keep = np.where(amaj_1 < 30/60)[0]
+    idys, idxs = index_2.query_ellipse(ras_1[keep], decs_1[keep],
+                                       amaj_1[keep], amin_1[keep],
+                                       phi_1[keep])
+    idys = keep[idys]
 else:
-    for ii, (name, ra, dec, err) in enumerate(zip(names_1, ras_1, decs_1, errs_1)):
-        if np.mod(ii,100) == 0:
-            print('%d/ %d' % (ii, len(ras_1)))
-
-        dist = angular_distance(ra, dec, ras_2, decs_2)
-        idx = np.where(dist <= err/3600.0)[0]
-        for jj in idx:
-            idxs.append(jj)
-            idys.append(ii)
+    idys, idxs = index_2.query_circle(ras_1, decs_1, errs_1/3600.0)
 
-            print(name, ra, dec, names_2[jj], ras_2[jj], decs_2[jj])
+for ii, jj in zip(idys, idxs):
+    print(names_1[ii], ras_1[ii], decs_1[ii], names_2[jj], ras_2[jj], decs_2[jj])
 
 idxs = np.unique(idxs)
 
 lines = [line.rstrip('\n') for line in open(opts.catalog_file_2)]
 fid = open(opts.catalog_file, 'w')
-for ii, line in enumerate(lines):
-    if ii in idxs:
-        fid.write('%s\n' % line)
+for ii in idxs:
+    fid.write('%s\n' % lines[ii])
 fid.close()
 
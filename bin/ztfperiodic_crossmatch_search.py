@@ -18,7 +18,6 @@ matplotlib.rcParams.update({'font.size': 16})
 matplotlib.rcParams['contour.negative_linestyle'] = 'solid'
 from matplotlib.colors import LogNorm
 import matplotlib.pyplot as plt
-import matplotlib.patches as patches
 
 from astropy import units as u
 from astropy.coordinates import SkyCoord
@@ -26,7 +25,7 @@ from astropy.coordinates import SkyCoord
 import ztfperiodic
 from ztfperiodic.period import CE
 from ztfperiodic.lcstats import calc_stats
-from ztfperiodic.utils import angular_distance
+from ztfperiodic.crossmatch import CatalogIndex
 from ztfperiodic.utils import convert_to_hex
 from ztfperiodic.periodsearch import find_periods
 
@@ -214,24 +213,12 @@ for ff, filename in enumerate(filenames):
     if len(data_tmp) == 0: continue
 
     print('Analyzing %s... %d significant objects.' % (filename, len(data_tmp)))
-    idxs = []
-    idys = []
-    for ii, (name, ra, dec, err, amaj, amin, phi) in enumerate(zip(cnames, ras, decs, errs, amajs, amins, phis)):
-        #if np.mod(ii,10000) == 0:
-        #    print('Checking object %d/%d' % (ii, len(cnames)))
-
-        dist = angular_distance(ra, dec, np.array(data_tmp["ra"]),
-                                np.array(data_tmp["dec"]))
-        idx = np.where(dist <= amaj)[0]
-        if len(idx) == 0: continue
- 
-        ellipse = patches.Ellipse((ra, dec), amaj, amin, angle=phi)
-        for jj in idx:
-            if not ellipse.contains_point((data_tmp["ra"][jj],data_tmp["dec"][jj])):
-                continue
-            idxs.append(jj)
-            idys.append(ii)
-
-            print("%s %s %.5f %.5f %.5f %.5f %.5f %.5f %.5f %.5f" % (filename, name, ra, dec, err, amaj, amin, phi, data_tmp["ra"][jj],data_tmp["dec"][jj]))
-            print("%s %s %.5f %.5f %.5f %.5f %.5f %.5f %.5f %.5f" % (filename, name, ra, dec, err, amaj, amin, phi, data_tmp["ra"][jj],data_tmp["dec"][jj]), file=fid, flush=True)
+    # the ellipses are amaj x amin across, i.e. semi-axes of amaj/2, amin/2
+    index = CatalogIndex(np.array(data_tmp["ra"]), np.array(data_tmp["dec"]))
+    idys, idxs = index.query_ellipse(ras, decs, amajs/2.0, amins/2.0, phis)
+    for ii, jj in zip(idys, idxs):
+        name, ra, dec, err = cnames[ii], ras[ii], decs[ii], errs[ii]
+        amaj, amin, phi = amajs[ii], amins[ii], phis[ii]
+        print("%s %s %.5f %.5f %.5f %.5f %.5f %.5f %.5f %.5f" % (filename, name, ra, dec, err, amaj, amin, phi, data_tmp["ra"][jj],data_tmp["dec"][jj]))
+        print("%s %s %.5f %.5f %.5f %.5f %.5f %.5f %.5f %.5f" % (filename, name, ra, dec, err, amaj, amin, phi, data_tmp["ra"][jj],data_tmp["dec"][jj]), file=fid, flush=True)
 fid.close()
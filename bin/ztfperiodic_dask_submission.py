@@ -3,6 +3,7 @@
 import os, sys
 import time
 import glob
+import subprocess
 import optparse
 
 import tables
@@ -15,6 +16,7 @@ from dask_cuda import LocalCUDACluster
 from dask.distributed import Client, progress
 
 import ztfperiodic.utils
+from ztfperiodic.jobqueue import start_worker_queue
 
 try:
     from penquins import Kowalski
@@ -33,6 +35,7 @@ def parse_commandline():
     parser.add_option("-c","--CUDA_VISIBLE_DEVICES",default="0,1,2,3,4,5,6,7")
 
     parser.add_option("--doSubmit",  action="store_true", default=False)
+    parser.add_option("--doWorker",  action="store_true", default=False)
 
     opts, args = parser.parse_args()
 
@@ -70,6 +73,24 @@ def run_job(row):
         print(jobstr)
         os.system(jobstr)
 
+def run_workers(df, qsubDir, filetype, devices):
+
+    # one resident worker per GPU, pulling jobs from a shared queue file
+    queuefile = os.path.join(qsubDir,'%s.queue' % filetype)
+    try:
+        workerline = start_worker_queue(queuefile, jobline, df)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    print(workerline)
+
+    workers = []
+    for device in devices.split(","):
+        env = dict(os.environ, CUDA_VISIBLE_DEVICES=device)
+        workers.append(subprocess.Popen(workerline, shell=True, env=env))
+    for worker in workers:
+        worker.wait()
+
 if __name__ == '__main__':
 
     # Parse command line
@@ -105,6 +126,10 @@ if __name__ == '__main__':
     
     counter = 0
 
+    if opts.doSubmit and opts.doWorker:
+        run_workers(df, qsubDir, filetype, opts.CUDA_VISIBLE_DEVICES)
+        exit(0)
+
     #client = Client(opts.scheduler)
     cluster = LocalCUDACluster(CUDA_VISIBLE_DEVICES=opts.CUDA_VISIBLE_DEVICES,
                                threads_per_worker=1)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+import sys
+import json
+import optparse
+import subprocess
+
+# heavy optional dependencies that the core modules should not import
+HEAVY_MODULES = ["matplotlib.pyplot", "astroquery", "tensorflow",
+                 "kerastuner", "penquins"]
+
+MEASURE = """
+import sys, time, json
+start = time.time()
+import %s
+elapsed = time.time() - start
+print(json.dumps({"time": elapsed, "modules": list(sys.modules)}))
+"""
+
+def parse_commandline():
+    """
+    Parse the options given on the command-line.
+    """
+    parser = optparse.OptionParser()
+
+    parser.add_option("-m","--modules",default="ztfperiodic.utils,ztfperiodic.periodsearch,ztfperiodic.lcstats,ztfperiodic.lcbatch")
+    parser.add_option("-b","--budget",default=2.0,type=float)
+    parser.add_option("-n","--Nrepeat",default=3,type=int)
+
+    opts, args = parser.parse_args()
+
+    return opts
+
+def import_time(module, nrepeat=3):
+    """Best import time of module over nrepeat fresh interpreters, and
+    the heavy modules it loaded."""
+
+    best, heavy = None, []
+    for ii in range(nrepeat):
+        out = subprocess.run([sys.executable, "-c", MEASURE % module],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+        if out.returncode != 0:
+            print(out.stderr)
+            return None, []
+        result = json.loads(out.stdout.strip().split("\n")[-1])
+        if (best is None) or (result["time"] < best):
+            best = result["time"]
+        heavy = [mod for mod in HEAVY_MODULES if mod in result["modules"]]
+
+    return best, heavy
+
+# Parse command line
+opts = parse_commandline()
+modules = opts.modules.split(",")
+
+failed = []
+for module in modules:
+    elapsed, heavy = import_time(module, nrepeat=opts.Nrepeat)
+    if elapsed is None:
+        print('%s: import failed' % module)
+        failed.append(module)
+        continue
+
+    print('%s: %.2f s (budget %.2f s)' % (module, elapsed, opts.budget))
+    if len(heavy) > 0:
+        print('    imports %s' % ", ".join(heavy))
+    if (elapsed > opts.budget) or (len(heavy) > 0):
+        failed.append(module)
+
+if len(failed) > 0:
+    print('Import budget exceeded by %s' % ", ".join(failed))
+    sys.exit(1)
@@ -3,6 +3,7 @@
 import os, sys
 import time
 import glob
+import subprocess
 import optparse
 
 import tables
@@ -11,6 +12,7 @@ import numpy as np
 import h5py
 
 import ztfperiodic.utils
+from ztfperiodic.jobqueue import start_worker_queue
 
 try:
     from penquins import Kowalski
@@ -28,6 +30,8 @@ def parse_commandline():
     parser.add_option("-f","--filetype",default="slurm")
 
     parser.add_option("--doSubmit",  action="store_true", default=False)
+    parser.add_option("--doWorker",  action="store_true", default=False)
+    parser.add_option("-n","--Nworkers",default=1,type=int)
 
     opts, args = parser.parse_args()
 
@@ -100,7 +104,22 @@ print('%d jobs remaining...' % njobs)
 
 counter = 0
 
-if opts.doSubmit:
+if opts.doSubmit and opts.doWorker:
+    # resident workers pull the remaining jobs from a queue file, so the
+    # imports, Kowalski connection and catalogs are only set up once each
+    queuefile = os.path.join(qsubDir,'%s.queue' % filetype)
+    try:
+        workerline = start_worker_queue(queuefile, jobline, df)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    print(workerline)
+    workers = [subprocess.Popen(workerline, shell=True)
+               for ii in range(opts.Nworkers)]
+    for worker in workers:
+        worker.wait()
+
+elif opts.doSubmit:
     while njobs > 0:
         quadrant_index = np.random.randint(0, njobs, size=1)
         run_job(df, quadrant_index)
@@ -15,40 +15,48 @@ import tables
 import pandas as pd
 import numpy as np
 import h5py
-from scipy.signal import lombscargle
-from scipy import stats
+from scipy.stats import chi2
 
 import matplotlib
 matplotlib.use('Agg')
 matplotlib.rcParams.update({'font.size': 16})
 matplotlib.rcParams['contour.negative_linestyle'] = 'solid'
 from matplotlib.colors import LogNorm
-import matplotlib.pyplot as plt
 
 from astropy import units as u
 from astropy.coordinates import SkyCoord
-from astroquery.sdss import SDSS
 import astropy.constants as const
-import astropy.io.fits
 
 import ztfperiodic
 from ztfperiodic.period import CE
 from ztfperiodic.lcstats import calc_basic_stats, calc_fourier_stats
-from ztfperiodic.utils import get_kowalski_bulk
+from ztfperiodic.lcbatch import LightcurveBatch, map_batch
+from ztfperiodic.lccache import LightcurveCache
+from ztfperiodic.utils import get_kowalski_bulk, get_kowalski_sub_boundaries
+from ztfperiodic.utils import get_kowalski_baseline
 from ztfperiodic.utils import get_kowalski_list
 from ztfperiodic.utils import get_kowalski_objids
 from ztfperiodic.utils import get_simulated_list
-from ztfperiodic.utils import get_matchfile
+from ztfperiodic.utils import read_matchfile, matchfile_lightcurves
+from ztfperiodic.utils import matchfile_baseline
 from ztfperiodic.utils import find_matchfile
 from ztfperiodic.utils import convert_to_hex
 from ztfperiodic.utils import get_kowalski_external
-from ztfperiodic.periodsearch import find_periods
-from ztfperiodic.specfunc import correlate_spec, adjust_subplots_band, tick_function
-
-try:
-    from penquins import Kowalski
-except:
-    print("penquins not installed... need to use matchfiles.")
+from ztfperiodic.utils import database_query
+from ztfperiodic.utils import cached_query
+from ztfperiodic.utils import append_catalog
+from ztfperiodic.utils import id_boundaries_file, load_id_boundaries
+from ztfperiodic.jobqueue import pop_task
+from ztfperiodic.querypool import QueryPool
+from ztfperiodic.periodsearch import find_periods, find_periods_baseline_bins
+from ztfperiodic.freqgrid import FrequencyGrid
+from ztfperiodic.lazy import lazy_import, lazy_pyplot
+
+# only needed for plots and spectra, imported at first use
+plt = lazy_pyplot()
+fits = lazy_import('astropy.io.fits')
+sdss = lazy_import('astroquery.sdss')
+specfunc = lazy_import('ztfperiodic.specfunc')
 
 def parse_commandline():
     """
@@ -101,11 +109,24 @@ def parse_commandline():
     parser.add_option("--Ncatalog",default=1,type=int)
     parser.add_option("--Ncatindex",default=0,type=int)
 
+    parser.add_option("--doStreaming",  action="store_true", default=False)
+    parser.add_option("--chunk_size",default=10000,type=int)
+    parser.add_option("--baseline",default=None,type=float)
+    parser.add_option("--doChunkBaselines",  action="store_true", default=False)
+
+    parser.add_option("--cacheDir",default=None)
+    parser.add_option("--cacheSize",default=50.0,type=float)
+
+    parser.add_option("--doWorker",  action="store_true", default=False)
+    parser.add_option("--queue_file",default="../input/queue_file.dat")
+    parser.add_option("--queue_wait",default=0.0,type=float)
+
     parser.add_option("--stardist",default=13.0,type=float)
     parser.add_option("--sigthresh",default=None,type=float)
 
     parser.add_option("-u","--user")
     parser.add_option("-w","--pwd")
+    parser.add_option("--Nconnections",default=4,type=int)
 
     parser.add_option("-p","--program_ids",default="2,3")
     parser.add_option("--min_epochs",default=50,type=int)
@@ -128,6 +149,9 @@ def parse_commandline():
     parser.add_option("--doCheckLightcurves",  action="store_true", default=False)
 
     parser.add_option("--samples_per_peak",default=10,type=int)
+    parser.add_option("--frequencyGridDir",default=None)
+    parser.add_option("--doBaselineBins",  action="store_true", default=False)
+    parser.add_option("--baseline_ratio",default=2.0,type=float)
 
     parser.add_option("--doBrutus",  action="store_true", default=False)
     parser.add_option("--brutusPath",default="/home/michael.coughlin/ZTF/brutus/data/DATAFILES/")
@@ -137,11 +161,18 @@ def parse_commandline():
     return opts
 
 
+# star catalogs are read once per process; astropy also keeps the
+# matching tree on the SkyCoord, so it is only built once as well
+star_catalogs = {}
+
 def brightstardist(filename,ra,dec):
      catalog = SkyCoord(ra=ra*u.degree, dec=dec*u.degree, frame='icrs')
-     with h5py.File(filename, 'r') as f:
-         ras, decs = f['ra'][:], f['dec'][:]
-     c = SkyCoord(ra=ras*u.degree, dec=decs*u.degree,frame='icrs')
+     if not filename in star_catalogs:
+         with h5py.File(filename, 'r') as f:
+             ras, decs = f['ra'][:], f['dec'][:]
+         c = SkyCoord(ra=ras*u.degree, dec=decs*u.degree,frame='icrs')
+         star_catalogs[filename] = (ras, decs, c)
+     ras, decs, c = star_catalogs[filename]
      idx,sep,_ = catalog.match_to_catalog_sky(c)
 
      seps = []
@@ -171,7 +202,6 @@ def slicestardist(lightcurves, coordinates, filters, ids, absmags, bp_rps, names
     filename = "%s/bsc5.hdf5" % inputDir
     sep = brightstardist(filename,ras,decs)
     idx1 = np.where(sep >= opts.stardist)[0]
-    sep = brightstardist(filename,ras,decs)
     filename = "%s/Gaia.hdf5" % inputDir
     sep = brightstardist(filename,ras,decs)
     idx2 = np.where(sep >= opts.stardist)[0]
@@ -180,6 +210,18 @@ def slicestardist(lightcurves, coordinates, filters, ids, absmags, bp_rps, names
     return [lightcurves[i] for i in idx], [coordinates[i] for i in idx], [filters[i] for i in idx], [ids[i] for i in idx], [absmags[i] for i in idx], [bp_rps[i] for i in idx], [names[i] for i in idx]
 
 
+def make_batch(lightcurves, coordinates, filters, ids, absmags, bp_rps,
+               names, baseline, doRemoveBrightStars=False):
+
+    if doRemoveBrightStars and (len(lightcurves) > 0):
+        lightcurves, coordinates, filters, ids, absmags, bp_rps, names =\
+            slicestardist(lightcurves, coordinates, filters,
+                          ids, absmags, bp_rps, names)
+
+    return LightcurveBatch.from_lists(lightcurves, coordinates, filters,
+                                      ids, absmags, bp_rps, names, baseline)
+
+
 def touch(fname):
     if os.path.exists(fname):
         os.utime(fname, None)
@@ -197,6 +239,15 @@ if not (opts.doCPU or opts.doGPU):
     print("--doCPU or --doGPU required")
     exit(0)
 
+# streamed jobs search all chunks on the grid of the job baseline, which
+# is only derived without reading the light curves for matchfiles and
+# Kowalski quadrants
+if opts.doStreaming and (opts.baseline is None) and \
+   (not opts.doChunkBaselines) and (opts.lightcurve_source == "Kowalski") and \
+   (opts.source_type != "quadrant"):
+    print("--doStreaming of Kowalski %s sources requires --baseline (or --doChunkBaselines)" % opts.source_type)
+    exit(1)
+
 algorithms = opts.algorithm.split(',')
 matchFile = opts.matchFile
 outputDir = opts.outputDir
@@ -235,10 +286,6 @@ if opts.doBrutus:
     from brutus.fitting import BruteForce
     from brutus import plotting as bplot
 
-    brutusDir = os.path.join(outputDir,'brutus', "%d_%d_%d_%d"%(field, ccd, quadrant, Ncatindex))
-    if not os.path.isdir(brutusDir):
-        os.makedirs(brutusDir)
-
     filt = filters.wise + filters.ps[:-2]
     #filt = filters.ps[:-2]
     
@@ -336,926 +383,1083 @@ else:
 epoch_ranges = [0,100,500,np.inf]
 epoch_folders = ["0-100","100-500","500-all"]
 
-catalogDir = os.path.join(outputDir,'catalog',"_".join(algorithms))
-if (opts.source_type == "catalog") and ("fermi" in catalog_file):
-    catalogDir = os.path.join(catalogDir,'%d' % Ncatindex)
-if not os.path.isdir(catalogDir):
-    os.makedirs(catalogDir)
-
-if opts.doSpectra:
-    spectraDir = os.path.join(outputDir,'spectra')
-    if (opts.source_type == "spectra") and ("fermi" in spectra_file):
-        spectraDir = os.path.join(spectraDir,'%d' % Ncatindex)
-    if not os.path.isdir(spectraDir):
-        os.makedirs(spectraDir)
-
-lightcurves = []
-coordinates = []
-baseline=0
-fil = 'all'
+catalogBaseDir = os.path.join(outputDir,'catalog',"_".join(algorithms))
+spectraBaseDir = os.path.join(outputDir,'spectra')
 
 try:
     print('Running on host %s' % (subprocess.check_output(['hostname','-f']).decode().replace("\n","")))
 except:
     pass
 
-print('Organizing lightcurves...')
 if opts.lightcurve_source == "Kowalski":
+    # the connections (and the cache) are shared by all tasks of a worker
+    kow = QueryPool.connect(opts.user, opts.pwd,
+                            nconnections=opts.Nconnections)
 
-    catalogFile = os.path.join(catalogDir,"%d_%d_%d.h5"%(field, ccd, quadrant))
-    if opts.doSpectra:
-        spectraFile = os.path.join(spectraDir,"%d_%d_%d.pkl"%(field, ccd, quadrant))
-
-    kow = []
-    nquery = 10
-    cnt = 0
-    while cnt < nquery:
-        try:
-            kow = Kowalski(username=opts.user, password=opts.pwd)
-            break
-        except:
-            time.sleep(5)
-        cnt = cnt + 1
-    if cnt == nquery:
-        raise Exception('Kowalski connection failed...')
-
-    if opts.source_type == "quadrant":
-        catalogFile = os.path.join(catalogDir,"%d_%d_%d_%d.h5"%(field, ccd, quadrant,Ncatindex))
-        if opts.doSpectra:
-            spectraFile = os.path.join(spectraDir,"%d_%d_%d_%d.pkl"%(field, ccd, quadrant,Ncatindex))
-
-        lightcurves, coordinates, filters, ids,\
-        absmags, bp_rps, names, baseline =\
-            get_kowalski_bulk(field, ccd, quadrant, kow, 
-                              program_ids=program_ids, min_epochs=min_epochs,
-                              num_batches=Ncatalog, nb=Ncatindex,
-                              doRemoveHC=doRemoveHC, doHCOnly=doHCOnly,
-                              doSigmaClipping=doSigmaClipping,
-                              sigmathresh=sigmathresh,
-                              doPercentile=doPercentile,
-                              percmin = percmin, percmax = percmax)
-        if opts.doRemoveBrightStars:
-            lightcurves, coordinates, filters, ids, absmags, bp_rps, names =\
-                slicestardist(lightcurves, coordinates, filters,
-                              ids, absmags, bp_rps, names)
-
-    elif opts.source_type == "catalog":
-
-        amaj, amin, phi = None, None, None
-        if not opts.default_err is None:
-            default_err = opts.default_err
-        else:
-            if doCombineFilt:
-                default_err = 3.0
-            else:
-                default_err = 5.0
-
-        if ".dat" in catalog_file:
-            lines = [line.rstrip('\n') for line in open(catalog_file)]
-            names, ras, decs, errs = [], [], [], []
-            if ("fermi" in catalog_file):
-                amaj, amin, phi = [], [], []
-            for line in lines:
-                lineSplit = list(filter(None,line.split(" ")))
-                if ("blue" in catalog_file) or ("uvex" in catalog_file) or ("xraybinary" in catalog_file) or ("lamost_mira" in catalog_file) or ("rotators" in catalog_file) or ("ap" in catalog_file):
-                    ra_hex, dec_hex = convert_to_hex(float(lineSplit[0])*24/360.0,delimiter=''), convert_to_hex(float(lineSplit[1]),delimiter='')
-                    if dec_hex[0] == "-":
-                        objname = "ZTFJ%s%s"%(ra_hex[:4],dec_hex[:5])
-                    else:
-                        objname = "ZTFJ%s%s"%(ra_hex[:4],dec_hex[:4])
-                    names.append(objname)
-                    ras.append(float(lineSplit[0]))
-                    decs.append(float(lineSplit[1]))
-                    errs.append(default_err)
-                elif "gaia_large_rv.dat" in catalog_file:
-                    ra_hex, dec_hex = convert_to_hex(float(lineSplit[0])*24/360.0,delimiter=''), convert_to_hex(float(lineSplit[1]),delimiter='')
-                    if dec_hex[0] == "-":
-                        objname = "ZTFJ%s%s"%(ra_hex[:4],dec_hex[:5])
-                    else:
-                        objname = "ZTFJ%s%s"%(ra_hex[:4],dec_hex[:4])
-                    names.append(objname)
-                    ras.append(float(lineSplit[0]))
-                    decs.append(float(lineSplit[1]))
-                    errs.append(default_err)
-                elif ("vlss" in catalog_file):
-                    names.append(lineSplit[0])
-                    ras.append(float(lineSplit[1]))
-                    decs.append(float(lineSplit[2]))
-                    err = np.sqrt(float(lineSplit[3])**2 + float(lineSplit[4])**2)*3600.0
-                    errs.append(err)
-                elif ("apogee" in catalog_file):
-                    names.append(lineSplit[0])
-                    ras.append(float(lineSplit[3]))
-                    decs.append(float(lineSplit[4]))
-                    errs.append(default_err)
-                elif ("fermi" in catalog_file):
-                    names.append(lineSplit[0])
-                    ras.append(float(lineSplit[1]))
-                    decs.append(float(lineSplit[2]))
-                    err = np.sqrt(float(lineSplit[3])**2 + float(lineSplit[4])**2)*3600.0
-                    errs.append(err)
-                    amaj.append(float(lineSplit[3]))
-                    amin.append(float(lineSplit[4]))
-                    phi.append(float(lineSplit[5]))
-                elif ("swift" in catalog_file) or ("xmm" in catalog_file):
-                    names.append(lineSplit[0])
-                    ras.append(float(lineSplit[1]))
-                    decs.append(float(lineSplit[2]))
-                    err = float(lineSplit[3])
-                    errs.append(err)
-                else:
-                    names.append(lineSplit[0])
-                    ras.append(float(lineSplit[1]))
-                    decs.append(float(lineSplit[2]))
-                    errs.append(default_err)
-            names = np.array(names)
-            ras, decs, errs = np.array(ras), np.array(decs), np.array(errs)
-            if ("fermi" in catalog_file):
-                amaj, amin, phi = np.array(amaj), np.array(amin), np.array(phi)
-
-            names_split = np.array_split(names,Ncatalog)
-            ras_split = np.array_split(ras,Ncatalog)
-            decs_split = np.array_split(decs,Ncatalog)
-            errs_split = np.array_split(errs,Ncatalog)
-    
-            names = names_split[Ncatindex]
-            ras = ras_split[Ncatindex]
-            decs = decs_split[Ncatindex]
-            errs = errs_split[Ncatindex]
-    
-            if ("fermi" in catalog_file):
-                amaj_split = np.array_split(amaj,Ncatalog)
-                amin_split = np.array_split(amin,Ncatalog)
-                phi_split = np.array_split(phi,Ncatalog)
-    
-                amaj = amaj_split[Ncatindex]
-                amin = amin_split[Ncatindex]
-                phi = phi_split[Ncatindex]
-
-        elif ".hdf5" in catalog_file:
-            if "underMS" in catalog_file:
-                with h5py.File(catalog_file.replace(".hdf5","_ra.hdf5"), 'r') as f:
-                    ras = f['ra'][:]
-                with h5py.File(catalog_file.replace(".hdf5","_dec.hdf5"), 'r') as f:
-                    decs = f['dec'][:]
-            else:
-                with h5py.File(catalog_file, 'r') as f:
-                    ras, decs = f['ra'][:], f['dec'][:]
-            errs = default_err*np.ones(ras.shape)
-
-            ras_split = np.array_split(ras,Ncatalog)
-            decs_split = np.array_split(decs,Ncatalog)
-            errs_split = np.array_split(errs,Ncatalog)
- 
-            ras = ras_split[Ncatindex]
-            decs = decs_split[Ncatindex]
-            errs = errs_split[Ncatindex]
- 
-            if ("fermi" in catalog_file):
-                amaj_split = np.array_split(amaj,Ncatalog)
-                amin_split = np.array_split(amin,Ncatalog)
-                phi_split = np.array_split(phi,Ncatalog)
- 
-                amaj = amaj_split[Ncatindex]
-                amin = amin_split[Ncatindex]
-                phi = phi_split[Ncatindex]
-
-            names = []
-            for ra, dec in zip(ras, decs):
-                ra_hex, dec_hex = convert_to_hex(ra*24/360.0,delimiter=''), convert_to_hex(dec,delimiter='')
-                if dec_hex[0] == "-":
-                    objname = "ZTFJ%s%s"%(ra_hex[:4],dec_hex[:5])
-                else:
-                    objname = "ZTFJ%s%s"%(ra_hex[:4],dec_hex[:4])
-                names.append(objname)
-            names = np.array(names)
-
-        if opts.doRemoveBrightStars:
-            filename = "%s/bsc5.hdf5" % inputDir
-            sep = brightstardist(filename,ras,decs)
-            idx1 = np.where(sep >= opts.stardist)[0]
-            filename = "%s/Gaia.hdf5" % inputDir
-            sep = brightstardist(filename,ras,decs)
-            idx2 = np.where(sep >= opts.stardist)[0]
-            idx = np.union1d(idx1,idx2)
-            names = names[idx]
-            ras, decs, errs = ras[idx], decs[idx], errs[idx]
-            if ("fermi" in catalog_file):
-                amaj, amin, phi = amaj[idx], amin[idx], phi[idx]
-
-        catalog_file_split = catalog_file.replace(".dat","").replace(".hdf5","").replace(".h5","").split("/")[-1]
-        catalogFile = os.path.join(catalogDir,"%s_%d.h5"%(catalog_file_split,
-                                                           Ncatindex))
-        if opts.doSpectra:
-            spectraFile = os.path.join(spectraDir,"%s_%d.pkl"%(catalog_file_split,
-                                                               Ncatindex))
-
-        if doSimulateLightcurves:
-            lightcurves, coordinates, filters, ids,\
-            absmags, bp_rps, names, baseline =\
-                get_simulated_list(ras, decs,
-                                  min_epochs=min_epochs,
-                                  names=names,
-                                  doCombineFilt=doCombineFilt,
-                                  doRemoveHC=doRemoveHC,
-                                  doUsePDot=doUsePDot)
-        else:
-            lightcurves, coordinates, filters, ids,\
-            absmags, bp_rps, names, baseline =\
-                get_kowalski_list(ras, decs,
-                                  kow,
-                                  program_ids=program_ids,
-                                  min_epochs=min_epochs,
-                                  errs=errs,
-                                  names=names,
-                                  amaj=amaj, amin=amin, phi=phi,
-                                  doCombineFilt=doCombineFilt,
-                                  doRemoveHC=doRemoveHC,
-                                  doExtinction=doExtinction,
-                                  doSigmaClipping=doSigmaClipping,
-                                  sigmathresh=sigmathresh,
-                                  doOutbursting=doOutbursting,
-                                  doCrossMatch=doCrossMatch,
-                                  crossmatch_radius=crossmatch_radius)
-
-    elif opts.source_type == "objid":
-
-        if (".dat" in catalog_file) or (".txt" in catalog_file):
-            objids = np.loadtxt(catalog_file)
-            objids = objids[:,0] 
-        elif ".npy" in catalog_file:
-            objids = np.load(catalog_file)
-        else:
-            print("Sorry I don't know this file extension...")
-            exit(0)
-
-        objids_split = np.array_split(objids,Ncatalog)
-        objids = objids_split[Ncatindex]
+    # reruns of the same sources are read from the local cache
+    cache = None
+    if opts.cacheDir is not None:
+        cache = LightcurveCache(opts.cacheDir, max_size=opts.cacheSize)
 
-        catalog_file_split = catalog_file.replace(".dat","").replace(".hdf5","").replace(".h5","").replace(".npy","").split("/")[-1]
-        catalogFile = os.path.join(catalogDir,"%s_%d.h5"%(catalog_file_split,
-                                                           Ncatindex))
+    # _id boundaries of the quadrant batches, saved with the job manifest
+    quadrant_boundaries = {}
+    if opts.doQuadrantFile:
+        boundariesFile = id_boundaries_file(opts.quadrant_file)
+        if os.path.isfile(boundariesFile):
+            quadrant_boundaries = load_id_boundaries(boundariesFile)
 
-        if opts.doSpectra:
-            spectraFile = os.path.join(spectraDir,"%s_%d.pkl"%(catalog_file_split,
-                                                               Ncatindex))
 
+def analyze_lightcurves(lightcurves, nprocessed=0, baseline=None):
+    """Run the stats, period finding and cataloging on a LightcurveBatch.
 
-        lightcurves, coordinates, filters, ids,\
-        absmags, bp_rps, names, baseline =\
-            get_kowalski_objids(objids, kow,
-                                program_ids=program_ids,
-                                min_epochs=min_epochs,
-                                doRemoveHC=doRemoveHC,
-                                doHCOnly=doHCOnly,
-                                doExtinction=doExtinction,
-                                doSigmaClipping=doSigmaClipping,
-                                sigmathresh=sigmathresh,
-                                doOutbursting=doOutbursting,
-                                doPercentile=doPercentile,
-                                percmin = percmin, percmax = percmax,
-                                doParallel = opts.doParallel,
-                                Ncore = opts.Ncore)
-    else:
-        print("Source type unknown...")
-        exit(0)
-
-elif opts.lightcurve_source == "matchfiles":
-    if ":" in matchFile:
-        matchFile_end = matchFile.split(":")[-1].split("/")[-1]
-        matchFile_out = "/scratch/mcoughlin/%s" % matchFile_end
-        if not os.path.isfile(matchFile_out):
-            print('Fetching %s...' % matchFile)
-            wget_command = "scp -i /home/mcoughlin/.ssh/id_rsa_passwordless %s %s" % (matchFile, matchFile_out)
-            os.system(wget_command)
-        matchFile = matchFile_out
-
-    if not os.path.isfile(matchFile):
-        print("%s missing..."%matchFile)
-        exit(0)
-
-    matchFile_split = matchFile.replace(".pytable","").replace(".hdf5","").replace(".h5","").split("/")[-1]
-    catalogFile = os.path.join(catalogDir,"%s_%d.h5"%(matchFile_split,
-                                                           Ncatindex))
-    if opts.doSpectra:
-        spectraFile = os.path.join(spectraDir,matchFileEnd)
-
-    #matchFile = find_matchfile(opts.matchfileDir)
-    lightcurves, coordinates, filters, ids,\
-    absmags, bp_rps, names, baseline = get_matchfile(matchFile,
-                                                     min_epochs=min_epochs,
-                                                     doRemoveHC=doRemoveHC,
-                                                     doHCOnly=doHCOnly,
-                                                     Ncatalog=Ncatalog,
-                                                     Ncatindex=Ncatindex)
-
-    if opts.doRemoveBrightStars:
-        lightcurves, coordinates, filters, ids, absmags, bp_rps, names =\
-            slicestardist(lightcurves, coordinates, filters,
-                          ids, absmags, bp_rps, names)
-
-    if len(lightcurves) == 0:
-        print("No data available...")
-        exit(0)
+    nprocessed is the number of objects analyzed in earlier chunks and
+    keeps the brutus output file names unique across chunks. baseline
+    sets the frequency grid, the one of the batch if None.
+    """
 
-elif opts.lightcurve_source == "h5files":
-    if not os.path.isfile(matchFile):
-        print("%s missing..."%matchFile)
-        exit(0)
+    if baseline is None:
+        baseline = lightcurves.baseline
+    coordinates = lightcurves.coordinates
+    filters, ids, names = lightcurves.filters, lightcurves.ids, lightcurves.names
+    absmags, bp_rps = lightcurves.absmags, lightcurves.bp_rps
 
-    matchFileEnd = matchFile.split("/")[-1].replace("h5","h5")
-    catalogFile = os.path.join(catalogDir,matchFileEnd)
-    if opts.doSpectra:
-        spectraFile = os.path.join(spectraDir,matchFileEnd)
-    matchFileEndSplit = matchFileEnd.split("_")
-    fil = matchFileEndSplit[2][1]
-
-    f = h5py.File(matchFile, 'r+')
-    for key in f.keys():
-        keySplit = key.split("_")
-        nid, ra, dec = int(keySplit[0]), float(keySplit[1]), float(keySplit[2])
-        coordinates.append((ra,dec))
-
-        data = list(f[key])
-        data = np.array(data).T
-        if len(data[:,0]) < min_epochs: continue
-        lightcurve=(data[:,0],data[:,1],data[:,2])
-        lightcurves.append(lightcurve)
-
-        newbaseline = max(data[:,0])-min(data[:,0])
-        if newbaseline>baseline:
-            baseline=newbaseline
-    f.close()
-
-    if opts.doRemoveBrightStars:
-        lightcurves, coordinates = slicestardist(lightcurves, coordinates)
-
-if len(lightcurves) == 0:
-    touch(catalogFile)
-    if opts.doSpectra:
-        touch(spectraFile)
-    print('No lightcurves available... exiting.')
-    exit(0)
+    print('Running lightcurve basic stats...')
+    start_time = time.time()
 
-if opts.doCheckLightcurves:
-    print('Just checking that there are lightcurves to analyze... exiting.')
-    exit(0)
+    brutus_out = None
 
-print('Running lightcurve basic stats...')
-start_time = time.time()
+    if opts.doBrutus:
+        brutus_out = np.nan*np.ones((len(coordinates),len(filt)+4))
+        for ii, coordinate in enumerate(coordinates):
+
+            ra, dec = coordinate[0], coordinate[1]
+            external = get_kowalski_external(ra, dec, kow)
+            coord = SkyCoord(ra=ra*u.degree, dec=dec*u.degree, frame='icrs')
+            galcoords = np.vstack([coord.galactic.l.deg, coord.galactic.b.deg]).T
+
+            mag, magerr = np.array(external["mag"]), np.array(external["magerr"])
+            parallax, parallax_err = external["parallax"][0], external["parallax"][1]
+            mask = np.isfinite(magerr) & np.not_equal(magerr,np.zeros(magerr.shape))  # create boolean band mask
+            if len(np.where(mask)[0]) < 4: continue
+
+            magerr = np.sqrt(magerr**2 + 0.02**2)
+            phot, err = butils.inv_magnitude(mag, magerr)  # convert to flux (in maggies)
+            if np.isnan(parallax) or np.isnan(parallax_err) or (parallax - 5*parallax_err < 0):
+                continue
 
-if opts.doBrutus:
-    brutus_out = np.nan*np.ones((len(coordinates),len(filt)+4))
-    for ii, coordinate in enumerate(coordinates):
-
-        ra, dec = coordinate[0], coordinate[1]
-        external = get_kowalski_external(ra, dec, kow)
-        coord = SkyCoord(ra=ra*u.degree, dec=dec*u.degree, frame='icrs')
-        galcoords = np.vstack([coord.galactic.l.deg, coord.galactic.b.deg]).T
-
-        mag, magerr = np.array(external["mag"]), np.array(external["magerr"])
-        parallax, parallax_err = external["parallax"][0], external["parallax"][1]
-        mask = np.isfinite(magerr) & np.not_equal(magerr,np.zeros(magerr.shape))  # create boolean band mask
-        if len(np.where(mask)[0]) < 4: continue
-
-        magerr = np.sqrt(magerr**2 + 0.02**2)
-        phot, err = butils.inv_magnitude(mag, magerr)  # convert to flux (in maggies)
-        if np.isnan(parallax) or np.isnan(parallax_err) or (parallax - 5*parallax_err < 0):
-            continue
-   
-        filename = os.path.join(brutusDir, '%d' % ii)
-        filenameh5 = filename + '.h5'
-        if not os.path.isfile(filenameh5):
-     
-            # fit a set of hypothetical objects
-            BF_mist.fit(np.atleast_2d(phot),  # fluxes (in maggies)
-                        np.atleast_2d(err),  # errors (in maggies)
-                        np.atleast_2d(mask),  # band mask (True/False whether band was observed)
-                        merr_max=1.00,
-                        wt_thresh=1e-2,
-                        rv_gauss=rv_gauss,
-                        rvlim=rvlim,
-                        data_labels=np.atleast_2d(np.arange(1)).T,
-                        save_file=filename,  # filename where results are stored (.h5 automatically added)
-                        data_coords=np.atleast_2d(galcoords),  # array of (l, b) coordinates for Galactic prior
-                        parallax=np.atleast_2d(parallax).T,
-                        parallax_err=np.atleast_2d(parallax_err).T,  # parallax measurements (in mas)
-                        phot_offsets=off_mist,  # photometric offsets applied to **data**
-                        dustfile=dustfile,  # 3-D dustmap prior
-                        Ndraws=100,  # number of samples to save to disk
-                        Nmc_prior=20,  # number of Monte Carlo draws used to incorporate priors
-                        logl_dim_prior=True,  # use chi2 distribution instead of Gaussian
-                        save_dar_draws=True,  # save (dist, Av, Rv) samples
-                        running_io=False,  # write out objects as soon as they finish
-                        verbose=True)
-    
-        # load results
-        f = h5py.File(filenameh5, 'r')
-        idxs_mist = f['model_idx'][:]  # model indices
-        chi2_mist = f['obj_chi2min'][:]  # best-fit chi2
-        nbands_mist = f['obj_Nbands'][:]  # number of bands in fit
-        dists_mist = f['samps_dist'][:]
-        reds_mist = f['samps_red'][:]
-        dreds_mist = f['samps_dred'][:]
-        lnps_mist = f['samps_logp'][:]
-
-        i = 0
-
-        # Generate SEDs.
-        seds = butils.get_seds(models_mist[idxs_mist[i]],
-                               av=reds_mist[i], rv=dreds_mist[i])
-        # SEDs are in magnitude space.
-        seds += 5. * np.log10(dists_mist[i])[:, None]
-
-        sedsdiff = (mag - np.median(seds, axis=0))/magerr
-        parallaxdiff = (parallax - np.median(1.0/dists_mist))/parallax_err
-
-        # Ignore age weights.
-        labels = [x for x in labels_mist.dtype.names if x != 'agewt']
-
-        # Deal with 1D results.
-        samples = labels_mist[idxs_mist[i]]
-        samples = np.array([samples[l] for l in labels]).T
-        samples = np.atleast_1d(samples)
-
-        idx = labels.index('smf')
-        smfsamp = samples[:,idx]
-        frac = len(np.where(smfsamp > 0.5)[0])/len(smfsamp)
-        #print('Fraction of smf > 0.5: %.5f' % (frac))
-
-        brutus_out[ii,:len(filt)] = sedsdiff
-        brutus_out[ii,len(filt)] = parallaxdiff
-        brutus_out[ii,len(filt)+1] = frac
-        brutus_out[ii,len(filt)+2] = stats.chi2.sf(chi2_mist[i], nbands_mist - 3)
-        brutus_out[ii,len(filt)+3] = 1
- 
-        # check number of good fits
-        good = brutus_out[ii,len(filt)+2] > 1e-3
-        if not good:
-            brutus_out[ii,len(filt)+3] = 0
-            continue
-        for l in ['mini', 'feh', 'eep']:
-            bound_low, bound_high = np.percentile(labels_mist[l][idxs_mist], [2.5, 97.5],
-                                                  axis=1)
-            good *= (bound_low > np.min(labels_mist[l])) & (bound_high < np.max(labels_mist[l]))
-        if not good[0]:
-            brutus_out[ii,len(filt)+3] = 0
-            continue
-        #print('Good posteriors: {0}/{1} [{2}%]'.format(Ngood, len(good),
-        #                                               100. * Ngood / len(good)))
+            filename = os.path.join(brutusDir, '%d' % (ii + nprocessed))
+            filenameh5 = filename + '.h5'
+            if not os.path.isfile(filenameh5):
+
+                # fit a set of hypothetical objects
+                BF_mist.fit(np.atleast_2d(phot),  # fluxes (in maggies)
+                            np.atleast_2d(err),  # errors (in maggies)
+                            np.atleast_2d(mask),  # band mask (True/False whether band was observed)
+                            merr_max=1.00,
+                            wt_thresh=1e-2,
+                            rv_gauss=rv_gauss,
+                            rvlim=rvlim,
+                            data_labels=np.atleast_2d(np.arange(1)).T,
+                            save_file=filename,  # filename where results are stored (.h5 automatically added)
+                            data_coords=np.atleast_2d(galcoords),  # array of (l, b) coordinates for Galactic prior
+                            parallax=np.atleast_2d(parallax).T,
+                            parallax_err=np.atleast_2d(parallax_err).T,  # parallax measurements (in mas)
+                            phot_offsets=off_mist,  # photometric offsets applied to **data**
+                            dustfile=dustfile,  # 3-D dustmap prior
+                            Ndraws=100,  # number of samples to save to disk
+                            Nmc_prior=20,  # number of Monte Carlo draws used to incorporate priors
+                            logl_dim_prior=True,  # use chi2 distribution instead of Gaussian
+                            save_dar_draws=True,  # save (dist, Av, Rv) samples
+                            running_io=False,  # write out objects as soon as they finish
+                            verbose=True)
+
+            # load results
+            f = h5py.File(filenameh5, 'r')
+            idxs_mist = f['model_idx'][:]  # model indices
+            chi2_mist = f['obj_chi2min'][:]  # best-fit chi2
+            nbands_mist = f['obj_Nbands'][:]  # number of bands in fit
+            dists_mist = f['samps_dist'][:]
+            reds_mist = f['samps_red'][:]
+            dreds_mist = f['samps_dred'][:]
+            lnps_mist = f['samps_logp'][:]
+
+            i = 0
+
+            # Generate SEDs.
+            seds = butils.get_seds(models_mist[idxs_mist[i]],
+                                   av=reds_mist[i], rv=dreds_mist[i])
+            # SEDs are in magnitude space.
+            seds += 5. * np.log10(dists_mist[i])[:, None]
+
+            sedsdiff = (mag - np.median(seds, axis=0))/magerr
+            parallaxdiff = (parallax - np.median(1.0/dists_mist))/parallax_err
+
+            # Ignore age weights.
+            labels = [x for x in labels_mist.dtype.names if x != 'agewt']
+
+            # Deal with 1D results.
+            samples = labels_mist[idxs_mist[i]]
+            samples = np.array([samples[l] for l in labels]).T
+            samples = np.atleast_1d(samples)
+
+            idx = labels.index('smf')
+            smfsamp = samples[:,idx]
+            frac = len(np.where(smfsamp > 0.5)[0])/len(smfsamp)
+            #print('Fraction of smf > 0.5: %.5f' % (frac))
+
+            brutus_out[ii,:len(filt)] = sedsdiff
+            brutus_out[ii,len(filt)] = parallaxdiff
+            brutus_out[ii,len(filt)+1] = frac
+            brutus_out[ii,len(filt)+2] = chi2.sf(chi2_mist[i], nbands_mist - 3)
+            brutus_out[ii,len(filt)+3] = 1
+
+            # check number of good fits
+            good = brutus_out[ii,len(filt)+2] > 1e-3
+            if not good:
+                brutus_out[ii,len(filt)+3] = 0
+                continue
+            for l in ['mini', 'feh', 'eep']:
+                bound_low, bound_high = np.percentile(labels_mist[l][idxs_mist], [2.5, 97.5],
+                                                      axis=1)
+                good *= (bound_low > np.min(labels_mist[l])) & (bound_high < np.max(labels_mist[l]))
+            if not good[0]:
+                brutus_out[ii,len(filt)+3] = 0
+                continue
+            #print('Good posteriors: {0}/{1} [{2}%]'.format(Ngood, len(good),
+            #                                               100. * Ngood / len(good)))
 
-if opts.doParallel:
-    from joblib import Parallel, delayed
-    stats = Parallel(n_jobs=opts.Ncore)(delayed(calc_basic_stats)(LC[0],LC[1],LC[2]) for LC in lightcurves)
-else:
-    stats = []
-    for ii,data in enumerate(lightcurves):
-        if np.mod(ii,100) == 0:
-            print("%d/%d"%(ii,len(lightcurves)))
-        copy = np.ma.copy(data).T
-        t, mag, magerr = copy[:,0], copy[:,1], copy[:,2]
-
-        stat = calc_basic_stats(t, mag, magerr)
-        stats.append(stat)
-end_time = time.time()
-print('Lightcurve basic statistics took %.2f seconds' % (end_time - start_time))
-
-if baseline<10:
-    if opts.doLongPeriod:
-        fmin, fmax = 2/baseline, 48
+    if opts.doParallel:
+        # the workers read the light curves from shared memory
+        stats = np.vstack(map_batch(calc_basic_stats, lightcurves,
+                                    Ncore=opts.Ncore))
     else:
-        fmin, fmax = 2/baseline, 480
-else:
-    if opts.doLongPeriod:
-        fmin, fmax = 2/baseline, 48
+        stats = calc_basic_stats(lightcurves)
+    end_time = time.time()
+    print('Lightcurve basic statistics took %.2f seconds' % (end_time - start_time))
+
+    if baseline<10:
+        if opts.doLongPeriod:
+            fmin, fmax = 2/baseline, 48
+        else:
+            fmin, fmax = 2/baseline, 480
     else:
-        fmin, fmax = 2/baseline, 480
+        if opts.doLongPeriod:
+            fmin, fmax = 2/baseline, 48
+        else:
+            fmin, fmax = 2/baseline, 480
 
-print('Using baseline: %.5f, fmin: %.5f, fmax %.5f' %(baseline, fmin, fmax))
+    print('Using baseline: %.5f, fmin: %.5f, fmax %.5f' %(baseline, fmin, fmax))
 
-samples_per_peak = opts.samples_per_peak
-phase_bins, mag_bins = 20, 10
+    samples_per_peak = opts.samples_per_peak
+    phase_bins, mag_bins = 20, 10
 
-df = 1./(samples_per_peak * baseline)
-nf = int(np.ceil((fmax - fmin) / df))
-freqs = fmin + df * np.arange(nf)
+    df = 1./(samples_per_peak * baseline)
 
-if opts.doRemoveTerrestrial:
-    #freqs_to_remove = [[3e-2,4e-2], [47.99,48.01], [46.99,47.01], [45.99,46.01], [3.95,4.05], [2.95,3.05], [1.95,2.05], [0.95,1.05], [0.48, 0.52]]
-    freqs_to_remove = [[3e-2,4e-2], [3.95,4.05], [2.95,3.05], [1.95,2.05], [0.95,1.05], [0.48, 0.52]]
-else:
-    freqs_to_remove = None
-
-periodic_stats_algorithms = {}
-for algorithm in algorithms:    
-    if opts.doGPU and (algorithm == "PDM"):
-        from cuvarbase.utils import weights
-        lightcurves_pdm = []
-        for lightcurve in lightcurves:
-            t, y, dy = lightcurve
-            lightcurves_pdm.append((t, y, weights(np.ones(dy.shape)), freqs))
-        lightcurves = lightcurves_pdm 
-    
-    if opts.doNotPeriodFind:
-        periods_best = np.ones((len(lightcurves),1))
-        significances = np.ones((len(lightcurves),1))
-        pdots = np.ones((len(lightcurves),1))
+    if opts.doRemoveTerrestrial:
+        #freqs_to_remove = [[3e-2,4e-2], [47.99,48.01], [46.99,47.01], [45.99,46.01], [3.95,4.05], [2.95,3.05], [1.95,2.05], [0.95,1.05], [0.48, 0.52]]
+        freqs_to_remove = [[3e-2,4e-2], [3.95,4.05], [2.95,3.05], [1.95,2.05], [0.95,1.05], [0.48, 0.52]]
     else:
-        print('Analyzing %d lightcurves...' % len(lightcurves))
+        freqs_to_remove = None
+
+    # the grid and its alias mask are shared by all algorithms (and by the
+    # jobs using the same frequencyGridDir)
+    freqs = FrequencyGrid.cached(opts.frequencyGridDir, fmin, fmax, df,
+                                 freqs_to_remove=freqs_to_remove)
+    print('Number of frequencies: %d (%d after alias removal)' % (len(freqs.freqs), len(freqs.masked)))
+
+    periodic_stats_algorithms = {}
+    for algorithm in algorithms:    
+        lightcurves_algorithm = lightcurves
+        if opts.doGPU and (algorithm == "PDM"):
+            from cuvarbase.utils import weights
+            lightcurves_algorithm = []
+            for lightcurve in lightcurves:
+                t, y, dy = lightcurve
+                lightcurves_algorithm.append((t, y, weights(np.ones(dy.shape)), freqs.masked))
+
+        if opts.doNotPeriodFind:
+            periods_best = np.ones((len(lightcurves),1))
+            significances = np.ones((len(lightcurves),1))
+            pdots = np.ones((len(lightcurves),1))
+        else:
+            print('Analyzing %d lightcurves...' % len(lightcurves))
+            start_time = time.time()
+            period_kwargs = {"doGPU": opts.doGPU,
+                             "doCPU": opts.doCPU,
+                             "doSaveMemory": opts.doSaveMemory,
+                             "doRemoveTerrestrial": opts.doRemoveTerrestrial,
+                             "freqs_to_remove": freqs_to_remove,
+                             "doUsePDot": opts.doUsePDot,
+                             "doSingleTimeSegment": opts.doSingleTimeSegment,
+                             "doParallel": opts.doParallel,
+                             "Ncore": opts.Ncore}
+            # the GPU PDM light curves carry the job grid themselves
+            if opts.doBaselineBins and not (opts.doGPU and (algorithm == "PDM")):
+                periods_best, significances, pdots = find_periods_baseline_bins(algorithm,
+                                                                                lightcurves_algorithm,
+                                                                                fmin, fmax,
+                                                                                samples_per_peak=samples_per_peak,
+                                                                                baseline_ratio=opts.baseline_ratio,
+                                                                                frequencyGridDir=opts.frequencyGridDir,
+                                                                                **period_kwargs)
+            else:
+                periods_best, significances, pdots = find_periods(algorithm,
+                                                                  lightcurves_algorithm,
+                                                                  freqs,
+                                                                  **period_kwargs)
+            end_time = time.time()
+            print('Lightcurve analysis took %.2f seconds' % (end_time - start_time))
+
+        print('Running lightcurve stats...')
         start_time = time.time()
-        periods_best, significances, pdots = find_periods(algorithm,
-                                                          lightcurves, 
-                                                          freqs, 
-                                                          doGPU=opts.doGPU,
-                                                          doCPU=opts.doCPU,
-                                                          doSaveMemory=opts.doSaveMemory,
-                                                          doRemoveTerrestrial=opts.doRemoveTerrestrial,
-                                                          freqs_to_remove=freqs_to_remove,
-                                                          doUsePDot=opts.doUsePDot,
-                                                          doSingleTimeSegment=opts.doSingleTimeSegment,
-                                                          doParallel=opts.doParallel,
-                                                          Ncore=opts.Ncore)
+
+        if opts.doParallel:
+            periodic_stats = np.vstack(map_batch(calc_fourier_stats,
+                                                 lightcurves,
+                                                 args=[periods_best],
+                                                 Ncore=opts.Ncore))
+        else:
+            periodic_stats = calc_fourier_stats(lightcurves, periods_best)
         end_time = time.time()
-        print('Lightcurve analysis took %.2f seconds' % (end_time - start_time))
-    
-    print('Running lightcurve stats...')
-    start_time = time.time()
+        print('Lightcurve statistics took %.2f seconds' % (end_time - start_time))
 
-    if opts.doParallel:
-        from joblib import Parallel, delayed
-        periodic_stats = Parallel(n_jobs=opts.Ncore)(delayed(calc_fourier_stats)(LC[0],LC[1],LC[2],p) for LC,p in zip(lightcurves,periods_best))
-    else:
-        periodic_stats = []
-        for ii,data in enumerate(lightcurves):
-            period = periods_best[ii]
-            if np.mod(ii,100) == 0:
-                print("%d/%d"%(ii,len(lightcurves)))
-            copy = np.ma.copy(data).T
-            t, mag, magerr = copy[:,0], copy[:,1], copy[:,2]
-
-            periodic_stat = calc_fourier_stats(t, mag, magerr, period)
-            periodic_stats.append(periodic_stat)
-    end_time = time.time()
-    print('Lightcurve statistics took %.2f seconds' % (end_time - start_time))
-    
-    if not opts.sigthresh is None:
-        sigthresh = opts.sigthresh
-    else:
-        if opts.doVariability:
-            sigthresh = 0.15
+        if not opts.sigthresh is None:
+            sigthresh = opts.sigthresh
         else:
-            if algorithm == "LS":
-                sigthresh = 1e6
-            elif algorithm == "FFT":
-                sigthresh = 0
-            elif algorithm == "GCE":
-                sigthresh = 7
-            elif algorithm == "GCE_LS_AOV":
-                sigthresh = 10
-            elif algorithm == "ECE":
-                sigthresh = 6
-            elif algorithm == "EAOV":
-                sigthresh = 15
-            elif algorithm == "ELS":
-                sigthresh = 15
+            if opts.doVariability:
+                sigthresh = 0.15
             else:
-                sigthresh = 7
-    
-    if opts.doSpectra:
-        lamostpage = "http://dr5.lamost.org/spectrum/png/"
-        lamostfits = "http://dr5.lamost.org/spectrum/fits/"
-    
-        LAMOSTcat = os.path.join(starCatalogDir,'lamost.hdf5')
-        with h5py.File(LAMOSTcat, 'r') as f:
-            lamost_ra, lamost_dec = f['ra'][:], f['dec'][:]
-        LAMOSTidxcat = os.path.join(starCatalogDir,'lamost_indices.hdf5')
-        with h5py.File(LAMOSTidxcat, 'r') as f:
-            lamost_obsid = f['obsid'][:]
-            lamost_inverse = f['inverse'][:]
-    
-        lamost = SkyCoord(ra=lamost_ra*u.degree, dec=lamost_dec*u.degree, frame='icrs')    
-    
-    print('Cataloging / Plotting lightcurves...')
-    if opts.doSpectra:
-        data_out = {}
-    
-    str_stats = np.empty((0,2))
-    data_stats = np.empty((0,25))
-    data_periodic_stats = np.empty((0,18))
-    
-    if baseline<10:
-        basefolder = os.path.join(outputDir,'%sHC'%algorithm)
-    else:
-        basefolder = os.path.join(outputDir,'%s'%algorithm)
-    if (opts.source_type == "catalog") and ("fermi" in catalog_file):
-        basefolder = os.path.join(basefolder,'%d' % Ncatindex)
-    
-    cnt = 0
-    fid = open(catalogFile,'w')
-    for lightcurve, filt, objid, name, coordinate, absmag, bp_rp, period, significance, pdot in zip(lightcurves,filters,ids,names,coordinates,absmags,bp_rps,periods_best,significances,pdots):
-        filt_str = "_".join([str(x) for x in filt])
-    
-        str_stats = np.append(str_stats,
-                              np.array([[np.string_(name),
-                                         np.string_(filt_str)]]), axis=0)
-                                        
-        data_stats = np.append(data_stats,
-                               np.array([[objid, coordinate[0],
-                                          coordinate[1],
-                                          stats[cnt][0], stats[cnt][1],
-                                          stats[cnt][2], stats[cnt][3],
-                                          stats[cnt][4], stats[cnt][5],
-                                          stats[cnt][6], stats[cnt][7],
-                                          stats[cnt][8], stats[cnt][9],
-                                          stats[cnt][10], stats[cnt][11],
-                                          stats[cnt][12], stats[cnt][13],
-                                          stats[cnt][14], stats[cnt][15],
-                                          stats[cnt][16], stats[cnt][17],
-                                          stats[cnt][18], stats[cnt][19],
-                                          stats[cnt][20], stats[cnt][21]]]),
-                               axis=0)
-
-        data_periodic_stats = np.append(data_periodic_stats,
-                               np.array([[objid,
-                                          period, significance,
-                                          pdot,
-                                          periodic_stats[cnt][0], periodic_stats[cnt][1],
-                                          periodic_stats[cnt][2], periodic_stats[cnt][3],
-                                          periodic_stats[cnt][4], periodic_stats[cnt][5],
-                                          periodic_stats[cnt][6], periodic_stats[cnt][7],
-                                          periodic_stats[cnt][8], periodic_stats[cnt][9],
-                                          periodic_stats[cnt][10], periodic_stats[cnt][11],
-                                          periodic_stats[cnt][12], periodic_stats[cnt][13]]]),
-                               axis=0)
-    
-        if opts.doPlots and ((period/(1.0/fmax)) <= 1.05):
-            print("%d %.5f %.5f %d: Period is within 5 per." % (objid, coordinate[0], coordinate[1], stats[cnt][0]))
-    
-        if opts.doVariability:
-            significance = stats[cnt][9]        
-    
+                if algorithm == "LS":
+                    sigthresh = 1e6
+                elif algorithm == "FFT":
+                    sigthresh = 0
+                elif algorithm == "GCE":
+                    sigthresh = 7
+                elif algorithm == "GCE_LS_AOV":
+                    sigthresh = 10
+                elif algorithm == "ECE":
+                    sigthresh = 6
+                elif algorithm == "EAOV":
+                    sigthresh = 15
+                elif algorithm == "ELS":
+                    sigthresh = 15
+                else:
+                    sigthresh = 7
+
         if opts.doSpectra:
-            data_out[name] = {}
-            data_out[name]["name"] = name
-            data_out[name]["objid"] = objid
-            data_out[name]["RA"] = coordinate[0]
-            data_out[name]["Dec"] = coordinate[1]
-            data_out[name]["period"] = period
-            data_out[name]["significance"] = significance
-            data_out[name]["pdot"] = pdot
-            data_out[name]["filt"] = filt
-            data_out[name]["stats"] = stats[cnt]
- 
-        if opts.doPlots and (significance>sigthresh):
-            if opts.doHCOnly and np.isclose(period, 1.0/fmin, rtol=1e-2):
-                print("Vetoing... period is 1/fmax")
-                continue
-    
-            RA, Dec = coordinate
-            if opts.doObjIDFilenames:
-                figfile = "%d.png" % objid
-            else:
-                figfile = "%.10f_%.10f_%.10f_%.10f_%s.png"%(significance, RA, Dec,
-                                                          period, "".join(filt_str))
-    
-                if opts.doNotPeriodFind:
-                    thisfolder = 'noperiod'
+            lamostpage = "http://dr5.lamost.org/spectrum/png/"
+            lamostfits = "http://dr5.lamost.org/spectrum/fits/"
+
+            LAMOSTcat = os.path.join(starCatalogDir,'lamost.hdf5')
+            with h5py.File(LAMOSTcat, 'r') as f:
+                lamost_ra, lamost_dec = f['ra'][:], f['dec'][:]
+            LAMOSTidxcat = os.path.join(starCatalogDir,'lamost_indices.hdf5')
+            with h5py.File(LAMOSTidxcat, 'r') as f:
+                lamost_obsid = f['obsid'][:]
+                lamost_inverse = f['inverse'][:]
+
+            lamost = SkyCoord(ra=lamost_ra*u.degree, dec=lamost_dec*u.degree, frame='icrs')    
+
+        print('Cataloging / Plotting lightcurves...')
+        nobjects = len(lightcurves)
+        filt_strs = ["_".join([str(x) for x in filt_obj]) for filt_obj in filters]
+        str_stats = np.array([[np.bytes_(name), np.bytes_(filt_str)]
+                              for name, filt_str in zip(names, filt_strs)])
+
+        data_stats = np.empty((nobjects,25))
+        data_stats[:,0] = ids
+        data_stats[:,1] = lightcurves.ra
+        data_stats[:,2] = lightcurves.dec
+        data_stats[:,3:] = np.reshape(stats, (nobjects,22))
+
+        data_periodic_stats = np.empty((nobjects,18))
+        data_periodic_stats[:,0] = ids
+        data_periodic_stats[:,1] = np.reshape(periods_best, nobjects)
+        data_periodic_stats[:,2] = np.reshape(significances, nobjects)
+        data_periodic_stats[:,3] = np.reshape(pdots, nobjects)
+        data_periodic_stats[:,4:] = np.reshape(periodic_stats, (nobjects,14))
+
+        if baseline<10:
+            basefolder = os.path.join(outputDir,'%sHC'%algorithm)
+        else:
+            basefolder = os.path.join(outputDir,'%s'%algorithm)
+        if (opts.source_type == "catalog") and ("fermi" in catalog_file):
+            basefolder = os.path.join(basefolder,'%d' % Ncatindex)
+
+        for cnt, (lightcurve, filt_obj, filt_str, objid, name, coordinate, absmag, bp_rp, period, significance, pdot) in enumerate(zip(lightcurves,filters,filt_strs,ids,names,coordinates,absmags,bp_rps,periods_best,significances,pdots)):
+
+            if opts.doPlots and ((period/(1.0/fmax)) <= 1.05):
+                print("%d %.5f %.5f %d: Period is within 5 per." % (objid, coordinate[0], coordinate[1], stats[cnt][0]))
+
+            if opts.doVariability:
+                significance = stats[cnt][9]        
+
+            if opts.doSpectra:
+                data_out[name] = {}
+                data_out[name]["name"] = name
+                data_out[name]["objid"] = objid
+                data_out[name]["RA"] = coordinate[0]
+                data_out[name]["Dec"] = coordinate[1]
+                data_out[name]["period"] = period
+                data_out[name]["significance"] = significance
+                data_out[name]["pdot"] = pdot
+                data_out[name]["filt"] = filt_obj
+                data_out[name]["stats"] = stats[cnt]
+
+            if opts.doPlots and (significance>sigthresh):
+                if opts.doHCOnly and np.isclose(period, 1.0/fmin, rtol=1e-2):
+                    print("Vetoing... period is 1/fmax")
+                    continue
+
+                RA, Dec = coordinate
+                if opts.doObjIDFilenames:
+                    figfile = "%d.png" % objid
+                else:
+                    figfile = "%.10f_%.10f_%.10f_%.10f_%s.png"%(significance, RA, Dec,
+                                                              period, "".join(filt_str))
+
+                    if opts.doNotPeriodFind:
+                        thisfolder = 'noperiod'
+                    else:
+                        idx = np.where((period>=period_ranges[:-1]) & (period<=period_ranges[1:]))[0][0]
+                        thisfolder = folders[idx.astype(int)]
+                        if thisfolder == None:
+                            continue
+
+                if opts.doGPU and (algorithm == "PDM"):
+                    copy = np.ma.copy((lightcurve[0],lightcurve[1],lightcurve[2])).T
                 else:
-                    idx = np.where((period>=period_ranges[:-1]) & (period<=period_ranges[1:]))[0][0]
-                    thisfolder = folders[idx.astype(int)]
-                    if thisfolder == None:
+                    copy = np.ma.copy(lightcurve).T
+
+                if opts.doObjIDFilenames:
+                    objid_str = str(objid)
+                    folder = os.path.join(basefolder, objid_str[2], objid_str[3])
+                else:
+                    nepoch = np.array(len(copy[:,0]))
+                    idx2 = np.where((nepoch>=epoch_ranges[:-1]) & (nepoch<=epoch_ranges[1:]))[0][0]
+                    if epoch_folders[idx2.astype(int)] == None:
                         continue
-    
-            if opts.doGPU and (algorithm == "PDM"):
-                copy = np.ma.copy((lightcurve[0],lightcurve[1],lightcurve[2])).T
-            else:
-                copy = np.ma.copy(lightcurve).T
-    
-            if opts.doObjIDFilenames:
-                objid_str = str(objid)
-                folder = os.path.join(basefolder, objid_str[2], objid_str[3])
-            else:
-                nepoch = np.array(len(copy[:,0]))
-                idx2 = np.where((nepoch>=epoch_ranges[:-1]) & (nepoch<=epoch_ranges[1:]))[0][0]
-                if epoch_folders[idx2.astype(int)] == None:
-                    continue
-    
-                folder = os.path.join(basefolder,thisfolder,epoch_folders[idx2.astype(int)])
-            if not os.path.isdir(folder):
-                os.makedirs(folder)
-            pngfile = os.path.join(folder,figfile)
-    
-            if opts.doVariability:
-                phases = copy[:,0]
-            else:
-                if pdot == 0:
-                    phases = np.mod(copy[:,0],2*period)/(2*period)
+
+                    folder = os.path.join(basefolder,thisfolder,epoch_folders[idx2.astype(int)])
+                if not os.path.isdir(folder):
+                    os.makedirs(folder)
+                pngfile = os.path.join(folder,figfile)
+
+                if opts.doVariability:
+                    phases = copy[:,0]
                 else:
-                    time_vals = copy[:,0] - np.min(copy[:,0])
-                    phases=np.mod((time_vals-(1.0/2.0)*(pdot/period)*(time_vals)**2),2*period)/(2*period)
-            magnitude, err = copy[:,1], copy[:,2]
-    
-            spectral_data = {}
-            if opts.doSpectra:
-                coord = SkyCoord(ra=RA*u.degree, dec=Dec*u.degree, frame='icrs')
-                try:
-                    xid = SDSS.query_region(coord, spectro=True)
-                except:
-                    xid = None
-                if not xid is None:
+                    if pdot == 0:
+                        phases = np.mod(copy[:,0],2*period)/(2*period)
+                    else:
+                        time_vals = copy[:,0] - np.min(copy[:,0])
+                        phases=np.mod((time_vals-(1.0/2.0)*(pdot/period)*(time_vals)**2),2*period)/(2*period)
+                magnitude, err = copy[:,1], copy[:,2]
+
+                spectral_data = {}
+                if opts.doSpectra:
+                    coord = SkyCoord(ra=RA*u.degree, dec=Dec*u.degree, frame='icrs')
                     try:
-                        spec = SDSS.get_spectra(matches=xid)[0]
+                        xid = sdss.SDSS.query_region(coord, spectro=True)
                     except:
-                        spec = []
-                        pass
-                    for ii, sp in enumerate(spec):
+                        xid = None
+                    if not xid is None:
                         try:
-                            sp.data["loglam"]
+                            spec = sdss.SDSS.get_spectra(matches=xid)[0]
                         except:
-                            continue
-                        lam = 10**sp.data["loglam"]
-                        flux = sp.data["flux"]
-                        key = len(list(spectral_data.keys()))
-                        spectral_data[key] = {}
-                        spectral_data[key]["lambda"] = lam
-                        spectral_data[key]["flux"] = flux            
-    
-                sep = coord.separation(lamost).deg
-                idx = np.argmin(sep)
-                if sep[idx] < 3.0/3600.0:
-                    idy = np.where(idx == lamost_inverse)[0]
-                    obsids = lamost_obsid[idy]
-                    for obsid in obsids:
-                        requestpage = "%s/%d" % (lamostfits, obsid)
-     
-                        with tempfile.NamedTemporaryFile(mode='w') as f:
-                            wget_command = "wget %s -O %s" % (requestpage, f.name)
-                            os.system(wget_command)
-                            hdul = astropy.io.fits.open(f.name)
-            
-                        for ii, sp in enumerate(hdul):
-                            lam = sp.data[2,:]
-                            flux = sp.data[0,:]
+                            spec = []
+                            pass
+                        for ii, sp in enumerate(spec):
+                            try:
+                                sp.data["loglam"]
+                            except:
+                                continue
+                            lam = 10**sp.data["loglam"]
+                            flux = sp.data["flux"]
                             key = len(list(spectral_data.keys()))
                             spectral_data[key] = {}
                             spectral_data[key]["lambda"] = lam
-                            spectral_data[key]["flux"] = flux
-    
-            if len(spectral_data.keys()) > 0:
-                #fig, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(25,10))
-                fig = plt.figure(figsize=(25,10))
-                gs = fig.add_gridspec(nrows=3, ncols=6)
-                ax1 = fig.add_subplot(gs[:, 0:2])
-                ax2 = fig.add_subplot(gs[:, 2:4])
-                #ax3 = fig.add_subplot(gs[0, 2])
-            else:
-                fig, (ax1, ax2) = plt.subplots(1, 2,figsize=(20,10))
-            ax1.errorbar(phases, magnitude,err,ls='none',c='k')
-            period2=period
-            ymed = np.nanmedian(magnitude)
-            y10, y90 = np.nanpercentile(magnitude,10), np.nanpercentile(magnitude,90)
-            ystd = np.nanmedian(err)
-            ymin = y10 - 7*ystd
-            ymax = y90 + 7*ystd
-            ax1.set_ylim([ymin,ymax])
-            ax1.invert_yaxis()
-            asymmetric_error = np.atleast_2d([absmag[1], absmag[2]]).T
-            hist2 = ax2.hist2d(bprpWD,absmagWD, bins=100,zorder=0,norm=LogNorm())
-            print(bp_rp)
-            if not np.isnan(bp_rp[0]) or not np.isnan(absmag[0]):
-                ax2.errorbar(bp_rp[0],absmag[0],yerr=asymmetric_error,
-                             c='r',zorder=1,fmt='o')
-            ax2.set_xlim([-1,4.0])
-            ax2.set_ylim([-5,18])
-            ax2.invert_yaxis()
-            fig.colorbar(hist2[3],ax=ax2)
-            nspec = len(spectral_data.keys())
-            npairs = 0
-            if nspec > 1:
-                bands = [[4750.0, 4950.0], [6475.0, 6650.0], [8450, 8700]]
-                npairs = int(nspec * (nspec-1)/2)
-                v_values = np.zeros((len(bands), npairs))
-                v_values_unc = np.zeros((len(bands), npairs))
-                data_out[name]["spectra"] = {}
-                for jj, band in enumerate(bands):
-                    data_out[name]["spectra"][jj] = np.empty((0,3))
-    
-                    ax = fig.add_subplot(gs[jj, 4])
-                    ax_ = fig.add_subplot(gs[jj, 5])
-                    xmin, xmax = band[0], band[1]
-                    ymin, ymax = np.inf, -np.inf
-                    for key in spectral_data:
-                        idx = np.where( (spectral_data[key]["lambda"] >= xmin) &
-                                        (spectral_data[key]["lambda"] <= xmax))[0]
-                        wave = spectral_data[key]["lambda"][idx]
-                        myflux = spectral_data[key]["flux"][idx]
-                        # quick-and-dirty normalization
-                        myflux -= np.median(myflux)
-                        if len(myflux) == 0: continue
-                        myflux /= np.max(np.abs(myflux))
-                        y1 = np.nanpercentile(myflux,1)
-                        y99 = np.nanpercentile(myflux,99)
-                        ydiff = y99 - y1
-                        ymintmp = y1 - ydiff
-                        ymaxtmp = y99 + ydiff
-                        if ymin > ymintmp:
-                            ymin = ymintmp
-                        if ymaxtmp > ymax:
-                            ymax = ymaxtmp
-                        ax.plot(wave, myflux, '--')
-                    correlation_funcs = correlate_spec(spectral_data, band = band)
-                    # cross correlation
-                    if correlation_funcs == {}:
-                        pass
+                            spectral_data[key]["flux"] = flux            
+
+                    sep = coord.separation(lamost).deg
+                    idx = np.argmin(sep)
+                    if sep[idx] < 3.0/3600.0:
+                        idy = np.where(idx == lamost_inverse)[0]
+                        obsids = lamost_obsid[idy]
+                        for obsid in obsids:
+                            requestpage = "%s/%d" % (lamostfits, obsid)
+
+                            with tempfile.NamedTemporaryFile(mode='w') as f:
+                                wget_command = "wget %s -O %s" % (requestpage, f.name)
+                                os.system(wget_command)
+                                hdul = fits.open(f.name)
+
+                            for ii, sp in enumerate(hdul):
+                                lam = sp.data[2,:]
+                                flux = sp.data[0,:]
+                                key = len(list(spectral_data.keys()))
+                                spectral_data[key] = {}
+                                spectral_data[key]["lambda"] = lam
+                                spectral_data[key]["flux"] = flux
+
+                if len(spectral_data.keys()) > 0:
+                    #fig, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(25,10))
+                    fig = plt.figure(figsize=(25,10))
+                    gs = fig.add_gridspec(nrows=3, ncols=6)
+                    ax1 = fig.add_subplot(gs[:, 0:2])
+                    ax2 = fig.add_subplot(gs[:, 2:4])
+                    #ax3 = fig.add_subplot(gs[0, 2])
+                else:
+                    fig, (ax1, ax2) = plt.subplots(1, 2,figsize=(20,10))
+                ax1.errorbar(phases, magnitude,err,ls='none',c='k')
+                period2=period
+                ymed = np.nanmedian(magnitude)
+                y10, y90 = np.nanpercentile(magnitude,10), np.nanpercentile(magnitude,90)
+                ystd = np.nanmedian(err)
+                ymin = y10 - 7*ystd
+                ymax = y90 + 7*ystd
+                ax1.set_ylim([ymin,ymax])
+                ax1.invert_yaxis()
+                asymmetric_error = np.atleast_2d([absmag[1], absmag[2]]).T
+                hist2 = ax2.hist2d(bprpWD,absmagWD, bins=100,zorder=0,norm=LogNorm())
+                print(bp_rp)
+                if not np.isnan(bp_rp[0]) or not np.isnan(absmag[0]):
+                    ax2.errorbar(bp_rp[0],absmag[0],yerr=asymmetric_error,
+                                 c='r',zorder=1,fmt='o')
+                ax2.set_xlim([-1,4.0])
+                ax2.set_ylim([-5,18])
+                ax2.invert_yaxis()
+                fig.colorbar(hist2[3],ax=ax2)
+                nspec = len(spectral_data.keys())
+                npairs = 0
+                if nspec > 1:
+                    bands = [[4750.0, 4950.0], [6475.0, 6650.0], [8450, 8700]]
+                    npairs = int(nspec * (nspec-1)/2)
+                    v_values = np.zeros((len(bands), npairs))
+                    v_values_unc = np.zeros((len(bands), npairs))
+                    data_out[name]["spectra"] = {}
+                    for jj, band in enumerate(bands):
+                        data_out[name]["spectra"][jj] = np.empty((0,3))
+
+                        ax = fig.add_subplot(gs[jj, 4])
+                        ax_ = fig.add_subplot(gs[jj, 5])
+                        xmin, xmax = band[0], band[1]
+                        ymin, ymax = np.inf, -np.inf
+                        for key in spectral_data:
+                            idx = np.where( (spectral_data[key]["lambda"] >= xmin) &
+                                            (spectral_data[key]["lambda"] <= xmax))[0]
+                            wave = spectral_data[key]["lambda"][idx]
+                            myflux = spectral_data[key]["flux"][idx]
+                            # quick-and-dirty normalization
+                            myflux -= np.median(myflux)
+                            if len(myflux) == 0: continue
+                            myflux /= np.max(np.abs(myflux))
+                            y1 = np.nanpercentile(myflux,1)
+                            y99 = np.nanpercentile(myflux,99)
+                            ydiff = y99 - y1
+                            ymintmp = y1 - ydiff
+                            ymaxtmp = y99 + ydiff
+                            if ymin > ymintmp:
+                                ymin = ymintmp
+                            if ymaxtmp > ymax:
+                                ymax = ymaxtmp
+                            ax.plot(wave, myflux, '--')
+                        correlation_funcs = specfunc.correlate_spec(spectral_data, band = band)
+                        # cross correlation
+                        if correlation_funcs == {}:
+                            pass
+                        else:
+                            if len(correlation_funcs) == 1:
+                                yheights = [0.5]
+                            else:
+                                yheights = np.linspace(0.25,0.75,len(correlation_funcs))
+                            for kk, key in enumerate(correlation_funcs):
+                                if not 'v_peak' in correlation_funcs[key]:
+                                    continue
+                                vpeak = correlation_funcs[key]['v_peak']
+                                vpeak_unc = correlation_funcs[key]['v_peak_unc']
+                                Cpeak = correlation_funcs[key]['C_peak']
+                                ax_.plot(correlation_funcs[key]["velocity"], correlation_funcs[key]["correlation"])
+                                ax_.plot([vpeak, vpeak], [0, Cpeak], 'k--')
+                                ax_.text(250, yheights[kk], "v=%.0f +- %.0f"%(vpeak, vpeak_unc))
+                                v_values[jj][kk] = vpeak
+                                v_values_unc[jj][kk] = vpeak_unc
+                                data_out[name]["spectra"][jj] = np.vstack((data_out[name]["spectra"][jj], [vpeak, vpeak_unc, Cpeak]))
+
+                        if np.isfinite(ymin) and np.isfinite(ymax):
+                            ax.set_ylim([ymin,ymax])
+                        ax.set_xlim([xmin,xmax])
+                        ax_.set_ylim([0,1])
+                        ax_.set_xlim([-1000,1000])
+                        if jj == len(bands)-1:
+                            ax.set_xlabel('Wavelength [A]')
+                            ax_.set_xlabel('Velocity [km/s]')
+                            specfunc.adjust_subplots_band(ax, ax_)
+                        else:
+                            ax_.set_xticklabels([])
+                        if jj==1:
+                            new_tick_locations = np.array([-1000, -500, 0, 500, 1000])
+                            axmass = ax_.twiny()
+                            axmass.set_xlim(ax_.get_xlim())
+                            axmass.set_xticks(new_tick_locations)
+                            tick_labels = specfunc.tick_function(new_tick_locations, period)
+                            tick_labels = ["{0:.0f}".format(float(x)) for x in tick_labels]
+                            axmass.set_xticklabels(tick_labels)
+                            axmass.set_xlabel("f($M$) ("+r'$M_\odot$'+')')
+                if npairs > 0:
+                    # calculate mass functon
+                    if npairs==1:
+                        id_pair = 0
                     else:
-                        if len(correlation_funcs) == 1:
-                            yheights = [0.5]
+                        # select a pair with:
+                        # (1) reasonable variance among all band measurements
+                        stds = np.std(v_values, axis=0)
+                        if np.sum(stds<50)>=1:
+                            v_values = v_values[:, stds<50]
+                            v_values_unc = v_values_unc[:, stds<50]
+                        # (2) largest (absolute) velosity variation
+                        vsums = np.sum(abs(v_values), axis=0)
+                        id_pair = np.where(vsums == max(vsums))[0][0]
+                    v_adopt = np.median(v_values[:,id_pair])
+                    id_band = np.where(v_values[:,id_pair]==v_adopt)[0][0]
+                    v_adopt_unc = v_values_unc[id_band,id_pair]
+                    K = abs(v_adopt/2.) # [km/s] assuming that the velocity variation is max and min in rv curve
+                    K_unc = abs(v_adopt_unc/2.) # [km/s]
+                    P = 2*period # [day] if ellipsodial modulation, amplitude are roughly the same, 
+                                # then the photometric period is probably half of the orbital period
+                    fmass = (K * 100000)**3 * (P*86400) / (2*np.pi*const.G.cgs.value) / const.M_sun.cgs.value
+                    fmass_unc = 3 * fmass / K * K_unc
+                    data_out[name]["fmass"] = fmass
+                    data_out[name]["fmass_unc"] = fmass_unc
+                if pdot == 0:
+                    plt.suptitle(str(period2)+"_"+str(RA)+"_"+str(Dec))
+                else:
+                    plt.suptitle(str(period2)+"_"+str(RA)+"_"+str(Dec)+"_"+str(pdot))
+                fig.savefig(pngfile, bbox_inches='tight')
+                plt.close()
+
+        periodic_stats_algorithms[algorithm] = data_periodic_stats
+
+    return str_stats, data_stats, periodic_stats_algorithms, brutus_out
+
+
+def parse_task(task):
+    """(field, ccd, quadrant, Ncatindex, Ncatalog, catalog_file, matchFile)
+    of a queue file line, in the format of the quadrant files"""
+
+    if opts.lightcurve_source == "Kowalski":
+        task_catalog_file = catalog_file
+        if len(task) > 6:
+            task_catalog_file = task[6]
+        return (int(task[1]), int(task[2]), int(task[3]),
+                int(task[4]), int(task[5]), task_catalog_file, matchFile)
+    else:
+        return (field, ccd, quadrant, int(task[2]), Ncatalog,
+                catalog_file, task[1])
+
+
+def queue_tasks(queue_file, queue_wait=0.0):
+    """Pop tasks from the queue file until it has been empty for
+    queue_wait seconds"""
+
+    last_task = time.time()
+    while True:
+        task = pop_task(queue_file)
+        if task is None:
+            if time.time() - last_task > queue_wait:
+                return
+            time.sleep(min(queue_wait, 10.0))
+            continue
+        last_task = time.time()
+        yield parse_task(task)
+
+
+if opts.doWorker:
+    # everything above is set up once, and the worker then runs the
+    # tasks of the queue file one after the other
+    tasks = queue_tasks(opts.queue_file, queue_wait=opts.queue_wait)
+else:
+    tasks = [(field, ccd, quadrant, Ncatindex, Ncatalog, catalog_file,
+              matchFile)]
+
+for task in tasks:
+    field, ccd, quadrant, Ncatindex, Ncatalog, catalog_file, matchFile = task
+    if opts.doWorker:
+        print('Running task %s' % (" ".join([str(x) for x in task])))
+
+    catalogDir = catalogBaseDir
+    if (opts.source_type == "catalog") and ("fermi" in catalog_file):
+        catalogDir = os.path.join(catalogDir,'%d' % Ncatindex)
+    if not os.path.isdir(catalogDir):
+        os.makedirs(catalogDir)
+
+    if opts.doSpectra:
+        spectraDir = spectraBaseDir
+        if (opts.source_type == "spectra") and ("fermi" in spectra_file):
+            spectraDir = os.path.join(spectraDir,'%d' % Ncatindex)
+        if not os.path.isdir(spectraDir):
+            os.makedirs(spectraDir)
+
+    if opts.doBrutus:
+        brutusDir = os.path.join(outputDir,'brutus', "%d_%d_%d_%d"%(field, ccd, quadrant, Ncatindex))
+        if not os.path.isdir(brutusDir):
+            os.makedirs(brutusDir)
+
+    nchunks = 1
+    stream_baseline = None
+    fil = 'all'
+    data_out = {}
+
+    print('Organizing lightcurves...')
+    if opts.lightcurve_source == "Kowalski":
+
+        catalogFile = os.path.join(catalogDir,"%d_%d_%d.h5"%(field, ccd, quadrant))
+        if opts.doSpectra:
+            spectraFile = os.path.join(spectraDir,"%d_%d_%d.pkl"%(field, ccd, quadrant))
+
+        if opts.source_type == "quadrant":
+            catalogFile = os.path.join(catalogDir,"%d_%d_%d_%d.h5"%(field, ccd, quadrant,Ncatindex))
+            if opts.doSpectra:
+                spectraFile = os.path.join(spectraDir,"%d_%d_%d_%d.pkl"%(field, ccd, quadrant,Ncatindex))
+
+            # doHCOnly subtracts the median high-cadence trend of the batch,
+            # so it always runs on the whole job
+            if opts.doStreaming and not doHCOnly:
+                qu = {"query_type":"general_search","query":"db['ZTF_sources_20200401'].count_documents({'field':%d,'ccd':%d,'quad':%d})"%(field,ccd,quadrant)}
+                r = cached_query(kow, qu, cache=cache, nquery = 10)
+                if "data" in r:
+                    nsources = np.ceil(r["data"]/Ncatalog)
+                    nchunks = max(int(np.ceil(nsources/opts.chunk_size)), 1)
+
+            boundaries = quadrant_boundaries.get("%d_%d_%d" % (field, ccd,
+                                                               quadrant))
+            if (boundaries is not None) and (len(boundaries) != Ncatalog+1):
+                boundaries = None
+
+            # the _id ranges of the chunks are looked up once for the job
+            sub_boundaries = None
+            if nchunks > 1:
+                sub_boundaries = get_kowalski_sub_boundaries(field, ccd,
+                                      quadrant, kow,
+                                      num_batches=Ncatalog, nb=Ncatindex,
+                                      num_sub_batches=nchunks,
+                                      id_boundaries=boundaries,
+                                      cache=cache)
+
+            if (nchunks > 1) and (opts.baseline is None) and \
+               not opts.doChunkBaselines:
+                id_start, id_end = None, None
+                if sub_boundaries is not None:
+                    id_start, id_end = sub_boundaries[0], sub_boundaries[-1]
+                stream_baseline = get_kowalski_baseline(field, ccd, quadrant,
+                                      kow, program_ids=program_ids,
+                                      min_epochs=min_epochs,
+                                      id_start=id_start, id_end=id_end,
+                                      cache=cache)
+
+            def load_lightcurves(ichunk):
+                return make_batch(*get_kowalski_bulk(field, ccd, quadrant, kow,
+                                      program_ids=program_ids, min_epochs=min_epochs,
+                                      num_batches=Ncatalog, nb=Ncatindex,
+                                      num_sub_batches=nchunks, sub_nb=ichunk,
+                                      doRemoveHC=doRemoveHC, doHCOnly=doHCOnly,
+                                      doSigmaClipping=doSigmaClipping,
+                                      sigmathresh=sigmathresh,
+                                      doPercentile=doPercentile,
+                                      percmin = percmin, percmax = percmax,
+                                      id_boundaries=boundaries,
+                                      sub_boundaries=sub_boundaries,
+                                      cache=cache),
+                                  doRemoveBrightStars=opts.doRemoveBrightStars)
+
+        elif opts.source_type == "catalog":
+
+            amaj, amin, phi = None, None, None
+            if not opts.default_err is None:
+                default_err = opts.default_err
+            else:
+                if doCombineFilt:
+                    default_err = 3.0
+                else:
+                    default_err = 5.0
+
+            if ".dat" in catalog_file:
+                lines = [line.rstrip('\n') for line in open(catalog_file)]
+                names, ras, decs, errs = [], [], [], []
+                if ("fermi" in catalog_file):
+                    amaj, amin, phi = [], [], []
+                for line in lines:
+                    lineSplit = list(filter(None,line.split(" ")))
+                    if ("blue" in catalog_file) or ("uvex" in catalog_file) or ("xraybinary" in catalog_file) or ("lamost_mira" in catalog_file) or ("rotators" in catalog_file) or ("ap" in catalog_file):
+                        ra_hex, dec_hex = convert_to_hex(float(lineSplit[0])*24/360.0,delimiter=''), convert_to_hex(float(lineSplit[1]),delimiter='')
+                        if dec_hex[0] == "-":
+                            objname = "ZTFJ%s%s"%(ra_hex[:4],dec_hex[:5])
                         else:
-                            yheights = np.linspace(0.25,0.75,len(correlation_funcs))
-                        for kk, key in enumerate(correlation_funcs):
-                            if not 'v_peak' in correlation_funcs[key]:
-                                continue
-                            vpeak = correlation_funcs[key]['v_peak']
-                            vpeak_unc = correlation_funcs[key]['v_peak_unc']
-                            Cpeak = correlation_funcs[key]['C_peak']
-                            ax_.plot(correlation_funcs[key]["velocity"], correlation_funcs[key]["correlation"])
-                            ax_.plot([vpeak, vpeak], [0, Cpeak], 'k--')
-                            ax_.text(250, yheights[kk], "v=%.0f +- %.0f"%(vpeak, vpeak_unc))
-                            v_values[jj][kk] = vpeak
-                            v_values_unc[jj][kk] = vpeak_unc
-                            data_out[name]["spectra"][jj] = np.vstack((data_out[name]["spectra"][jj], [vpeak, vpeak_unc, Cpeak]))
+                            objname = "ZTFJ%s%s"%(ra_hex[:4],dec_hex[:4])
+                        names.append(objname)
+                        ras.append(float(lineSplit[0]))
+                        decs.append(float(lineSplit[1]))
+                        errs.append(default_err)
+                    elif "gaia_large_rv.dat" in catalog_file:
+                        ra_hex, dec_hex = convert_to_hex(float(lineSplit[0])*24/360.0,delimiter=''), convert_to_hex(float(lineSplit[1]),delimiter='')
+                        if dec_hex[0] == "-":
+                            objname = "ZTFJ%s%s"%(ra_hex[:4],dec_hex[:5])
+                        else:
+                            objname = "ZTFJ%s%s"%(ra_hex[:4],dec_hex[:4])
+                        names.append(objname)
+                        ras.append(float(lineSplit[0]))
+                        decs.append(float(lineSplit[1]))
+                        errs.append(default_err)
+                    elif ("vlss" in catalog_file):
+                        names.append(lineSplit[0])
+                        ras.append(float(lineSplit[1]))
+                        decs.append(float(lineSplit[2]))
+                        err = np.sqrt(float(lineSplit[3])**2 + float(lineSplit[4])**2)*3600.0
+                        errs.append(err)
+                    elif ("apogee" in catalog_file):
+                        names.append(lineSplit[0])
+                        ras.append(float(lineSplit[3]))
+                        decs.append(float(lineSplit[4]))
+                        errs.append(default_err)
+                    elif ("fermi" in catalog_file):
+                        names.append(lineSplit[0])
+                        ras.append(float(lineSplit[1]))
+                        decs.append(float(lineSplit[2]))
+                        err = np.sqrt(float(lineSplit[3])**2 + float(lineSplit[4])**2)*3600.0
+                        errs.append(err)
+                        amaj.append(float(lineSplit[3]))
+                        amin.append(float(lineSplit[4]))
+                        phi.append(float(lineSplit[5]))
+                    elif ("swift" in catalog_file) or ("xmm" in catalog_file):
+                        names.append(lineSplit[0])
+                        ras.append(float(lineSplit[1]))
+                        decs.append(float(lineSplit[2]))
+                        err = float(lineSplit[3])
+                        errs.append(err)
+                    else:
+                        names.append(lineSplit[0])
+                        ras.append(float(lineSplit[1]))
+                        decs.append(float(lineSplit[2]))
+                        errs.append(default_err)
+                names = np.array(names)
+                ras, decs, errs = np.array(ras), np.array(decs), np.array(errs)
+                if ("fermi" in catalog_file):
+                    amaj, amin, phi = np.array(amaj), np.array(amin), np.array(phi)
+
+                names_split = np.array_split(names,Ncatalog)
+                ras_split = np.array_split(ras,Ncatalog)
+                decs_split = np.array_split(decs,Ncatalog)
+                errs_split = np.array_split(errs,Ncatalog)
+    
+                names = names_split[Ncatindex]
+                ras = ras_split[Ncatindex]
+                decs = decs_split[Ncatindex]
+                errs = errs_split[Ncatindex]
+    
+                if ("fermi" in catalog_file):
+                    amaj_split = np.array_split(amaj,Ncatalog)
+                    amin_split = np.array_split(amin,Ncatalog)
+                    phi_split = np.array_split(phi,Ncatalog)
     
-                    if np.isfinite(ymin) and np.isfinite(ymax):
-                        ax.set_ylim([ymin,ymax])
-                    ax.set_xlim([xmin,xmax])
-                    ax_.set_ylim([0,1])
-                    ax_.set_xlim([-1000,1000])
-                    if jj == len(bands)-1:
-                        ax.set_xlabel('Wavelength [A]')
-                        ax_.set_xlabel('Velocity [km/s]')
-                        adjust_subplots_band(ax, ax_)
+                    amaj = amaj_split[Ncatindex]
+                    amin = amin_split[Ncatindex]
+                    phi = phi_split[Ncatindex]
+
+            elif ".hdf5" in catalog_file:
+                if "underMS" in catalog_file:
+                    with h5py.File(catalog_file.replace(".hdf5","_ra.hdf5"), 'r') as f:
+                        ras = f['ra'][:]
+                    with h5py.File(catalog_file.replace(".hdf5","_dec.hdf5"), 'r') as f:
+                        decs = f['dec'][:]
+                else:
+                    with h5py.File(catalog_file, 'r') as f:
+                        ras, decs = f['ra'][:], f['dec'][:]
+                errs = default_err*np.ones(ras.shape)
+
+                ras_split = np.array_split(ras,Ncatalog)
+                decs_split = np.array_split(decs,Ncatalog)
+                errs_split = np.array_split(errs,Ncatalog)
+ 
+                ras = ras_split[Ncatindex]
+                decs = decs_split[Ncatindex]
+                errs = errs_split[Ncatindex]
+ 
+                if ("fermi" in catalog_file):
+                    amaj_split = np.array_split(amaj,Ncatalog)
+                    amin_split = np.array_split(amin,Ncatalog)
+                    phi_split = np.array_split(phi,Ncatalog)
+ 
+                    amaj = amaj_split[Ncatindex]
+                    amin = amin_split[Ncatindex]
+                    phi = phi_split[Ncatindex]
+
+                names = []
+                for ra, dec in zip(ras, decs):
+                    ra_hex, dec_hex = convert_to_hex(ra*24/360.0,delimiter=''), convert_to_hex(dec,delimiter='')
+                    if dec_hex[0] == "-":
+                        objname = "ZTFJ%s%s"%(ra_hex[:4],dec_hex[:5])
                     else:
-                        ax_.set_xticklabels([])
-                    if jj==1:
-                        new_tick_locations = np.array([-1000, -500, 0, 500, 1000])
-                        axmass = ax_.twiny()
-                        axmass.set_xlim(ax_.get_xlim())
-                        axmass.set_xticks(new_tick_locations)
-                        tick_labels = tick_function(new_tick_locations, period)
-                        tick_labels = ["{0:.0f}".format(float(x)) for x in tick_labels]
-                        axmass.set_xticklabels(tick_labels)
-                        axmass.set_xlabel("f($M$) ("+r'$M_\odot$'+')')
-            if npairs > 0:
-                # calculate mass functon
-                if npairs==1:
-                    id_pair = 0
+                        objname = "ZTFJ%s%s"%(ra_hex[:4],dec_hex[:4])
+                    names.append(objname)
+                names = np.array(names)
+
+            if opts.doRemoveBrightStars:
+                filename = "%s/bsc5.hdf5" % inputDir
+                sep = brightstardist(filename,ras,decs)
+                idx1 = np.where(sep >= opts.stardist)[0]
+                filename = "%s/Gaia.hdf5" % inputDir
+                sep = brightstardist(filename,ras,decs)
+                idx2 = np.where(sep >= opts.stardist)[0]
+                idx = np.union1d(idx1,idx2)
+                names = names[idx]
+                ras, decs, errs = ras[idx], decs[idx], errs[idx]
+                if ("fermi" in catalog_file):
+                    amaj, amin, phi = amaj[idx], amin[idx], phi[idx]
+
+            catalog_file_split = catalog_file.replace(".dat","").replace(".hdf5","").replace(".h5","").split("/")[-1]
+            catalogFile = os.path.join(catalogDir,"%s_%d.h5"%(catalog_file_split,
+                                                               Ncatindex))
+            if opts.doSpectra:
+                spectraFile = os.path.join(spectraDir,"%s_%d.pkl"%(catalog_file_split,
+                                                                   Ncatindex))
+
+            if opts.doStreaming:
+                nchunks = max(int(np.ceil(len(ras)/opts.chunk_size)), 1)
+            chunks = np.array_split(np.arange(len(ras)), nchunks)
+
+            def load_lightcurves(ichunk):
+                idx = chunks[ichunk]
+                if doSimulateLightcurves:
+                    return make_batch(*get_simulated_list(ras[idx], decs[idx],
+                                          min_epochs=min_epochs,
+                                          names=names[idx],
+                                          doCombineFilt=doCombineFilt,
+                                          doRemoveHC=doRemoveHC,
+                                          doUsePDot=doUsePDot))
                 else:
-                    # select a pair with:
-                    # (1) reasonable variance among all band measurements
-                    stds = np.std(v_values, axis=0)
-                    if np.sum(stds<50)>=1:
-                        v_values = v_values[:, stds<50]
-                        v_values_unc = v_values_unc[:, stds<50]
-                    # (2) largest (absolute) velosity variation
-                    vsums = np.sum(abs(v_values), axis=0)
-                    id_pair = np.where(vsums == max(vsums))[0][0]
-                v_adopt = np.median(v_values[:,id_pair])
-                id_band = np.where(v_values[:,id_pair]==v_adopt)[0][0]
-                v_adopt_unc = v_values_unc[id_band,id_pair]
-                K = abs(v_adopt/2.) # [km/s] assuming that the velocity variation is max and min in rv curve
-                K_unc = abs(v_adopt_unc/2.) # [km/s]
-                P = 2*period # [day] if ellipsodial modulation, amplitude are roughly the same, 
-                            # then the photometric period is probably half of the orbital period
-                fmass = (K * 100000)**3 * (P*86400) / (2*np.pi*const.G.cgs.value) / const.M_sun.cgs.value
-                fmass_unc = 3 * fmass / K * K_unc
-                data_out[name]["fmass"] = fmass
-                data_out[name]["fmass_unc"] = fmass_unc
-            if pdot == 0:
-                plt.suptitle(str(period2)+"_"+str(RA)+"_"+str(Dec))
+                    if amaj is None:
+                        amaj_chunk, amin_chunk, phi_chunk = None, None, None
+                    else:
+                        amaj_chunk, amin_chunk, phi_chunk = amaj[idx], amin[idx], phi[idx]
+                    return make_batch(*get_kowalski_list(ras[idx], decs[idx],
+                                          kow,
+                                          program_ids=program_ids,
+                                          min_epochs=min_epochs,
+                                          errs=errs[idx],
+                                          names=names[idx],
+                                          amaj=amaj_chunk, amin=amin_chunk,
+                                          phi=phi_chunk,
+                                          doCombineFilt=doCombineFilt,
+                                          doRemoveHC=doRemoveHC,
+                                          doExtinction=doExtinction,
+                                          doSigmaClipping=doSigmaClipping,
+                                          sigmathresh=sigmathresh,
+                                          doOutbursting=doOutbursting,
+                                          doCrossMatch=doCrossMatch,
+                                          crossmatch_radius=crossmatch_radius,
+                                          cache=cache))
+
+        elif opts.source_type == "objid":
+
+            if (".dat" in catalog_file) or (".txt" in catalog_file):
+                objids = np.loadtxt(catalog_file)
+                objids = objids[:,0] 
+            elif ".npy" in catalog_file:
+                objids = np.load(catalog_file)
             else:
-                plt.suptitle(str(period2)+"_"+str(RA)+"_"+str(Dec)+"_"+str(pdot))
-            fig.savefig(pngfile, bbox_inches='tight')
-            plt.close()
-    
-        cnt = cnt + 1
+                print("Sorry I don't know this file extension...")
+                continue
 
-    periodic_stats_algorithms[algorithm] = data_periodic_stats
+            objids_split = np.array_split(objids,Ncatalog)
+            objids = objids_split[Ncatindex]
 
-with h5py.File(catalogFile, 'w') as hf:
-    hf.create_dataset("names",  data=str_stats[:,0])
-    hf.create_dataset("filters",  data=str_stats[:,1])
-    hf.create_dataset("stats",  data=data_stats)
+            catalog_file_split = catalog_file.replace(".dat","").replace(".hdf5","").replace(".h5","").replace(".npy","").split("/")[-1]
+            catalogFile = os.path.join(catalogDir,"%s_%d.h5"%(catalog_file_split,
+                                                               Ncatindex))
+
+            if opts.doSpectra:
+                spectraFile = os.path.join(spectraDir,"%s_%d.pkl"%(catalog_file_split,
+                                                                   Ncatindex))
+
+
+            if opts.doStreaming:
+                nchunks = max(int(np.ceil(len(objids)/opts.chunk_size)), 1)
+            chunks = np.array_split(objids, nchunks)
+
+            def load_lightcurves(ichunk):
+                return make_batch(*get_kowalski_objids(chunks[ichunk], kow,
+                                        program_ids=program_ids,
+                                        min_epochs=min_epochs,
+                                        doRemoveHC=doRemoveHC,
+                                        doHCOnly=doHCOnly,
+                                        doExtinction=doExtinction,
+                                        doSigmaClipping=doSigmaClipping,
+                                        sigmathresh=sigmathresh,
+                                        doOutbursting=doOutbursting,
+                                        doPercentile=doPercentile,
+                                        percmin = percmin, percmax = percmax,
+                                        doParallel = opts.doParallel,
+                                        Ncore = opts.Ncore,
+                                        cache = cache))
+        else:
+            print("Source type unknown...")
+            exit(0)
 
-    for algorithm in algorithms:
-        hf.create_dataset("stats_%s" % algorithm,
-                          data=periodic_stats_algorithms[algorithm])
+    elif opts.lightcurve_source == "matchfiles":
+        if ":" in matchFile:
+            matchFile_end = matchFile.split(":")[-1].split("/")[-1]
+            matchFile_out = "/scratch/mcoughlin/%s" % matchFile_end
+            if not os.path.isfile(matchFile_out):
+                print('Fetching %s...' % matchFile)
+                wget_command = "scp -i /home/mcoughlin/.ssh/id_rsa_passwordless %s %s" % (matchFile, matchFile_out)
+                os.system(wget_command)
+            matchFile = matchFile_out
+
+        if not os.path.isfile(matchFile):
+            print("%s missing..."%matchFile)
+            continue
 
-    if opts.doBrutus:
-        hf.create_dataset("brutus_out",  data=brutus_out)
+        matchFile_split = matchFile.replace(".pytable","").replace(".hdf5","").replace(".h5","").split("/")[-1]
+        catalogFile = os.path.join(catalogDir,"%s_%d.h5"%(matchFile_split,
+                                                               Ncatindex))
+        if opts.doSpectra:
+            spectraFile = os.path.join(spectraDir,matchFileEnd)
+
+        # the matchfile is read and grouped by source once for the job;
+        # the chunks are slices of it
+        #matchFile = find_matchfile(opts.matchfileDir)
+        matches = read_matchfile(matchFile, min_epochs=min_epochs,
+                                 Ncatalog=Ncatalog, Ncatindex=Ncatindex)
+
+        # as for Kowalski, doHCOnly always runs on the whole job
+        if opts.doStreaming and not doHCOnly:
+            nchunks = max(int(np.ceil(len(matches["matchids"])/opts.chunk_size)), 1)
+        chunks = np.array_split(matches["matchids"], nchunks)
+        if nchunks > 1:
+            stream_baseline = matchfile_baseline(matches,
+                                                 min_epochs=min_epochs)
+
+        def load_lightcurves(ichunk):
+            return make_batch(*matchfile_lightcurves(matches, chunks[ichunk],
+                                             min_epochs=min_epochs,
+                                             doRemoveHC=doRemoveHC,
+                                             doHCOnly=doHCOnly),
+                              doRemoveBrightStars=opts.doRemoveBrightStars)
+
+    elif opts.lightcurve_source == "h5files":
+        if not os.path.isfile(matchFile):
+            print("%s missing..."%matchFile)
+            continue
+
+        matchFileEnd = matchFile.split("/")[-1].replace("h5","h5")
+        catalogFile = os.path.join(catalogDir,matchFileEnd)
+        if opts.doSpectra:
+            spectraFile = os.path.join(spectraDir,matchFileEnd)
+        matchFileEndSplit = matchFileEnd.split("_")
+        fil = matchFileEndSplit[2][1]
+
+        def load_lightcurves(ichunk):
+            lightcurves, coordinates, baseline = [], [], 0
+            f = h5py.File(matchFile, 'r+')
+            for key in f.keys():
+                keySplit = key.split("_")
+                nid, ra, dec = int(keySplit[0]), float(keySplit[1]), float(keySplit[2])
+
+                data = list(f[key])
+                data = np.array(data).T
+                if len(data[:,0]) < min_epochs: continue
+                lightcurve=(data[:,0],data[:,1],data[:,2])
+                lightcurves.append(lightcurve)
+                coordinates.append((ra,dec))
+
+                newbaseline = max(data[:,0])-min(data[:,0])
+                if newbaseline>baseline:
+                    baseline=newbaseline
+            f.close()
+
+            filters = [[fil] for x in lightcurves]
+            return make_batch(lightcurves, coordinates, filters, None, None,
+                              None, None, baseline,
+                              doRemoveBrightStars=opts.doRemoveBrightStars)
+
+    nprocessed = 0
+
+    # the catalog is written chunk by chunk to a partial file, which is only
+    # moved into place once all objects are done
+    catalogFilePartial = catalogFile.replace(".h5", ".partial.h5")
+
+    # the frequency grid follows from the baseline, which is fixed for the
+    # whole job so that streaming does not change the periods found
+    # (unless per-chunk grids are asked for with --doChunkBaselines)
+    job_baseline = opts.baseline
+    if (job_baseline is None) and (nchunks > 1) and not opts.doChunkBaselines:
+        if stream_baseline is None:
+            print('Baseline query failed, set --baseline... continuing.')
+            continue
+        job_baseline = stream_baseline
+        print('Job baseline: %.5f days' % job_baseline)
+
+    if nchunks > 1:
+        # the next chunk is read while the current one is analyzed
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=1)
+        print('Streaming lightcurves in %d chunks...' % nchunks)
+
+    future = None
+    for ichunk in range(nchunks):
+        if nchunks > 1:
+            if future is None:
+                future = executor.submit(load_lightcurves, ichunk)
+            lightcurves = future.result()
+            if ichunk + 1 < nchunks:
+                future = executor.submit(load_lightcurves, ichunk + 1)
+            print('Chunk %d/%d: %d lightcurves' % (ichunk+1, nchunks,
+                                                   len(lightcurves)))
+        else:
+            lightcurves = load_lightcurves(ichunk)
 
-if opts.doSpectra:
-    with open(spectraFile, 'wb') as handle:
-        pickle.dump(data_out, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(lightcurves) == 0:
+            continue
+
+        if opts.doCheckLightcurves:
+            print('Just checking that there are lightcurves to analyze... exiting.')
+            exit(0)
+
+        str_stats, data_stats, periodic_stats_algorithms, brutus_out = \
+            analyze_lightcurves(lightcurves, nprocessed=nprocessed,
+                                baseline=job_baseline)
+
+        catalog_data = {"names": str_stats[:,0],
+                        "filters": str_stats[:,1],
+                        "stats": data_stats}
+        for algorithm in algorithms:
+            catalog_data["stats_%s" % algorithm] = periodic_stats_algorithms[algorithm]
+        if opts.doBrutus:
+            catalog_data["brutus_out"] = brutus_out
+        append_catalog(catalogFilePartial, catalog_data,
+                       create=(nprocessed == 0))
+
+        nprocessed = nprocessed + len(lightcurves)
+        del lightcurves
+
+    if nchunks > 1:
+        executor.shutdown()
+
+    if nprocessed == 0:
+        touch(catalogFile)
+        if opts.doSpectra:
+            touch(spectraFile)
+        print('No lightcurves available... continuing.')
+        continue
+
+    os.replace(catalogFilePartial, catalogFile)
+
+    if opts.doSpectra:
+        with open(spectraFile, 'wb') as handle:
+            pickle.dump(data_out, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+if opts.lightcurve_source == "Kowalski":
+    kow.print_stats()
 
 if opts.doRsyncFiles:
     outputDirSplit = outputDir.split("/")[-1]
@@ -168,6 +168,7 @@ if opts.lightcurve_source == "Kowalski":
         job_number = 0
         quadrantfile = os.path.join(qsubDir,'qsub.dat')
         fid = open(quadrantfile,'w')
+        boundaries = {}
         for field in fields:
             if opts.doCutNObs:
                 if not field in fields_list:
@@ -207,6 +208,11 @@ if opts.lightcurve_source == "Kowalski":
                             for obj in r['data']:
                                 objids.append(obj['_id'])
                             np.save(idsFile, objids)
+
+                        # jobs read their batch as an _id range
+                        boundaries["%d_%d_%d" % (field, ccd, quadrant)] = \
+                            ztfperiodic.utils.id_boundaries(np.load(idsFile),
+                                                            Ncatalog)
                     
                     for ii in range(Ncatalog):
                         catalogFile = os.path.join(catalogDir,"%d_%d_%d_%d.h5"%(field, ccd, quadrant, ii))
@@ -218,6 +224,9 @@ if opts.lightcurve_source == "Kowalski":
     
                         job_number = job_number + 1
         fid.close()
+        if boundaries:
+            ztfperiodic.utils.save_id_boundaries(
+                ztfperiodic.utils.id_boundaries_file(quadrantfile), boundaries)
 elif opts.lightcurve_source == "matchfiles":
     bands = {1: 'g', 2: 'r', 3: 'i', 4: 'z', 5: 'J'}
     directory="%s/*/*/*.pytable"%opts.matchfileDir
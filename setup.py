@@ -91,6 +91,59 @@ extras_require = {
     ],
 }
 
+# -- extensions ---------------------------------------------------------------
+
+# the Cython AOV kernel (AOV_cython algorithm) is only built if Cython
+# is available; it is optional, so that a failed compilation does not fail
+# the install, and its prange loops run serially without OpenMP
+
+def openmp_flags():
+    """['-fopenmp'] if the C compiler builds an OpenMP program, else []
+    """
+    import shutil
+    import tempfile
+    from distutils.ccompiler import new_compiler
+    from distutils.sysconfig import customize_compiler
+    from distutils.errors import CCompilerError
+
+    compiler = new_compiler()
+    customize_compiler(compiler)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(tmpdir, 'openmp_test.c')
+        with open(source, 'w') as f:
+            f.write('#include <omp.h>\n'
+                    'int main(void) { return omp_get_max_threads() < 1; }\n')
+        objects = compiler.compile([source], output_dir=tmpdir,
+                                   extra_postargs=['-fopenmp'])
+        compiler.link_executable(objects,
+                                 os.path.join(tmpdir, 'openmp_test'),
+                                 extra_postargs=['-fopenmp'])
+    except CCompilerError:
+        print('C compiler does not support OpenMP, '
+              'building the AOV kernel without it')
+        return []
+    finally:
+        shutil.rmtree(tmpdir)
+    return ['-fopenmp']
+
+ext_modules = []
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    pass
+else:
+    from setuptools import Extension
+    openmp = openmp_flags()
+    ext_modules = cythonize([
+        Extension('ztfperiodic.aov_cython', ['ztfperiodic/aov_cython.pyx'],
+                  extra_compile_args=['-O3'] + openmp,
+                  extra_link_args=openmp),
+    ])
+    # set after cythonize, which does not carry the flag over
+    for ext in ext_modules:
+        ext.optional = True
+
 # -- run setup ----------------------------------------------------------------
 
 packagenames = find_packages()
@@ -108,6 +161,7 @@ setup(name=DISTNAME,
       include_package_data=True,
       cmdclass=cmdclass,
       scripts=scripts,
+      ext_modules=ext_modules,
       setup_requires=setup_requires,
       install_requires=install_requires,
       tests_require=tests_require,
@@ -0,0 +1,129 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+"""
+Phase-binned AOV periodogram in Cython.
+
+`aov_batch` evaluates the AOV statistic (Schwarzenberg-Czerny, 1989) of
+a batch of light curves, padded to a common length, at many frequencies
+in one call. The (light curve, frequency) pairs are looped over without
+the GIL and split over threads with OpenMP; every thread bins into its
+own heap buffers, so there is no limit on the length of the light
+curves. Used by the AOV_cython algorithm of
+`ztfperiodic.periodsearch.find_periods`.
+
+The extension is built by setup.py when Cython is available.
+"""
+
+import os
+
+import numpy as np
+
+from cython.parallel cimport prange, parallel
+from libc.stdlib cimport malloc, free
+from libc.math cimport floor
+
+
+cdef double _aov(double freq, const double *t, const double *m, int npts,
+                 double avg, int r, double *n, double *sum1,
+                 double *sum2) noexcept nogil:
+    cdef int i, idx
+    cdef double aux, s1, s2, mean
+
+    if npts <= r:
+        return 0.0
+
+    for i in range(r):
+        n[i] = 0.0
+        sum1[i] = 0.0
+        sum2[i] = 0.0
+
+    for i in range(npts):
+        aux = (t[i]-t[0])*freq
+        idx = <int>((aux - floor(aux))*r)
+        if idx >= r:
+            idx = r-1
+        sum1[idx] = sum1[idx] + m[i]
+        sum2[idx] = sum2[idx] + m[i]*m[i]
+        n[idx] = n[idx] + 1
+
+    s1 = 0.0
+    s2 = 0.0
+    for i in range(r):
+        if n[i] == 0:
+            continue
+        mean = sum1[i]/n[i]
+        s1 = s1 + n[i]*(mean-avg)*(mean-avg)
+        s2 = s2 + sum2[i] - n[i]*mean*mean
+
+    if s2 <= 0.0:
+        return 0.0
+
+    return s1/s2*(npts-r)/(r-1)
+
+
+def aov_batch(time, mag, lengths, freqs, int r=10, int n_jobs=1):
+    """AOV periodograms of a padded batch of light curves.
+
+    Parameters
+    ----------
+    time, mag : array-like, shape = [n_lightcurves, max_length]
+        Light curves, one per row; only the first lengths[ii] values of
+        row ii are used.
+    lengths : array-like, shape = [n_lightcurves]
+        Number of samples of each light curve.
+    freqs : array-like, shape = [n_freqs]
+        Frequencies.
+    r : int
+        Number of phase bins.
+    n_jobs : int
+        Number of threads (-1 for all cores).
+
+    Returns
+    -------
+    aov : array-like, shape = [n_lightcurves, n_freqs]
+        AOV statistic, larger for more significant periods.
+    """
+
+    cdef double[:, ::1] t = np.ascontiguousarray(time, dtype=np.float64)
+    cdef double[:, ::1] m = np.ascontiguousarray(mag, dtype=np.float64)
+    cdef int[::1] npts = np.ascontiguousarray(lengths, dtype=np.intc)
+    cdef double[::1] f = np.ascontiguousarray(freqs, dtype=np.float64)
+
+    cdef Py_ssize_t nlc = t.shape[0], nfreq = f.shape[0]
+    if (m.shape[0] != nlc) or (npts.shape[0] != nlc):
+        raise ValueError('time, mag and lengths must have the same number of light curves')
+    if (nlc > 0) and (np.max(lengths) > t.shape[1]):
+        raise ValueError('lengths exceed the padded length')
+    if r < 2:
+        raise ValueError('at least two phase bins are needed')
+
+    # mean magnitude of each light curve, without the padding
+    valid = np.arange(t.shape[1])[None,:] < np.asarray(npts)[:,None]
+    cdef double[::1] avg = np.sum(np.where(valid, m, 0.0), axis=1) / \
+        np.maximum(np.asarray(npts), 1)
+
+    out = np.zeros((nlc, nfreq), dtype=np.float64)
+    cdef double[:, ::1] out_view = out
+
+    cdef int num_threads = n_jobs
+    if num_threads < 0:
+        num_threads = max(1, (os.cpu_count() or 1) + 1 + num_threads)
+    num_threads = max(1, num_threads)
+
+    cdef Py_ssize_t k, ii, jj, ntask = nlc*nfreq
+    cdef double *buf
+    if ntask == 0:
+        return out
+
+    with nogil, parallel(num_threads=num_threads):
+        buf = <double *> malloc(3*r*sizeof(double))
+        if buf == NULL:
+            with gil:
+                raise MemoryError()
+        for k in prange(ntask, schedule='guided'):
+            ii = k // nfreq
+            jj = k % nfreq
+            out_view[ii, jj] = _aov(f[jj], &t[ii, 0], &m[ii, 0], npts[ii],
+                                    avg[ii], r, buf, buf+r, buf+2*r)
+        free(buf)
+
+    return out
@@ -0,0 +1,127 @@
+"""
+Cadence selections of the light curve loaders.
+
+`thin_cadence` is the doRemoveHC selection of the Kowalski loaders: a
+point is kept only if it comes at least `HC_CADENCE` (30 minutes) after
+the previously kept point. The greedy selection is evaluated for all
+light curves of a batch at once: every point at least HC_CADENCE after
+its predecessor starts a new cluster and is always kept, and within the
+clusters the next kept point is found with one searchsorted per step,
+for all clusters together.
+
+`next_gaps` gives the time to the next point of the same light curve,
+which is what the doHCOnly selections and the high-cadence segmentation
+of `split_lightcurve` and `get_matchfile` are based on.
+
+All functions take time-sorted light curves, either one array or the
+concatenated arrays and offsets of a `ztfperiodic.lcbatch.LightcurveBatch`.
+"""
+
+import numpy as np
+
+# minimum separation of the points kept by doRemoveHC, in days
+HC_CADENCE = 30.0*60.0/86400.0
+
+
+def _offsets(n, offsets):
+    if offsets is None:
+        return np.array([0, n], dtype=np.int64)
+    return np.asarray(offsets, dtype=np.int64)
+
+
+def next_gaps(hjd, offsets=None):
+    """Time to the next point of the same light curve (nan for the last
+    point of each light curve).
+
+    Parameters
+    ----------
+    hjd : array-like, shape = [n_samples]
+        Times, sorted within each light curve.
+    offsets : array-like, shape = [n_lightcurves + 1]
+        Light curve ii is hjd[offsets[ii]:offsets[ii+1]]; a single light
+        curve if None.
+    """
+
+    hjd = np.asarray(hjd, dtype=np.float64)
+    offsets = _offsets(len(hjd), offsets)
+
+    gaps = np.full(len(hjd), np.nan)
+    gaps[:-1] = hjd[1:] - hjd[:-1]
+    ends = offsets[1:][np.diff(offsets) > 0] - 1
+    gaps[ends] = np.nan
+
+    return gaps
+
+
+def thin_cadence(hjd, offsets=None, min_dt=HC_CADENCE):
+    """Keep a point only if it is at least min_dt after the previously
+    kept point of its light curve (the first point is always kept).
+
+    Parameters
+    ----------
+    hjd : array-like, shape = [n_samples]
+        Times, sorted within each light curve.
+    offsets : array-like, shape = [n_lightcurves + 1]
+        Light curve ii is hjd[offsets[ii]:offsets[ii+1]]; a single light
+        curve if None.
+    min_dt : float
+        Minimum separation of the kept points, in days.
+
+    Returns
+    -------
+    keep : array-like, shape = [n_samples]
+        Boolean mask of the kept points.
+    """
+
+    hjd = np.asarray(hjd, dtype=np.float64)
+    n = len(hjd)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    offsets = _offsets(n, offsets)
+    lengths = np.diff(offsets)
+
+    # points far enough from their predecessor are always kept
+    first = np.zeros(n, dtype=bool)
+    first[offsets[:-1][lengths > 0]] = True
+    dt = np.full(n, np.inf)
+    dt[1:] = hjd[1:] - hjd[:-1]
+    cluster_start = first | (dt >= min_dt)
+    keep[cluster_start] = True
+
+    starts = np.where(cluster_start)[0]
+    stops = np.append(starts[1:], n)
+    active = stops - starts > 1
+    cur, stop = starts[active], stops[active]
+    if len(cur) == 0:
+        return keep
+
+    # times made increasing over the whole batch, to search all light
+    # curves at once; candidates are then checked on hjd itself
+    segment = np.repeat(np.arange(len(lengths)), lengths)
+    tmin = np.repeat(hjd[offsets[:-1][lengths > 0]], lengths[lengths > 0])
+    span = np.max(hjd - tmin) + 2*min_dt + 1.0
+    key = (hjd - tmin) + segment*span
+
+    while len(cur) > 0:
+        nxt = np.searchsorted(key, key[cur] + min_dt, side='left')
+        nxt = np.minimum(np.maximum(nxt, cur + 1), stop)
+
+        # first point with hjd - hjd[cur] >= min_dt, as in the loop
+        while True:
+            back = (nxt - 1 > cur) & (hjd[nxt - 1] - hjd[cur] >= min_dt)
+            if not np.any(back):
+                break
+            nxt[back] -= 1
+        while True:
+            forward = (nxt < stop) & \
+                ~(hjd[np.minimum(nxt, n - 1)] - hjd[cur] >= min_dt)
+            if not np.any(forward):
+                break
+            nxt[forward] += 1
+
+        found = nxt < stop
+        keep[nxt[found]] = True
+        cur, stop = nxt[found], stop[found]
+
+    return keep
@@ -0,0 +1,205 @@
+"""
+Consolidation of period search catalogs.
+
+A period search run writes one catalog file per job, i.e. thousands of
+small HDF5 files for a survey run. `consolidate_catalogs` merges them
+into a single HDF5 file with one contiguous dataset per column. The
+output is preallocated from the sizes of the inputs and filled a batch
+of files at a time, so that memory is bounded by one batch rather than
+the whole run. `load_consolidated_catalog` memory-maps the numeric
+columns of the consolidated file.
+"""
+
+import os
+import glob
+
+import numpy as np
+import h5py
+
+STATS_NAMES = ["objid", "ra", "dec"] + ["stats%d" % ii for ii in range(22)]
+PERIODIC_STATS_NAMES = ["objid", "period", "sig", "pdot"] + \
+    ["periodicstats%d" % ii for ii in range(14)]
+STRING_NAMES = ["name", "filt"]
+
+# column order of the consolidated catalog
+COLUMN_NAMES = STATS_NAMES + STRING_NAMES + PERIODIC_STATS_NAMES[1:] + \
+    ["catnum"]
+
+
+def catalog_filenames(catalog, doFermi=False, doField=False, field=-1):
+    """Catalog files of a period search output directory."""
+
+    if doFermi:
+        filenames = sorted(glob.glob(os.path.join(catalog,"*/*.dat")))[::-1] + \
+                    sorted(glob.glob(os.path.join(catalog,"*/*.h5")))[::-1]
+    elif doField:
+        filenames = sorted(glob.glob(os.path.join(catalog,"%d_*.dat" % field)))[::-1] + \
+                    sorted(glob.glob(os.path.join(catalog,"%d_*.h5" % field)))[::-1]
+    else:
+        filenames = sorted(glob.glob(os.path.join(catalog,"*.dat")))[::-1] + \
+                    sorted(glob.glob(os.path.join(catalog,"*.h5")))[::-1]
+
+    # jobs still running write to .partial.h5 files
+    return [filename for filename in filenames
+            if not filename.endswith(".partial.h5")]
+
+
+def catalog_number(filename):
+    """Job index at the end of a catalog file name (-1 if there is none)."""
+
+    catnum = filename.split("/")[-1].replace(".dat","").replace(".h5","").split("_")[-1]
+    try:
+        return int(catnum)
+    except ValueError:
+        return -1
+
+
+def catalog_size(filename, algorithm):
+    """Number of objects in a catalog file (0 if it cannot be read)."""
+
+    try:
+        with h5py.File(filename, 'r') as f:
+            return min(f['stats'].shape[0],
+                       f['stats_%s' % algorithm].shape[0],
+                       f['names'].shape[0], f['filters'].shape[0])
+    except (IOError, OSError, KeyError):
+        return 0
+
+
+def _to_str(values):
+    return np.array([x.decode() if isinstance(x, bytes) else str(x)
+                     for x in values], dtype=object)
+
+
+def read_catalog_file(filename, algorithm, nrows):
+    """Columns of the first nrows objects of a catalog file."""
+
+    with h5py.File(filename, 'r') as f:
+        stats = f['stats'][:nrows]
+        periodic_stats = f['stats_%s' % algorithm][:nrows]
+        names = f['names'][:nrows]
+        filters = f['filters'][:nrows]
+
+    columns = {}
+    for jj, name in enumerate(STATS_NAMES):
+        columns[name] = stats[:,jj]
+    for jj, name in enumerate(PERIODIC_STATS_NAMES):
+        if name == "objid": continue
+        columns[name] = periodic_stats[:,jj]
+    columns["name"] = _to_str(names)
+    columns["filt"] = _to_str(filters)
+    columns["catnum"] = catalog_number(filename)*np.ones(nrows)
+
+    return columns
+
+
+def consolidate_catalogs(filenames, outfile, algorithm='ECE',
+                         doParallel=False, Ncore=8, batch_size=100):
+    """Merge catalog files into one column-wise HDF5 file.
+
+    Parameters
+    ----------
+    filenames : list
+        Catalog files written by the period search; files that cannot
+        be read are skipped.
+    outfile : str
+        Consolidated catalog file.
+    algorithm : str
+        Algorithm of the periodic stats to keep.
+    doParallel : bool
+        Read the files of each batch with Ncore processes.
+    batch_size : int
+        Number of files read before writing to outfile.
+
+    Returns
+    -------
+    nobjects : int
+        Number of objects in the consolidated catalog.
+    """
+
+    sizes = np.array([catalog_size(filename, algorithm)
+                      for filename in filenames], dtype=np.int64)
+    filenames = [filename for filename, size in zip(filenames, sizes)
+                 if size > 0]
+    sizes = sizes[sizes > 0]
+    offsets = np.append(0, np.cumsum(sizes)).astype(np.int64)
+    nobjects = int(offsets[-1])
+
+    print('Consolidating %d objects from %d files...' % (nobjects,
+                                                        len(filenames)))
+
+    tmpfile = "%s.%d.tmp" % (outfile, os.getpid())
+    with h5py.File(tmpfile, 'w') as out:
+        # contiguous, uncompressed datasets so they can be memory-mapped
+        for name in COLUMN_NAMES:
+            if name in STRING_NAMES:
+                out.create_dataset(name, shape=(nobjects,),
+                                   dtype=h5py.string_dtype())
+            else:
+                out.create_dataset(name, shape=(nobjects,),
+                                   dtype=np.float64)
+        out.create_dataset("file_offsets", data=offsets)
+        out.create_dataset("filenames", data=np.array(filenames, dtype=object),
+                           dtype=h5py.string_dtype())
+        out.attrs["algorithm"] = algorithm
+
+        for start in range(0, len(filenames), batch_size):
+            stop = min(start + batch_size, len(filenames))
+            print('Loading file %d/%d' % (start, len(filenames)))
+
+            if doParallel:
+                from joblib import Parallel, delayed
+                columns_list = Parallel(n_jobs=Ncore)(delayed(read_catalog_file)(filenames[ii], algorithm, sizes[ii]) for ii in range(start, stop))
+            else:
+                columns_list = [read_catalog_file(filenames[ii], algorithm,
+                                                  sizes[ii])
+                                for ii in range(start, stop)]
+
+            # one write per column and batch
+            for name in COLUMN_NAMES:
+                values = np.concatenate([columns[name]
+                                         for columns in columns_list])
+                out[name][offsets[start]:offsets[stop]] = values
+
+    os.replace(tmpfile, outfile)
+
+    return nobjects
+
+
+def load_consolidated_catalog(filename, columns=None):
+    """Columns of a consolidated catalog.
+
+    Numeric columns are memory-mapped from the file, string columns are
+    read into memory.
+
+    Parameters
+    ----------
+    filename : str
+        Consolidated catalog file.
+    columns : list
+        Columns to load (default all, plus file_offsets).
+
+    Returns
+    -------
+    data : dict
+        Column name to array.
+    """
+
+    if columns is None:
+        columns = COLUMN_NAMES + ["file_offsets"]
+
+    data = {}
+    with h5py.File(filename, 'r') as f:
+        for name in columns:
+            dset = f[name]
+            if name in STRING_NAMES:
+                data[name] = np.array(dset.asstr()[:], dtype=str)
+                continue
+            offset = dset.id.get_offset()
+            if (offset is None) or (dset.size == 0):
+                data[name] = dset[:]
+            else:
+                data[name] = np.memmap(filename, mode='r', dtype=dset.dtype,
+                                       shape=dset.shape, offset=offset)
+
+    return data
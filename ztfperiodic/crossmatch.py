@@ -0,0 +1,177 @@
+"""
+Crossmatching of source catalogs.
+
+`CatalogIndex` builds a KD-tree of the unit vectors of a catalog once, so
+that every later query only looks at the catalog sources near each query
+position instead of computing the distance to all of them. Matches are
+returned as pairs of indices (query, catalog).
+
+Circular regions are matched on the chord length between the unit
+vectors, which is exact for any radius. Error ellipses are first matched
+with their semi-major axis as radius, and the candidates are then tested
+in the tangent plane of the ellipse center. As for the matplotlib
+ellipses used before, the angle phi (degrees) is measured counter-
+clockwise from the RA axis.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def radec_to_xyz(ra, dec):
+    """Unit vectors of coordinates in degrees, shape = [n, 3]."""
+
+    ra = np.radians(np.atleast_1d(np.asarray(ra, dtype=np.float64)))
+    dec = np.radians(np.atleast_1d(np.asarray(dec, dtype=np.float64)))
+    cosdec = np.cos(dec)
+    return np.vstack([cosdec*np.cos(ra), cosdec*np.sin(ra), np.sin(dec)]).T
+
+
+def chord_length(radius):
+    """Chord length of unit vectors separated by radius degrees."""
+
+    radius = np.minimum(np.asarray(radius, dtype=np.float64), 180.0)
+    return 2*np.sin(np.radians(radius)/2.0)
+
+
+def tangent_plane_offsets(ra0, dec0, ra, dec):
+    """Gnomonic offsets (xi, eta) in degrees of (ra, dec) around the
+    tangent point (ra0, dec0); xi increases with RA."""
+
+    ra0, dec0 = np.radians(ra0), np.radians(dec0)
+    ra, dec = np.radians(ra), np.radians(dec)
+
+    dra = ra - ra0
+    cosc = np.sin(dec0)*np.sin(dec) + np.cos(dec0)*np.cos(dec)*np.cos(dra)
+    xi = np.cos(dec)*np.sin(dra)/cosc
+    eta = (np.cos(dec0)*np.sin(dec) - np.sin(dec0)*np.cos(dec)*np.cos(dra))/cosc
+
+    return np.degrees(xi), np.degrees(eta)
+
+
+def in_ellipse(ra0, dec0, amaj, amin, phi, ra, dec):
+    """Whether (ra, dec) lies inside the ellipses centered on (ra0, dec0)
+    with semi-axes amaj and amin (degrees) and angle phi (degrees)."""
+
+    xi, eta = tangent_plane_offsets(ra0, dec0, ra, dec)
+    phi = np.radians(phi)
+    x = xi*np.cos(phi) + eta*np.sin(phi)
+    y = -xi*np.sin(phi) + eta*np.cos(phi)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inside = (x/amaj)**2 + (y/amin)**2 <= 1.0
+    # points more than 90 degrees away have no tangent plane projection
+    inside &= np.isfinite(xi) & np.isfinite(eta)
+
+    return inside
+
+
+class CatalogIndex(object):
+    """Spatial index of a catalog for crossmatching.
+
+    Parameters
+    ----------
+    ra, dec : array-like, shape = [n_sources]
+        Catalog coordinates in degrees.
+    """
+
+    def __init__(self, ra, dec):
+        self.ra = np.atleast_1d(np.asarray(ra, dtype=np.float64))
+        self.dec = np.atleast_1d(np.asarray(dec, dtype=np.float64))
+        self.tree = cKDTree(radec_to_xyz(self.ra, self.dec))
+
+    def __len__(self):
+        return len(self.ra)
+
+    def query_circle(self, ra, dec, radius):
+        """Catalog sources within radius of each query position.
+
+        Parameters
+        ----------
+        ra, dec : array-like, shape = [n_queries]
+            Query coordinates in degrees.
+        radius : float or array-like, shape = [n_queries]
+            Match radius in degrees.
+
+        Returns
+        -------
+        idx1 : array-like
+            Indices of the query positions.
+        idx2 : array-like
+            Indices of the matching catalog sources.
+        """
+
+        xyz = radec_to_xyz(ra, dec)
+        radius = np.broadcast_to(radius, (len(xyz),))
+
+        matches = self.tree.query_ball_point(xyz, chord_length(radius))
+        counts = np.array([len(match) for match in matches], dtype=np.int64)
+        idx1 = np.repeat(np.arange(len(xyz)), counts)
+        if np.sum(counts) > 0:
+            idx2 = np.concatenate(matches).astype(np.int64)
+        else:
+            idx2 = np.zeros(0, dtype=np.int64)
+
+        return idx1, idx2
+
+    def query_nearest(self, ra, dec, radius):
+        """Nearest catalog source of each query position, if within radius.
+
+        Parameters
+        ----------
+        ra, dec : array-like, shape = [n_queries]
+            Query coordinates in degrees.
+        radius : float
+            Match radius in degrees.
+
+        Returns
+        -------
+        idx1 : array-like
+            Indices of the query positions with a match.
+        idx2 : array-like
+            Indices of their nearest catalog sources.
+        """
+
+        xyz = radec_to_xyz(ra, dec)
+        if (len(xyz) == 0) or (len(self) == 0):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        # the bound is strict, so that sources at exactly radius match
+        bound = np.nextafter(chord_length(radius), np.inf)
+        dist, idx = self.tree.query(xyz, k=1, distance_upper_bound=bound)
+        idx1 = np.where(np.isfinite(dist))[0]
+
+        return idx1, idx[idx1].astype(np.int64)
+
+    def query_ellipse(self, ra, dec, amaj, amin, phi):
+        """Catalog sources inside the error ellipse of each query position.
+
+        Parameters
+        ----------
+        ra, dec : array-like, shape = [n_queries]
+            Ellipse centers in degrees.
+        amaj, amin : float or array-like, shape = [n_queries]
+            Semi-major and semi-minor axes in degrees.
+        phi : float or array-like, shape = [n_queries]
+            Angle of the major axis in degrees, counter-clockwise from
+            the RA axis.
+
+        Returns
+        -------
+        idx1 : array-like
+            Indices of the query positions.
+        idx2 : array-like
+            Indices of the matching catalog sources.
+        """
+
+        ra = np.atleast_1d(np.asarray(ra, dtype=np.float64))
+        dec = np.atleast_1d(np.asarray(dec, dtype=np.float64))
+        amaj = np.broadcast_to(amaj, ra.shape)
+        amin = np.broadcast_to(amin, ra.shape)
+        phi = np.broadcast_to(phi, ra.shape)
+
+        idx1, idx2 = self.query_circle(ra, dec, amaj)
+        inside = in_ellipse(ra[idx1], dec[idx1], amaj[idx1], amin[idx1],
+                            phi[idx1], self.ra[idx2], self.dec[idx2])
+
+        return idx1[inside], idx2[inside]
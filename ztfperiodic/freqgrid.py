@@ -0,0 +1,266 @@
+"""
+Frequency grids of the period searches.
+
+A `FrequencyGrid` holds the uniform grid fmin + df*arange(nf) of a job
+together with the mask of its terrestrial aliases (the frequencies inside
+any of the freqs_to_remove windows), and the masked, float32 and period
+views the algorithms of `ztfperiodic.periodsearch.find_periods` use.
+Everything is computed once per grid instead of once per algorithm and
+light curve, e.g.
+
+    grid = FrequencyGrid.from_baseline(baseline, fmin, fmax,
+                                       samples_per_peak=10,
+                                       freqs_to_remove=freqs_to_remove)
+    grid.masked      # frequencies searched by the masking algorithms
+    grid.periods32   # 1/grid.masked in float32, for periodfind
+
+Grids can be cached on disk in hdf5 files keyed by (fmin, fmax, df,
+alias windows), so that the jobs of a campaign share them.
+
+`baseline_bins` groups light curves by baseline, so that each group can
+be searched on a grid with the step its own baselines need rather than
+the one of the longest light curve of the job.
+"""
+
+import os
+import hashlib
+
+import numpy as np
+
+
+def alias_mask(freqs, freqs_to_remove=None):
+    """Boolean mask of the frequencies outside all alias windows.
+
+    Parameters
+    ----------
+    freqs : array-like, shape = [n_freqs]
+        Frequencies.
+    freqs_to_remove : list of [low, high] pairs
+        Windows of frequencies to remove (edges included); nothing is
+        removed if None.
+    """
+
+    freqs = np.asarray(freqs)
+    keep = np.ones(len(freqs), dtype=bool)
+    if freqs_to_remove is None:
+        return keep
+    for pair in freqs_to_remove:
+        keep &= (freqs < pair[0]) | (freqs > pair[1])
+    return keep
+
+
+def grid_key(fmin, fmax, df, freqs_to_remove=None):
+    """Cache key of a grid: hash of (fmin, fmax, df, alias windows)."""
+    aliases = sorted([[float(pair[0]), float(pair[1])]
+                      for pair in (freqs_to_remove or [])])
+    text = "%.17g_%.17g_%.17g_%s" % (float(fmin), float(fmax), float(df),
+                                     repr(aliases))
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+class FrequencyGrid(object):
+    """Uniform frequency grid with its terrestrial alias mask.
+
+    Parameters
+    ----------
+    fmin, fmax : float
+        Frequency range; the grid is fmin + df*arange(ceil((fmax-fmin)/df)).
+    df : float
+        Frequency step.
+    freqs_to_remove : list of [low, high] pairs
+        Alias windows to mask; None for no mask.
+    freqs : array-like, shape = [n_freqs]
+        Precomputed grid, used instead of fmin, fmax and df to build it.
+    """
+
+    def __init__(self, fmin, fmax, df, freqs_to_remove=None, freqs=None,
+                 mask=None):
+        self.fmin, self.fmax, self.df = float(fmin), float(fmax), float(df)
+        if freqs_to_remove is not None:
+            freqs_to_remove = [[float(pair[0]), float(pair[1])]
+                               for pair in freqs_to_remove]
+        self.freqs_to_remove = freqs_to_remove
+
+        if freqs is None:
+            nf = int(np.ceil((self.fmax - self.fmin) / self.df))
+            freqs = self.fmin + self.df * np.arange(nf)
+        self.freqs = np.asarray(freqs, dtype=np.float64)
+        if mask is None:
+            mask = alias_mask(self.freqs, freqs_to_remove)
+        self.mask = np.asarray(mask, dtype=bool)
+
+        self._views = {}
+
+    @classmethod
+    def from_baseline(cls, baseline, fmin, fmax, samples_per_peak=10,
+                      freqs_to_remove=None):
+        """Grid with samples_per_peak frequencies per 1/baseline."""
+        return cls(fmin, fmax, 1./(samples_per_peak * baseline),
+                   freqs_to_remove=freqs_to_remove)
+
+    @classmethod
+    def from_freqs(cls, freqs, freqs_to_remove=None):
+        """Grid of given frequencies (assumed uniform for df)."""
+        freqs = np.asarray(freqs, dtype=np.float64)
+        df = freqs[1] - freqs[0] if len(freqs) > 1 else 0.0
+        fmin = freqs[0] if len(freqs) > 0 else 0.0
+        fmax = freqs[-1] + df if len(freqs) > 0 else 0.0
+        return cls(fmin, fmax, df, freqs_to_remove=freqs_to_remove,
+                   freqs=freqs)
+
+    def __len__(self):
+        return len(self.freqs)
+
+    @property
+    def has_aliases(self):
+        """Whether any frequency of the grid is masked."""
+        return not self._view('all_kept', lambda: bool(np.all(self.mask)))
+
+    def _view(self, name, func):
+        if not name in self._views:
+            self._views[name] = func()
+        return self._views[name]
+
+    @property
+    def masked(self):
+        """Frequencies outside the alias windows."""
+        return self._view('masked', lambda: self.freqs[self.mask])
+
+    @property
+    def freqs32(self):
+        """Masked frequencies in float32."""
+        return self._view('freqs32', lambda: self.masked.astype(np.float32))
+
+    @property
+    def periods(self):
+        """Periods of the masked frequencies."""
+        return self._view('periods', lambda: 1.0/self.masked)
+
+    @property
+    def periods32(self):
+        """Periods of the masked frequencies in float32."""
+        return self._view('periods32', lambda: self.periods.astype(np.float32))
+
+    def mask_for(self, freqs):
+        """Alias mask of frequencies returned by an engine, the cached one
+        when they are the grid itself."""
+        freqs = np.asarray(freqs)
+        if (len(freqs) == len(self.freqs)) and \
+           ((len(freqs) == 0) or ((freqs[0] == self.freqs[0]) and
+                                  (freqs[-1] == self.freqs[-1]))):
+            return self.mask
+        return alias_mask(freqs, self.freqs_to_remove)
+
+    def key(self):
+        """Cache key of the grid: (fmin, fmax, df, alias windows)."""
+        return grid_key(self.fmin, self.fmax, self.df, self.freqs_to_remove)
+
+    def save(self, filename):
+        """Write the grid and its mask to an hdf5 file."""
+        import h5py
+
+        with h5py.File(filename, 'w') as f:
+            f.create_dataset('freqs', data=self.freqs)
+            f.create_dataset('mask', data=self.mask)
+            f.attrs['fmin'] = self.fmin
+            f.attrs['fmax'] = self.fmax
+            f.attrs['df'] = self.df
+            if self.freqs_to_remove is not None:
+                f.create_dataset('freqs_to_remove',
+                                 data=np.array(self.freqs_to_remove))
+
+    @classmethod
+    def load(cls, filename):
+        """Read a grid written by save."""
+        import h5py
+
+        with h5py.File(filename, 'r') as f:
+            freqs = f['freqs'][:]
+            mask = f['mask'][:]
+            if 'freqs_to_remove' in f:
+                freqs_to_remove = f['freqs_to_remove'][:].tolist()
+            else:
+                freqs_to_remove = None
+            return cls(f.attrs['fmin'], f.attrs['fmax'], f.attrs['df'],
+                       freqs_to_remove=freqs_to_remove, freqs=freqs,
+                       mask=mask)
+
+    @classmethod
+    def cached(cls, cache_dir, fmin, fmax, df, freqs_to_remove=None):
+        """Grid read from cache_dir, computed and written there if it is
+        not cached yet (or cache_dir is None)."""
+
+        if cache_dir is None:
+            return cls(fmin, fmax, df, freqs_to_remove=freqs_to_remove)
+
+        filename = os.path.join(cache_dir, "freqgrid_%s.h5" %
+                                grid_key(fmin, fmax, df, freqs_to_remove))
+        if os.path.isfile(filename):
+            try:
+                return cls.load(filename)
+            except (OSError, KeyError):
+                print('Could not read frequency grid %s, recomputing' % filename)
+
+        grid = cls(fmin, fmax, df, freqs_to_remove=freqs_to_remove)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        # written to a temporary file first, as jobs may share cache_dir
+        tmpfile = "%s.%d.tmp" % (filename, os.getpid())
+        grid.save(tmpfile)
+        os.replace(tmpfile, filename)
+
+        return grid
+
+
+def as_frequency_grid(freqs, freqs_to_remove=None):
+    """FrequencyGrid of freqs, which is returned as is if it already is one."""
+    if isinstance(freqs, FrequencyGrid):
+        return freqs
+    return FrequencyGrid.from_freqs(freqs, freqs_to_remove=freqs_to_remove)
+
+
+def baseline_bins(baselines, ratio=2.0, nbins=8):
+    """Group light curves in bins of baseline a factor ratio wide.
+
+    Bin k holds the baselines in (bmax/ratio**(k+1), bmax/ratio**k],
+    with bmax the longest baseline; the last bin also holds all shorter
+    ones (and empty light curves, of nan baseline).
+
+    Parameters
+    ----------
+    baselines : array-like, shape = [n_lightcurves]
+        Baseline of each light curve.
+    ratio : float
+        Width of the bins, > 1.
+    nbins : int
+        Maximum number of bins.
+
+    Returns
+    -------
+    bins : list of (baseline, indices)
+        For every non-empty bin, from the longest baselines down, its
+        upper edge (which the grid step of the bin should be based on)
+        and the indices of its light curves.
+    """
+
+    if ratio <= 1:
+        raise ValueError('ratio must be larger than 1')
+
+    baselines = np.asarray(baselines, dtype=np.float64)
+    valid = np.isfinite(baselines) & (baselines > 0)
+    if not np.any(valid):
+        return [(np.nan, np.arange(len(baselines)))] if len(baselines) else []
+
+    bmax = np.max(baselines[valid])
+    index = np.full(len(baselines), nbins - 1, dtype=np.int64)
+    # small tolerance so that baselines at an edge stay in the upper bin
+    k = np.floor(np.log(bmax/baselines[valid])/np.log(ratio) + 1e-12)
+    index[valid] = np.clip(k, 0, nbins - 1).astype(np.int64)
+
+    bins = []
+    for k in range(nbins):
+        idx = np.where(index == k)[0]
+        if len(idx) > 0:
+            bins.append((bmax/ratio**k, idx))
+
+    return bins
@@ -0,0 +1,132 @@
+"""
+Local task queue for period search workers.
+
+The queue is a plain text file with one task per line, in the format of
+the quadrant files written by the submission scripts (e.g.
+"job_number field ccd quadrant Ncatindex Ncatalog"). Workers on the same
+machine pop tasks from the top of the file one at a time, with the file
+locked while it is rewritten, so that every task is run exactly once.
+
+The submission scripts fill the queue from their quadrant files and
+start the workers with the job line of their .sub file, in which
+"--quadrant_index $PBS_ARRAYID" is replaced by the queue options (see
+start_worker_queue).
+"""
+
+import os
+import fcntl
+from contextlib import contextmanager
+
+
+@contextmanager
+def _locked(filename):
+    with open(filename + ".lock", 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _read_tasks(filename):
+    if not os.path.isfile(filename):
+        return []
+    with open(filename, 'r') as f:
+        lines = [line.rstrip('\n') for line in f]
+    return [line for line in lines if line.strip() != ""]
+
+
+def _write_tasks(filename, lines):
+    tmpfile = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmpfile, 'w') as f:
+        for line in lines:
+            f.write('%s\n' % line)
+    os.replace(tmpfile, filename)
+
+
+def push_tasks(filename, tasks, overwrite=False):
+    """Add tasks to the end of the queue.
+
+    Parameters
+    ----------
+    filename : str
+        Queue file.
+    tasks : list
+        Tasks, either as lines or as lists of values.
+    overwrite : bool
+        Replace the tasks already in the queue.
+    """
+
+    lines = []
+    for task in tasks:
+        if not isinstance(task, str):
+            task = " ".join([str(x) for x in task])
+        lines.append(task)
+
+    with _locked(filename):
+        if not overwrite:
+            lines = _read_tasks(filename) + lines
+        _write_tasks(filename, lines)
+
+
+def pop_task(filename):
+    """Remove the first task from the queue.
+
+    Returns
+    -------
+    task : list
+        Values of the task line, or None if the queue is empty.
+    """
+
+    with _locked(filename):
+        lines = _read_tasks(filename)
+        if len(lines) == 0:
+            return None
+        _write_tasks(filename, lines[1:])
+
+    return list(filter(None, lines[0].split(" ")))
+
+
+
+QUADRANT_INDEX_OPTION = "--quadrant_index $PBS_ARRAYID"
+
+
+def job_task(row):
+    """Task of a row of a quadrant file (a pandas Series with the columns
+    job_number, field, ccd, quadrant, Ncatindex, Ncatalog and idsFile)."""
+
+    task = [row["job_number"], row["field"], row["ccd"], row["quadrant"],
+            row["Ncatindex"], row["Ncatalog"]]
+    if isinstance(row["idsFile"], str):
+        task.append(row["idsFile"])
+    return task
+
+
+def worker_line(jobline, queuefile):
+    """Command line of a worker reading queuefile, from the job line of a
+    .sub file.
+
+    Raises
+    ------
+    ValueError
+        If the job line does not select its job with
+        "--quadrant_index $PBS_ARRAYID".
+    """
+
+    if not QUADRANT_INDEX_OPTION in jobline:
+        raise ValueError('job line does not contain "%s", cannot turn it '
+                         'into a worker line: %s'
+                         % (QUADRANT_INDEX_OPTION, jobline))
+    return jobline.replace(QUADRANT_INDEX_OPTION,
+                           "--doWorker --queue_file %s" % queuefile)
+
+
+def start_worker_queue(queuefile, jobline, df):
+    """Replace the tasks of queuefile by the jobs of the quadrant file
+    rows df and return the command line of its workers (see worker_line,
+    which is checked before the queue is touched)."""
+
+    workerline = worker_line(jobline, queuefile)
+    push_tasks(queuefile, [job_task(row) for index, row in df.iterrows()],
+               overwrite=True)
+    return workerline
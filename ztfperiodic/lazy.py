@@ -0,0 +1,90 @@
+"""
+Lazy imports of heavy modules.
+
+`lazy_import` returns a module object whose attributes are only looked up,
+and the real module only imported, the first time they are used, e.g.
+
+    sdss = lazy_import('astroquery.sdss')
+    ...
+    xid = sdss.SDSS.query_region(coord, spectro=True)
+
+so that a job only pays for importing astroquery, tensorflow, pyplot, ...
+in the code paths that actually use them. A missing module raises the
+usual ImportError at first use instead of at import.
+"""
+
+import sys
+import types
+import importlib
+
+
+class LazyModule(types.ModuleType):
+    """Placeholder for a module that is imported at first attribute access.
+
+    Parameters
+    ----------
+    name : str
+        Absolute name of the module.
+    """
+
+    def __init__(self, name):
+        super(LazyModule, self).__init__(name)
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        if self.__dict__['_lazy_module'] is None:
+            return "<lazy module '%s' (not loaded)>" % self.__name__
+        return repr(self.__dict__['_lazy_module'])
+
+
+class LazyPyplot(LazyModule):
+    """matplotlib.pyplot, imported with the given backend at first use."""
+
+    def __init__(self, backend='Agg'):
+        super(LazyPyplot, self).__init__('matplotlib.pyplot')
+        self.__dict__['_lazy_backend'] = backend
+
+    def _load(self):
+        if (self.__dict__['_lazy_module'] is None) and \
+           (self.__dict__['_lazy_backend'] is not None) and \
+           (not 'matplotlib.pyplot' in sys.modules):
+            import matplotlib
+            matplotlib.use(self.__dict__['_lazy_backend'])
+        return super(LazyPyplot, self)._load()
+
+
+def lazy_import(name):
+    """Module name, imported at first use (or now if it already is)."""
+
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
+
+def lazy_pyplot(backend='Agg'):
+    """matplotlib.pyplot, imported with backend at first use."""
+
+    if 'matplotlib.pyplot' in sys.modules:
+        return sys.modules['matplotlib.pyplot']
+    return LazyPyplot(backend=backend)
+
+
+def loaded(module):
+    """Whether a module returned by lazy_import has been imported."""
+
+    if isinstance(module, LazyModule):
+        return module.__dict__['_lazy_module'] is not None
+    return True
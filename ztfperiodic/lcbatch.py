@@ -0,0 +1,345 @@
+"""
+Columnar container for a batch of light curves.
+
+The loaders in `ztfperiodic.utils` return a list of (hjd, mag, magerr)
+tuples together with six parallel lists of metadata. `LightcurveBatch`
+stores the same information as three concatenated arrays plus an offsets
+array, with one metadata column per quantity, so that a quadrant of
+sources costs three numpy arrays rather than one small tuple per object.
+
+Indexing a batch with an integer returns the usual (hjd, mag, magerr)
+tuple of views, so that code written for the list of tuples (e.g.
+`find_periods`) keeps working unchanged.
+
+`map_batch` runs a function over contiguous pieces of a batch in
+parallel processes. The concatenated arrays are written once to files
+in shared memory (/dev/shm when available), which the workers memory-map,
+so that each task only sends an index range instead of pickling the
+light curves.
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+class LightcurveBatch(object):
+    """A batch of light curves stored as concatenated arrays.
+
+    Attributes
+    ----------
+    time, mag, magerr : array-like, shape = [n_samples]
+        Concatenated light curves.
+    offsets : array-like, shape = [n_lightcurves + 1]
+        Light curve ii is time[offsets[ii]:offsets[ii+1]].
+    ra, dec : array-like, shape = [n_lightcurves]
+        Coordinates in degrees.
+    filters : list
+        Filters of each light curve.
+    ids : array-like, shape = [n_lightcurves]
+        Object ids.
+    absmags : array-like, shape = [n_lightcurves, 3]
+    bp_rps : array-like, shape = [n_lightcurves, 2]
+    names : array-like, shape = [n_lightcurves]
+        Object names.
+    baseline : float
+        Longest time span of the batch.
+    """
+
+    def __init__(self, time, mag, magerr, offsets,
+                 ra=None, dec=None, filters=None, ids=None,
+                 absmags=None, bp_rps=None, names=None, baseline=None):
+
+        self.time = np.asarray(time)
+        self.mag = np.asarray(mag)
+        self.magerr = np.asarray(magerr)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+        nlc = len(self.offsets) - 1
+        if ra is None:
+            ra = np.nan*np.ones(nlc)
+        if dec is None:
+            dec = np.nan*np.ones(nlc)
+        if filters is None:
+            filters = [[] for ii in range(nlc)]
+        if ids is None:
+            ids = np.arange(nlc)
+        if absmags is None:
+            absmags = np.nan*np.ones((nlc, 3))
+        if bp_rps is None:
+            bp_rps = np.nan*np.ones((nlc, 2))
+        if names is None:
+            names = np.array([str(x) for x in ids])
+
+        self.ra = np.asarray(ra, dtype=np.float64)
+        self.dec = np.asarray(dec, dtype=np.float64)
+        self.filters = list(filters)
+        self.ids = np.asarray(ids)
+        self.absmags = np.asarray(absmags, dtype=np.float64).reshape(nlc, 3)
+        self.bp_rps = np.asarray(bp_rps, dtype=np.float64).reshape(nlc, 2)
+        self.names = np.asarray(names)
+
+        if baseline is None:
+            baseline = 0.0
+            if nlc > 0:
+                baseline = np.max(self.time_max() - self.time_min())
+        self.baseline = baseline
+
+    @classmethod
+    def from_lists(cls, lightcurves, coordinates=None, filters=None,
+                   ids=None, absmags=None, bp_rps=None, names=None,
+                   baseline=None):
+        """Build a batch from the lists returned by the loaders.
+
+        The arguments are in the order the loaders return them, so that
+        ``LightcurveBatch.from_lists(*get_matchfile(f))`` works.
+        """
+
+        if isinstance(lightcurves, LightcurveBatch):
+            return lightcurves
+
+        lengths = np.array([len(lc[0]) for lc in lightcurves], dtype=np.int64)
+        offsets = np.zeros(len(lengths)+1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+
+        if len(lightcurves) > 0:
+            time = np.concatenate([np.asarray(lc[0]) for lc in lightcurves])
+            mag = np.concatenate([np.asarray(lc[1]) for lc in lightcurves])
+            magerr = np.concatenate([np.asarray(lc[2]) for lc in lightcurves])
+        else:
+            time, mag, magerr = np.empty(0), np.empty(0), np.empty(0)
+
+        ra, dec = None, None
+        if coordinates is not None:
+            coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+            ra, dec = coordinates[:,0], coordinates[:,1]
+
+        return cls(time, mag, magerr, offsets,
+                   ra=ra, dec=dec, filters=filters, ids=ids,
+                   absmags=absmags, bp_rps=bp_rps, names=names,
+                   baseline=baseline)
+
+    def to_lists(self):
+        """Return the batch in the loaders' list format."""
+
+        return (list(self), self.coordinates, list(self.filters),
+                list(self.ids), self.absmags.tolist(), self.bp_rps.tolist(),
+                list(self.names), self.baseline)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for ii in range(len(self)):
+            yield self._lightcurve(ii)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key = key + len(self)
+            if (key < 0) or (key >= len(self)):
+                raise IndexError("light curve index out of range")
+            return self._lightcurve(key)
+        return self.take(np.arange(len(self))[key])
+
+    def _lightcurve(self, ii):
+        start, stop = self.offsets[ii], self.offsets[ii+1]
+        return (self.time[start:stop], self.mag[start:stop],
+                self.magerr[start:stop])
+
+    @property
+    def lengths(self):
+        """Number of samples of each light curve."""
+        return np.diff(self.offsets)
+
+    @property
+    def segment_ids(self):
+        """Light curve index of every sample."""
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    @property
+    def coordinates(self):
+        """List of (ra, dec) tuples."""
+        return list(zip(self.ra, self.dec))
+
+    def time_min(self):
+        """Earliest time of each light curve (nan if empty)."""
+        return self._reduce(np.minimum, self.time)
+
+    def time_max(self):
+        """Latest time of each light curve (nan if empty)."""
+        return self._reduce(np.maximum, self.time)
+
+    def _reduce(self, ufunc, values):
+        out = np.nan*np.ones(len(self))
+        nonempty = self.lengths > 0
+        if np.any(nonempty):
+            out[nonempty] = ufunc.reduceat(values, self.offsets[:-1][nonempty])
+        return out
+
+    def take(self, idx):
+        """Return a new batch with the light curves at positions idx."""
+
+        idx = np.asarray(idx)
+        if idx.dtype == bool:
+            idx = np.where(idx)[0]
+        idx = idx.astype(np.int64)
+
+        lengths = self.lengths[idx]
+        offsets = np.zeros(len(idx)+1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+
+        # gather all samples at once rather than light curve by light curve
+        rows = np.repeat(self.offsets[idx] - offsets[:-1], lengths) + \
+            np.arange(offsets[-1])
+
+        return LightcurveBatch(self.time[rows], self.mag[rows],
+                               self.magerr[rows], offsets,
+                               ra=self.ra[idx], dec=self.dec[idx],
+                               filters=[self.filters[ii] for ii in idx],
+                               ids=self.ids[idx],
+                               absmags=self.absmags[idx],
+                               bp_rps=self.bp_rps[idx],
+                               names=self.names[idx],
+                               baseline=self.baseline)
+
+    def select(self, keep):
+        """Return a new batch with only the samples where keep is True,
+        e.g. keep = ztfperiodic.cadence.thin_cadence(batch.time,
+        batch.offsets); light curves left empty are kept."""
+
+        keep = np.asarray(keep, dtype=bool)
+        counts = np.zeros(len(keep)+1, dtype=np.int64)
+        counts[1:] = np.cumsum(keep)
+        offsets = counts[self.offsets]
+
+        return LightcurveBatch(self.time[keep], self.mag[keep],
+                               self.magerr[keep], offsets,
+                               ra=self.ra, dec=self.dec,
+                               filters=self.filters, ids=self.ids,
+                               absmags=self.absmags, bp_rps=self.bp_rps,
+                               names=self.names, baseline=self.baseline)
+
+    def padded(self, fill=0.0):
+        """(time, mag, magerr, lengths), with one light curve per row of
+        arrays of shape (n_lightcurves, max_length) padded with fill."""
+
+        lengths = self.lengths
+        maxn = int(np.max(lengths)) if len(self) > 0 else 0
+        rows = self.segment_ids
+        cols = np.arange(len(self.time)) - np.repeat(self.offsets[:-1], lengths)
+
+        out = []
+        for values in [self.time, self.mag, self.magerr]:
+            arr = np.full((len(self), maxn), fill, dtype=np.float64)
+            arr[rows, cols] = values
+            out.append(arr)
+
+        return out[0], out[1], out[2], lengths
+
+    def slice(self, start, stop):
+        """Return a batch of the light curves start to stop, sharing the
+        sample arrays of this batch (no copy)."""
+
+        offsets = self.offsets[start:stop+1]
+        first, last = offsets[0], offsets[-1]
+
+        return LightcurveBatch(self.time[first:last], self.mag[first:last],
+                               self.magerr[first:last], offsets - first,
+                               ra=self.ra[start:stop], dec=self.dec[start:stop],
+                               filters=self.filters[start:stop],
+                               ids=self.ids[start:stop],
+                               absmags=self.absmags[start:stop],
+                               bp_rps=self.bp_rps[start:stop],
+                               names=self.names[start:stop],
+                               baseline=self.baseline)
+
+
+SHARED_ARRAYS = ["time", "mag", "magerr", "offsets"]
+
+# the shared batch last mapped by this process
+_shared = {"dirname": None, "batch": None}
+
+
+def share_batch(batch, tmpdir=None):
+    """Write the arrays of a batch to a new directory for load_shared_batch.
+
+    The directory is created in /dev/shm if it exists (unless tmpdir is
+    given), and has to be removed by the caller.
+    """
+
+    if (tmpdir is None) and os.path.isdir('/dev/shm'):
+        tmpdir = '/dev/shm'
+    dirname = tempfile.mkdtemp(prefix='lcbatch_', dir=tmpdir)
+    for name in SHARED_ARRAYS:
+        np.save(os.path.join(dirname, '%s.npy' % name), getattr(batch, name))
+    return dirname
+
+
+def load_shared_batch(dirname):
+    """LightcurveBatch memory-mapping the arrays written by share_batch
+    (metadata columns are not shared)."""
+
+    if _shared["dirname"] != dirname:
+        arrays = [np.load(os.path.join(dirname, '%s.npy' % name),
+                          mmap_mode='r') for name in SHARED_ARRAYS]
+        # only one mapping is kept, so that removed files are released
+        _shared["batch"] = LightcurveBatch(*arrays)
+        _shared["dirname"] = dirname
+    return _shared["batch"]
+
+
+def _map_piece(func, dirname, start, stop, args, kwargs):
+    batch = load_shared_batch(dirname).slice(start, stop)
+    return func(batch, *args, **kwargs)
+
+
+def map_batch(func, batch, args=(), kwargs=None, Ncore=8, nchunks=None,
+              tmpdir=None):
+    """Apply func to contiguous pieces of a batch with Ncore processes.
+
+    Parameters
+    ----------
+    func : callable
+        Called as func(piece, *args_piece, **kwargs), where piece is a
+        LightcurveBatch of consecutive light curves.
+    batch : LightcurveBatch or list
+        Light curves.
+    args : list
+        Per light curve arguments (e.g. periods), sliced like the batch.
+    kwargs : dict
+        Arguments passed unchanged to every call.
+    Ncore : int
+        Number of processes.
+    nchunks : int
+        Number of pieces (default 4*Ncore).
+
+    Returns
+    -------
+    results : list
+        Return values of func, in the order of the pieces.
+    """
+
+    batch = LightcurveBatch.from_lists(batch)
+    if kwargs is None:
+        kwargs = {}
+    if nchunks is None:
+        nchunks = 4*Ncore
+    nchunks = max(min(nchunks, len(batch)), 1)
+
+    bounds = np.linspace(0, len(batch), nchunks+1).astype(int)
+    if (Ncore <= 1) or (nchunks == 1):
+        return [func(batch.slice(start, stop),
+                     *[arg[start:stop] for arg in args], **kwargs)
+                for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    from joblib import Parallel, delayed
+    dirname = share_batch(batch, tmpdir=tmpdir)
+    try:
+        results = Parallel(n_jobs=Ncore)(delayed(_map_piece)(func, dirname, start, stop, [arg[start:stop] for arg in args], kwargs) for start, stop in zip(bounds[:-1], bounds[1:]))
+    finally:
+        shutil.rmtree(dirname, ignore_errors=True)
+
+    return results
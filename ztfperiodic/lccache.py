@@ -0,0 +1,400 @@
+"""
+On-disk cache of Kowalski query results.
+
+ZTF_sources documents are decoded into columnar detection arrays (see
+`documents_to_columns`), which is also the format the Kowalski loaders
+work on. The detections are stored unfiltered as HDF5 shards (one per
+query, e.g. one page of a field/ccd/quadrant), so that reruns of a
+quadrant with different algorithms, thresholds or program ids read the
+light curves from disk instead of Kowalski. Shards are indexed by objid,
+so that objid queries are served from any shard that already holds the
+object. Other query responses (e.g. cone searches) are pickled as they
+are.
+
+A JSON manifest in the cache directory records the size and last access
+time of every entry; the least recently used entries are removed when
+the cache grows beyond its disk budget. Entries evicted by another job
+between the manifest lookup and the read are misses.
+"""
+
+import os
+import json
+import atexit
+import time
+import fcntl
+import pickle
+import threading
+import hashlib
+import operator
+from contextlib import contextmanager
+
+import numpy as np
+import h5py
+
+DETECTION_COLUMNS = ["hjd", "mag", "magerr", "ra", "dec",
+                     "programid", "catflags"]
+DETECTION_DTYPES = {"programid": np.int64, "catflags": np.int64}
+
+
+def _tmpfile(filename):
+    # unique per process and thread, as the loaders may fill the cache
+    # from concurrent queries
+    return "%s.%d.%d.tmp" % (filename, os.getpid(), threading.get_ident())
+
+
+def query_key(*args):
+    """Cache key of a query made of the given parameters."""
+
+    key = "_".join([str(x) for x in args])
+    if len(key) > 100:
+        key = key[:60] + "_" + hashlib.md5(key.encode()).hexdigest()
+    return "".join([c if (c.isalnum() or c in "_-.") else "_" for c in key])
+
+
+class LightcurveCache(object):
+    """Persistent cache of Kowalski light curves and query responses.
+
+    Hits only record their access time in memory; the times are written
+    to the manifest with the next entry added by this process, or by
+    flush (called at exit), so that the eviction order is approximately
+    least recently used without a manifest rewrite per hit.
+
+    Parameters
+    ----------
+    directory : str
+        Cache directory, created if needed.
+    max_size : float
+        Disk budget in GB.
+    """
+
+    def __init__(self, directory, max_size=50.0):
+        self.directory = directory
+        self.max_bytes = int(max_size*1e9)
+        self.manifest_file = os.path.join(directory, "manifest.json")
+        self.lock_file = os.path.join(directory, "manifest.lock")
+
+        # manifest as last read, and the stat of the file it was read from
+        self._manifest_cache = {}
+        self._manifest_stat = None
+        # access times not written to the manifest yet
+        self._accessed = {}
+        # objid -> (key, row) of the sources shards, and the ids of each
+        # indexed shard
+        self._index = {}
+        self._index_ids = {}
+        self._thread_lock = threading.RLock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        atexit.register(self.flush)
+
+    @contextmanager
+    def _locked(self):
+        # jobs sharing the cache update the manifest one at a time
+        with open(self.lock_file, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_manifest(self):
+        if not os.path.isfile(self.manifest_file):
+            return {}
+        try:
+            with open(self.manifest_file, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            # a job died while writing; the shards are still on disk
+            # but are rebuilt on the next miss
+            return {}
+
+    def _write_manifest(self, manifest):
+        tmpfile = "%s.%d.tmp" % (self.manifest_file, os.getpid())
+        with open(tmpfile, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmpfile, self.manifest_file)
+
+    def _manifest(self):
+        # the manifest is only parsed again when a job has replaced it
+        try:
+            st = os.stat(self.manifest_file)
+        except FileNotFoundError:
+            return {}
+        stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with self._thread_lock:
+            if stat != self._manifest_stat:
+                self._manifest_cache = self._read_manifest()
+                self._manifest_stat = stat
+            return self._manifest_cache
+
+    def _touch(self, keys):
+        now = time.time()
+        with self._thread_lock:
+            for key in keys:
+                self._accessed[key] = now
+
+    def _apply_accessed(self, manifest):
+        with self._thread_lock:
+            accessed, self._accessed = self._accessed, {}
+        for key in accessed:
+            if key in manifest:
+                manifest[key]["last_access"] = max(
+                    manifest[key]["last_access"], accessed[key])
+
+    def flush(self):
+        """Write the access times of the hits of this process to the
+        manifest."""
+
+        if len(self._accessed) == 0:
+            return
+        with self._locked():
+            manifest = self._read_manifest()
+            self._apply_accessed(manifest)
+            self._write_manifest(manifest)
+
+    def _add(self, key, filename, kind):
+        with self._locked():
+            manifest = self._read_manifest()
+            self._apply_accessed(manifest)
+            manifest[key] = {"file": os.path.basename(filename),
+                             "kind": kind,
+                             "nbytes": os.path.getsize(filename),
+                             "last_access": time.time()}
+
+            # evict least recently used entries, but never the new one
+            keys = sorted(manifest.keys(),
+                          key=lambda k: manifest[k]["last_access"])
+            total = np.sum([manifest[k]["nbytes"] for k in keys])
+            for oldkey in keys:
+                if (total <= self.max_bytes) or (oldkey == key):
+                    continue
+                oldfile = os.path.join(self.directory,
+                                       manifest[oldkey]["file"])
+                if os.path.isfile(oldfile):
+                    os.remove(oldfile)
+                total = total - manifest[oldkey]["nbytes"]
+                del manifest[oldkey]
+
+            self._write_manifest(manifest)
+
+    def _entry(self, key, kind):
+        entry = self._manifest().get(key)
+        if (entry is None) or (entry["kind"] != kind):
+            return None
+        return os.path.join(self.directory, entry["file"])
+
+    def get_response(self, key):
+        """Return the cached response of query key, or None."""
+
+        filename = self._entry(key, "response")
+        if filename is None:
+            return None
+        try:
+            with open(filename, 'rb') as f:
+                response = pickle.load(f)
+        except FileNotFoundError:
+            # evicted by another job since the manifest was read
+            return None
+        self._touch([key])
+        return response
+
+    def put_response(self, key, response):
+        """Cache the response of query key."""
+
+        filename = os.path.join(self.directory, "%s.pkl" % key)
+        tmpfile = _tmpfile(filename)
+        with open(tmpfile, 'wb') as f:
+            pickle.dump(response, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpfile, filename)
+        self._add(key, filename, "response")
+
+    def _read_sources(self, key):
+        filename = self._entry(key, "sources")
+        if filename is None:
+            return None
+        try:
+            with h5py.File(filename, 'r') as f:
+                return {k: f[k][:] for k in f}
+        except FileNotFoundError:
+            # evicted by another job since the manifest was read
+            return None
+
+    def get_sources(self, key):
+        """Return the decoded ZTF_sources detections of query key, or None."""
+
+        columns = self._read_sources(key)
+        if columns is None:
+            return None
+        self._touch([key])
+        return columns
+
+    def put_sources(self, key, columns):
+        """Cache the decoded ZTF_sources detections returned by query key
+        (see documents_to_columns)."""
+
+        filename = os.path.join(self.directory, "%s.h5" % key)
+        tmpfile = _tmpfile(filename)
+        with h5py.File(tmpfile, 'w') as f:
+            for k in columns:
+                f.create_dataset(k, data=columns[k])
+        os.replace(tmpfile, filename)
+        self._add(key, filename, "sources")
+        with self._thread_lock:
+            self._index_shard(key, columns["ids"])
+
+    def _index_shard(self, key, ids):
+        self._unindex_shard(key)
+        self._index_ids[key] = ids
+        for ii, objid in enumerate(ids):
+            self._index[int(objid)] = (key, ii)
+
+    def _unindex_shard(self, key):
+        for objid in self._index_ids.pop(key, []):
+            if self._index.get(int(objid), (None,))[0] == key:
+                del self._index[int(objid)]
+
+    def _objid_index(self):
+        # brought up to date with the manifest: only the shards added by
+        # other jobs are opened, and evicted ones are dropped
+        manifest = self._manifest()
+        with self._thread_lock:
+            keys = [key for key in manifest
+                    if manifest[key]["kind"] == "sources"]
+            for key in set(self._index_ids) - set(keys):
+                self._unindex_shard(key)
+            for key in keys:
+                if key in self._index_ids:
+                    continue
+                filename = os.path.join(self.directory, manifest[key]["file"])
+                try:
+                    with h5py.File(filename, 'r') as f:
+                        ids = f["ids"][:]
+                except (IOError, OSError, KeyError):
+                    ids = np.array([], dtype=np.int64)
+                self._index_shard(key, ids)
+            return self._index
+
+    def find_sources(self, objids):
+        """Look up decoded ZTF_sources detections by objid.
+
+        Returns
+        -------
+        columns : dict
+            Cached detections of the objids found.
+        missing : list
+            objids that are not in the cache.
+        """
+
+        index = self._objid_index()
+        byshard, missing = {}, []
+        for objid in objids:
+            if int(objid) in index:
+                key, ii = index[int(objid)]
+                byshard.setdefault(key, []).append((ii, objid))
+            else:
+                missing.append(objid)
+
+        found, hits = [], []
+        for key in byshard:
+            columns = self._read_sources(key)
+            if columns is None:
+                with self._thread_lock:
+                    self._unindex_shard(key)
+                missing.extend([objid for ii, objid in byshard[key]])
+                continue
+            found.append(take_columns(columns,
+                                      [ii for ii, objid in byshard[key]]))
+            hits.append(key)
+        self._touch(hits)
+
+        return concatenate_columns(found), missing
+
+
+def documents_to_columns(documents):
+    """Decode ZTF_sources documents into concatenated detection arrays.
+
+    Returns a dict with one entry per object for ids and filter, the
+    offsets (object ii holds detections offsets[ii]:offsets[ii+1]) and one
+    array per detection field. Missing values are nan, or -1 for the
+    integer fields.
+    """
+
+    nobj = len(documents)
+    lengths = np.fromiter((len(doc["data"]) for doc in documents),
+                          dtype=np.int64, count=nobj)
+    columns = {"ids": np.fromiter((doc["_id"] for doc in documents),
+                                  dtype=np.int64, count=nobj),
+               "filter": np.fromiter((doc["filter"] for doc in documents),
+                                     dtype=np.int64, count=nobj),
+               "offsets": np.append(0, np.cumsum(lengths))}
+
+    # a single pass over the detection dicts, everything else is numpy
+    getter = operator.itemgetter(*DETECTION_COLUMNS)
+    try:
+        rows = [getter(dic) for doc in documents for dic in doc["data"]]
+    except KeyError:
+        rows = [tuple([dic.get(col) for col in DETECTION_COLUMNS])
+                for doc in documents for dic in doc["data"]]
+    values = np.array(rows, dtype=np.float64).reshape(-1,
+                                                      len(DETECTION_COLUMNS))
+
+    for jj, col in enumerate(DETECTION_COLUMNS):
+        if col in DETECTION_DTYPES:
+            column = np.where(np.isnan(values[:,jj]), -1, values[:,jj])
+            columns[col] = column.astype(DETECTION_DTYPES[col])
+        else:
+            columns[col] = np.ascontiguousarray(values[:,jj])
+    return columns
+
+
+def empty_columns():
+    """Decoded detection arrays of zero objects."""
+    return documents_to_columns([])
+
+
+def concatenate_columns(columns_list):
+    """Concatenate decoded detection arrays."""
+
+    if len(columns_list) == 0:
+        return empty_columns()
+    columns = {}
+    for key in ["ids", "filter"] + DETECTION_COLUMNS:
+        columns[key] = np.concatenate([c[key] for c in columns_list])
+    lengths = np.concatenate([np.diff(c["offsets"]) for c in columns_list])
+    columns["offsets"] = np.append(0, np.cumsum(lengths))
+    return columns
+
+
+def take_columns(columns, rows):
+    """Decoded detection arrays of the objects at positions rows."""
+
+    rows = np.asarray(rows, dtype=np.int64)
+    offsets = columns["offsets"]
+    lengths = np.diff(offsets)[rows]
+    new_offsets = np.append(0, np.cumsum(lengths))
+    idx = np.repeat(offsets[:-1][rows] - new_offsets[:-1], lengths) + \
+        np.arange(new_offsets[-1])
+
+    out = {"ids": columns["ids"][rows], "filter": columns["filter"][rows],
+           "offsets": new_offsets}
+    for col in DETECTION_COLUMNS:
+        out[col] = columns[col][idx]
+    return out
+
+
+def select_detections(columns, keep):
+    """Decoded detection arrays with only the detections where keep is
+    True; objects left without detections are kept with zero length."""
+
+    offsets = columns["offsets"]
+    nobj = len(offsets) - 1
+    seg = np.repeat(np.arange(nobj), np.diff(offsets))
+    lengths = np.bincount(seg[keep], minlength=nobj)
+
+    out = {"ids": columns["ids"], "filter": columns["filter"],
+           "offsets": np.append(0, np.cumsum(lengths))}
+    for col in DETECTION_COLUMNS:
+        out[col] = columns[col][keep]
+    return out
@@ -15,9 +15,13 @@ import numpy as np
 
 from scipy.stats import anderson, shapiro
 import scipy.optimize
+import scipy.special
+import scipy.stats
 from scipy.optimize import curve_fit
 from scipy.signal import sawtooth
 
+from ztfperiodic.lcbatch import LightcurveBatch
+
 def calc_weighted_mean_std(mag,w):
     """ Calculate the weighted mean and std values
 
@@ -140,41 +144,163 @@ def sawtooth_decomposition(t,y,dy,p):
 
 def fourier_decomposition(t,y,dy,p,maxNterms=5,relative_output=True):
 
-    N = np.size(y)
+    offsets = np.array([0, np.size(y)])
+    out = fourier_decomposition_batch(t, y, dy, offsets, [p],
+                                      maxNterms=maxNterms,
+                                      relative_output=relative_output)[0]
+    if np.isnan(out[0]):
+        raise ValueError("Fourier decomposition failed")
 
-    f = make_f(p=p)
-    chi2 = np.zeros(maxNterms+1,dtype=float) # fill in later
-    pars = np.zeros((maxNterms+2,(maxNterms+1)*2)) # fill in later
+    return out
 
-    
-    init = np.array([np.median(y),0.000001]) # the initial values for the minimiser
-    #print(t,y,dy,init)
-    for i,Nterms in enumerate(np.arange(maxNterms+1.,dtype=int)):
-        popt, pcov = curve_fit(make_f(p), # function
-            t, y, # t,dy
-            init, # initial values [1.0]*2
-            sigma=dy # dy
-            )
-
-        init = np.r_[init,0.1*np.ones(2)]
-
-        pars[i,:2*(i+1)] = popt
-        # make the model
-        model = f(t, *popt)
-        chi2[i] = np.sum(((y-model)/dy)**2)
 
-    # calc BICs
-    BIC = chi2 + np.log(N)* (2+2*np.arange(maxNterms+1,dtype=float))
-    best = np.argmin(BIC)
-    
-    power = (chi2[0]-chi2[best])/chi2[0]
-    bestBIC = BIC[best]
-    bestpars = pars[best,:]
+def fourier_decomposition_batch(t, y, dy, offsets, periods, maxNterms=5,
+                                relative_output=True, block_size=2**16):
+    """ Fourier decomposition of a batch of light curves
+
+    The model of make_f (offset, slope and Fourier terms) is linear in its
+    parameters, so the fits for 0..maxNterms harmonics are the nested
+    weighted least-squares solutions of a single design matrix. They all
+    follow from one Cholesky factorization of its normal matrix.
+
+    Parameters
+    ----------
+    t, y, dy : 1D-array
+        concatenated times, magnitudes and errors
+    offsets : 1D-array
+        light curve ii is t[offsets[ii]:offsets[ii+1]]
+    periods : 1D-array
+        period of each light curve
+    maxNterms : int
+        maximum number of harmonics
+    relative_output : bool
+        convert the Fourier components with AB2AmpPhi
+    block_size : int
+        approximate number of samples processed at once
+
+    Returns
+    -------
+    results : 2D-array
+
+        array of shape (n_lightcurves, 2*maxNterms+4), with the same
+        columns as fourier_decomposition; rows of failed fits are nan
+
+    """
+
+    t = np.asarray(t, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    dy = np.asarray(dy, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    periods = np.asarray(periods, dtype=np.float64).flatten()
+
+    nlc = len(offsets) - 1
+    npars = 2*(maxNterms+1)
+    out = np.nan*np.ones((nlc, npars+2))
+
+    # split the light curves into blocks of about block_size samples
+    starts = [0]
+    while starts[-1] < nlc:
+        stop = np.searchsorted(offsets, offsets[starts[-1]] + block_size,
+                               side='right') - 1
+        starts.append(max(stop, starts[-1]+1))
+
+    for start, stop in zip(starts[:-1], starts[1:]):
+        out[start:stop] = _fourier_decomposition_block(
+            t, y, dy, offsets[start:stop+1], periods[start:stop],
+            maxNterms)
 
     if relative_output:
-        bestpars[2:] = AB2AmpPhi(bestpars[2:])
+        out[:,4:] = AB2AmpPhi_batch(out[:,4:])
+
+    return out
+
+
+def _fourier_decomposition_block(t, y, dy, offsets, periods, maxNterms):
+
+    npars = 2*(maxNterms+1)
+    nlc = len(offsets) - 1
+    lo, hi = offsets[0], offsets[-1]
+    t, y, dy = t[lo:hi], y[lo:hi], dy[lo:hi]
+    offsets = offsets - lo
+    N = np.diff(offsets)
+    seg = np.repeat(np.arange(nlc), N)
+
+    # fits with fewer points than parameters fail, as with curve_fit
+    finite = np.isfinite(t) & np.isfinite(y) & np.isfinite(dy) & (dy > 0)
+    good = (N >= npars) & np.isfinite(periods) & (periods != 0)
+    good &= np.bincount(seg, weights=~finite, minlength=nlc) == 0
+    use = good[seg]
+
+    out = np.nan*np.ones((nlc, npars+2))
+    if not np.any(good):
+        return out
+
+    tt = np.where(use, t, 0.0)
+    w = np.where(use, 1.0/np.where(use, dy, 1.0), 0.0)
+    nonempty = N > 0
+    idx = offsets[:-1][nonempty]
+
+    # the slope column is scaled by the time span for a better
+    # conditioned normal matrix, and rescaled at the end
+    tmin, tspan = np.zeros(nlc), np.ones(nlc)
+    tmin[nonempty] = np.minimum.reduceat(tt, idx)
+    tspan[nonempty] = np.maximum.reduceat(tt, idx) - tmin[nonempty]
+    tspan[tspan == 0] = 1.0
+
+    A = np.empty((len(t), npars))
+    A[:,0] = 1.0
+    A[:,1] = (tt - tmin[seg])/tspan[seg]
+    phi = 2*np.pi*tt/np.where(good, periods, 1.0)[seg]
+    for n in range(1, maxNterms+1):
+        A[:,2*n] = np.cos(n*phi)
+        A[:,2*n+1] = np.sin(n*phi)
+    Aw = A*w[:,None]
+    bw = np.where(use, y, 0.0)*w
+
+    G = np.zeros((nlc, npars, npars))
+    c = np.zeros((nlc, npars))
+    G[nonempty] = np.add.reduceat(Aw[:,:,None]*Aw[:,None,:], idx, axis=0)
+    c[nonempty] = np.add.reduceat(Aw*bw[:,None], idx, axis=0)
+    G[~good] = np.eye(npars)
+
+    try:
+        L = np.linalg.cholesky(G)
+    except np.linalg.LinAlgError:
+        L = np.zeros(G.shape)
+        for jj in range(nlc):
+            try:
+                L[jj] = np.linalg.cholesky(G[jj])
+            except np.linalg.LinAlgError:
+                L[jj] = np.eye(npars)
+                good[jj] = False
+    z = np.linalg.solve(L, c[:,:,None])[:,:,0]
+
+    # the fit with Nterms harmonics uses the leading 2+2*Nterms columns,
+    # whose Cholesky factor is the leading block of L
+    chi2 = np.zeros((nlc, maxNterms+1))
+    pars = np.zeros((nlc, maxNterms+1, npars))
+    for i in range(maxNterms+1):
+        k = 2*(i+1)
+        x = np.linalg.solve(np.transpose(L[:,:k,:k], (0,2,1)),
+                            z[:,:k,None])[:,:,0]
+        pars[:,i,:k] = x
+        resid = bw - np.sum(Aw[:,:k]*x[seg], axis=1)
+        chi2[:,i] = np.bincount(seg, weights=resid**2, minlength=nlc)
+
+    # calc BICs
+    with np.errstate(divide='ignore', invalid='ignore'):
+        BIC = chi2 + np.log(N)[:,None]*(2+2*np.arange(maxNterms+1,dtype=float))
+        best = np.argmin(BIC, axis=1)
+        jj = np.arange(nlc)
+
+        power = (chi2[:,0]-chi2[jj,best])/chi2[:,0]
+        bestBIC = BIC[jj,best]
+        bestpars = pars[jj,best,:]
+        bestpars[:,1] = bestpars[:,1]/tspan
+
+    out[good] = np.c_[power,bestBIC,bestpars][good]
 
-    return np.r_[power,bestBIC,bestpars]
+    return out
 
 
 
@@ -210,6 +336,30 @@ def AB2AmpPhi(input_arr):
     return arr
 
 
+def AB2AmpPhi_batch(input_arr):
+    """ AB2AmpPhi applied to every row of a 2D-array
+    """
+
+    arr = np.array(input_arr, dtype=float)
+
+    # convert A,B to amp and phi
+    amp = np.sqrt(arr[:,0::2]**2 + arr[:,1::2]**2)
+    phi = np.arctan2(arr[:,0::2], arr[:,1::2])
+    arr[:,0::2] = amp
+    arr[:,1::2] = phi
+
+    # normalise
+    with np.errstate(divide='ignore', invalid='ignore'):
+        arr[:,2::2] /= arr[:,0:1] # normalise amplitudes
+
+    # report phase shift
+    maxk = int(arr.shape[1]/2)
+    for k in range(2,maxk+1,1):
+        arr[:,k*2-1] = (arr[:,k*2-1]/k-arr[:,1])/(2.*np.pi/k)%1
+
+    return arr
+
+
 
 def make_f(p):
     """ Function that returns a fourier function for period p
@@ -243,7 +393,15 @@ def make_f(p):
 
 
 
-def calc_basic_stats(t,mag,err):
+def calc_basic_stats(t,mag=None,err=None):
+    """ Calculate the basic (non-periodic) light curve statistics
+
+    t can also be a LightcurveBatch, in which case mag and err are
+    ignored and an array of shape (n_lightcurves, 22) is returned.
+    """
+
+    if isinstance(t, LightcurveBatch):
+        return calc_basic_stats_batch(t.time, t.mag, t.magerr, t.offsets)
 
     N = np.size(mag)
 
@@ -278,6 +436,260 @@ def calc_basic_stats(t,mag,err):
                 WelchI,StetsonJ,StetsonK,AD,SW]
 
 
+def calc_basic_stats_batch(t, mag, err, offsets):
+    """ Calculate the basic light curve statistics of a batch of light curves
+
+    Same statistics as calc_basic_stats, computed with segment sums over
+    the concatenated arrays. The order statistics (median, percentiles,
+    Anderson-Darling and Shapiro-Wilk) come from one sort of the whole
+    batch rather than one sort per light curve.
+
+    Parameters
+    ----------
+    t, mag, err : 1D-array
+        concatenated times, magnitudes and errors
+    offsets : 1D-array
+        light curve ii is t[offsets[ii]:offsets[ii+1]]
+
+    Returns
+    -------
+    results : 2D-array
+
+        array of shape (n_lightcurves, 22), with the same columns as
+        calc_basic_stats; statistics that are undefined for a light curve
+        (e.g. Shapiro-Wilk with less than 3 points) are nan
+
+    """
+
+    t = np.asarray(t, dtype=np.float64)
+    mag = np.asarray(mag, dtype=np.float64)
+    err = np.asarray(err, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+
+    nlc = len(offsets) - 1
+    N = np.diff(offsets)
+    seg = np.repeat(np.arange(nlc), N)
+
+    def segsum(x, idx=seg):
+        return np.bincount(idx, weights=x, minlength=nlc)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Nf = N.astype(np.float64)
+
+        # basic stats
+        sorted_mag = mag[_segment_argsort(mag, seg)]
+        median = _segment_median(sorted_mag, offsets)
+        w = err**-2
+        sumw = segsum(w)
+        wmean = segsum(w*mag)/sumw
+        dev = mag - wmean[seg]
+        wstd = np.sqrt(segsum(w*dev**2)/sumw)
+        chi2red = segsum(dev**2*w)/(Nf-1)
+        absdev = np.abs(mag-median[seg])
+        RoMS = segsum(absdev/err)/(Nf-1)
+
+        # deviation from median
+        maxval = _segment_reduce(np.maximum, mag-err, offsets)
+        minval = _segment_reduce(np.minimum, mag+err, offsets)
+        NormPeaktoPeakamp = (maxval - minval)/(maxval + minval)
+        NormExcessVar = segsum(dev**2-err**2)/(Nf*wmean**2)
+        medianAbsDev = _segment_median(absdev[_segment_argsort(absdev, seg)],
+                                       offsets)
+        ranges = []
+        for qlow, qhigh in [(25,75),(20,80),(15,85),(10,90),(5,95)]:
+            ranges.append(
+                _segment_percentile(sorted_mag, offsets, qhigh) -
+                _segment_percentile(sorted_mag, offsets, qlow))
+        iqr, i60r, i70r, i80r, i90r = ranges
+
+        # other variability stats
+        z = dev/err
+        z2 = z*z
+        skew = Nf/(Nf-1)/(Nf-2) * segsum(z2*z)
+        smallkurt = Nf*(Nf+1)/(Nf-1)/(Nf-2)/(Nf-3) * segsum(z2*z2)
+        smallkurt -= 3*(Nf-1)**2/(Nf-2)/(Nf-3)
+
+        # consecutive points of the same light curve
+        same = seg[1:] == seg[:-1]
+        pairseg = seg[:-1][same]
+
+        dt = (t[1:] - t[:-1])[same]
+        dm = (mag[1:] - mag[:-1])[same]
+        wt = dt**-2
+        eta = segsum(wt*dm**2, pairseg)
+        eta /= segsum(wt, pairseg)*wstd**2
+        invNeumann = eta**-1
+
+        d = np.sqrt(Nf/(Nf-1))[seg]*z
+        P = (d[:-1]*d[1:])[same]
+        WelchI = segsum(P, pairseg)
+        StetsonJ = segsum(np.sign(P)*np.sqrt(np.abs(P)), pairseg)
+        StetsonK = segsum(np.abs(d))/Nf
+        StetsonK /= np.sqrt(1./Nf*segsum(d**2))
+
+        AD, SW = _segment_anderson_shapiro(mag/err, seg, offsets)
+
+    out = np.c_[Nf,median,wmean,chi2red,RoMS,wstd,
+                NormPeaktoPeakamp,NormExcessVar,medianAbsDev,iqr,
+                i60r,i70r,i80r,i90r,skew,smallkurt,invNeumann,
+                WelchI,StetsonJ,StetsonK,AD,SW]
+    out[N == 0, 1:] = np.nan
+
+    return out
+
+
+def _segment_argsort(x, seg):
+    """ Indices that sort x within each segment (same as np.lexsort((x, seg)))
+    """
+    order = np.argsort(x)
+    key = seg[order]
+    # stable sort on the segment index, 16 bits at a time so that numpy
+    # uses its radix sort
+    nbits = max(int(np.max(seg, initial=0)).bit_length(), 1)
+    for shift in range(0, nbits, 16):
+        digit = ((key >> shift) & 0xffff).astype(np.uint16)
+        idx = np.argsort(digit, kind='stable')
+        order, key = order[idx], key[idx]
+    return order
+
+
+def _segment_reduce(ufunc, x, offsets):
+    """ ufunc.reduceat over the nonempty segments (nan for empty ones)
+    """
+    N = np.diff(offsets)
+    out = np.nan*np.ones(len(N))
+    nonempty = N > 0
+    if np.any(nonempty):
+        out[nonempty] = ufunc.reduceat(x, offsets[:-1][nonempty])
+    return out
+
+
+def _segment_median(x, offsets):
+    """ np.median of each segment of the segment-wise sorted array x
+    """
+    N = np.diff(offsets)
+    out = np.nan*np.ones(len(N))
+    nonempty = N > 0
+    n, start = N[nonempty], offsets[:-1][nonempty]
+    lower = x[start + (n-1)//2]
+    upper = x[start + n//2]
+    out[nonempty] = np.where(n % 2 == 1, upper, (lower+upper)/2.)
+    return out
+
+
+def _segment_percentile(x, offsets, q):
+    """ np.percentile (linear method) of each segment of the segment-wise
+    sorted array x
+    """
+    N = np.diff(offsets)
+    out = np.nan*np.ones(len(N))
+    nonempty = N > 0
+    n, start = N[nonempty], offsets[:-1][nonempty]
+
+    # same virtual index and interpolation as numpy
+    q = q/100.
+    virtual = n*q + (1 - q) - 1
+    previous = np.floor(virtual)
+    gamma = virtual - previous
+    previous = np.clip(previous.astype(np.int64), 0, n-1)
+    following = np.clip(previous+1, 0, n-1)
+
+    a, b = x[start+previous], x[start+following]
+    diff = b - a
+    out[nonempty] = np.where(gamma >= 0.5, b - diff*(1-gamma), a + diff*gamma)
+    return out
+
+
+_swilk_coefficients = {}
+
+def _swilk_coefficients_half(n):
+    """ First n//2 Shapiro-Wilk coefficients for a sample of size n
+
+    Royston (1995), Algorithm AS R94, as used by scipy.stats.shapiro.
+    """
+
+    if n in _swilk_coefficients:
+        return _swilk_coefficients[n]
+
+    if n == 3:
+        a = np.array([np.sqrt(0.5)])
+    else:
+        c1 = [0.0, 0.221157, -0.147981, -2.07119, 4.434685, -2.706056]
+        c2 = [0.0, 0.042981, -0.293762, -1.752461, 5.682633, -3.582633]
+        m = scipy.stats.norm.ppf((np.arange(1, n//2+1) - 0.375)/(n + 0.25))
+        summ2 = 2.0*np.sum(m**2)
+        ssumm2 = np.sqrt(summ2)
+        rsn = 1.0/np.sqrt(n)
+        a = -m/ssumm2
+        a[0] = np.polyval(c1[::-1], rsn) - m[0]/ssumm2
+        if n > 5:
+            a[1] = np.polyval(c2[::-1], rsn) - m[1]/ssumm2
+            fac = np.sqrt((summ2 - 2.0*m[0]**2 - 2.0*m[1]**2) /
+                          (1.0 - 2.0*a[0]**2 - 2.0*a[1]**2))
+            a[2:] = -m[2:]/fac
+        else:
+            fac = np.sqrt((summ2 - 2.0*m[0]**2)/(1.0 - 2.0*a[0]**2))
+            a[1:] = -m[1:]/fac
+
+    _swilk_coefficients[n] = a
+    return a
+
+
+def _segment_anderson_shapiro(x, seg, offsets):
+    """ Anderson-Darling (normal) and Shapiro-Wilk statistics of each segment
+    """
+
+    N = np.diff(offsets)
+    nlc = len(N)
+    Nf = N.astype(np.float64)
+    start = offsets[:-1]
+
+    def segsum(y):
+        return np.bincount(seg, weights=y, minlength=nlc)
+
+    order = _segment_argsort(x, seg)
+    y = x[order]
+    rank = np.arange(len(y)) - start[seg]
+    mirror = start[seg] + N[seg] - 1 - rank
+
+    # Anderson-Darling, as scipy.stats.anderson(dist='norm')
+    xbar = segsum(y)/Nf
+    s = np.sqrt(segsum((y-xbar[seg])**2)/(Nf-1))
+    wad = (y-xbar[seg])/s[seg]
+    logcdf = scipy.special.log_ndtr(wad)
+    logsf = scipy.special.log_ndtr(-wad)
+    AD = -Nf - segsum((2*rank+1)/Nf[seg]*(logcdf + logsf[mirror]))
+
+    # Shapiro-Wilk, as scipy.stats.shapiro; the statistic is the squared
+    # correlation of the sorted sample with the antisymmetric coefficients
+    SW = np.nan*np.ones(nlc)
+    valid = N >= 3
+    # coefficients of all sample sizes in one table, gathered per point
+    sizes = np.unique(N[valid])
+    table = [np.zeros(1)] + [_swilk_coefficients_half(n) for n in sizes]
+    table_start = np.zeros(np.max(N, initial=0)+1, dtype=np.int64)
+    table_start[sizes] = np.cumsum([len(a) for a in table])[:-1]
+    table = np.concatenate(table)
+    n = N[seg]
+    k = np.minimum(rank, n-1-rank)
+    sign = np.where(n >= 3, np.sign(rank - (n-1-rank)), 0)
+    coeffs = sign*table[table_start[n] + np.minimum(k, np.maximum(n//2-1, 0))]
+
+    # shift by the middle element, as scipy does, and scale by the range
+    shift = np.zeros(nlc)
+    shift[valid] = x[start[valid] + N[valid]//2]
+    yrange = np.zeros(nlc)
+    yrange[valid] = y[start[valid] + N[valid] - 1] - y[start[valid]]
+    xx = (y - shift[seg])/yrange[seg]
+    xx = xx - (segsum(xx)/Nf)[seg]
+    aa = coeffs - (segsum(coeffs)/Nf)[seg]
+    ssa, ssx, sax = segsum(aa*aa), segsum(xx*xx), segsum(aa*xx)
+    ssassx = np.sqrt(ssa*ssx)
+    SW[valid] = (1.0 - (ssassx - sax)*(ssassx + sax)/(ssa*ssx))[valid]
+
+    return AD, SW
+
+
 
 
 def calc_stats(t,mag,err,p):
@@ -312,7 +724,18 @@ def calc_stats(t,mag,err,p):
                  f1_relamp3,f1_relphi3,f1_relamp4,f1_relphi5]
 
 
-def calc_fourier_stats(t,mag,err,p):
+def calc_fourier_stats(t,mag,err=None,p=None):
+    """ Calculate the Fourier decomposition statistics at period p
+
+    t can also be a LightcurveBatch, in which case the periods are given
+    as the second argument (or as p) and an array of shape
+    (n_lightcurves, 14) is returned.
+    """
+
+    if isinstance(t, LightcurveBatch):
+        periods = mag if p is None else p
+        return fourier_decomposition_batch(t.time, t.mag, t.magerr,
+                                           t.offsets, periods)
 
     try:
         # fourier decomposition stuff
@@ -0,0 +1,131 @@
+"""
+Multiharmonic AOV periodogram in numpy.
+
+`aovmhw` is a port of the aovmhw routine of pyaov (Schwarzenberg-Czerny,
+1996) that evaluates the periodogram on an arbitrary array of frequencies,
+a block of frequencies at a time, instead of on a regular grid. It is
+used to refine the candidate frequencies of the GCE_LS_AOV search:
+`refinement_grid` puts the windows around all of the candidates of a
+light curve on one common grid, so that overlapping windows are only
+evaluated once and a single call covers all of them.
+
+Please quote:
+    A.Schwarzenberg-Czerny, 1996, Astrophys. J.,460, L107.
+"""
+
+import numpy as np
+
+# minimum variance difference, as in aovconst.f90
+MINVAR = 4*np.finfo(np.float64).tiny
+
+
+def refinement_grid(freqs_to_keep, df, nwin=50, oversample=2):
+    """Union of the windows fr0 +- nwin*df around the candidate
+    frequencies fr0, sampled with step df/oversample.
+
+    The windows are snapped to the common grid k*df/oversample, so that
+    frequencies shared by overlapping windows appear once. Only positive
+    frequencies are kept.
+    """
+
+    step = df/oversample
+    centers = np.round(np.asarray(freqs_to_keep, dtype=np.float64).ravel()/step).astype(np.int64)
+    window = np.arange(-nwin*oversample, nwin*oversample+1, dtype=np.int64)
+    k = np.unique((centers[:,None] + window[None,:]).ravel())
+    k = k[k > 0]
+
+    return k*step
+
+
+def aovmhw(t, f, er, freqs, nh2=3, max_block=2**16):
+    """Multiharmonic AOV periodogram at the given frequencies.
+
+    Parameters
+    ----------
+    t, f, er : array-like, shape = [n_obs]
+        Times, values and errors of the observations.
+    freqs : array-like, shape = [n_freqs]
+        Frequencies.
+    nh2 : int
+        2*number of Fourier harmonics, as in pyaov.amhw.
+    max_block : int
+        Maximum number of (frequency, observation) pairs held in memory
+        at once.
+
+    Returns
+    -------
+    th : array-like, shape = [n_freqs]
+        AOV periodogram, with F(2*nh+1, n_obs-2*nh-2) distribution.
+    """
+
+    t = np.asarray(t, dtype=np.float64)
+    f = np.asarray(f, dtype=np.float64)
+    er = np.asarray(er, dtype=np.float64)
+    freqs = np.asarray(freqs, dtype=np.float64)
+
+    nobs = len(t)
+    nh = max(1, nh2//2)
+    nn2 = nh + nh
+
+    th = np.zeros(len(freqs))
+    if (nobs < nn2 + 2) or (len(freqs) == 0):
+        return th
+
+    d1 = nn2
+    d2 = nobs - nn2 - 1
+
+    rw = np.zeros(nobs)
+    rw[er > 0] = 1.0/er[er > 0]
+    avf = np.sum(f*rw*rw)/np.sum(rw*rw)
+    vrf = np.sum(((f-avf)*rw)**2)
+    fw = (f-avf)*rw
+    eps = np.finfo(np.float64).eps
+
+    nblock = max(1, max_block//nobs)
+    for start in range(0, len(freqs), nblock):
+        fr = freqs[start:start+nblock]
+
+        # phases of all frequencies of the block, shape (n_block, n_obs)
+        ph = np.outer(fr, t)
+        ph -= np.floor(ph)
+        ph *= 2*np.pi
+        z = np.empty(ph.shape, dtype=np.complex128)
+        z.real = np.cos(ph)
+        z.imag = np.sin(ph)
+        del ph
+
+        cf = z.copy()
+        for ii in range(nh-1):
+            cf *= z
+        cf *= fw
+        rwz = z*rw
+        p = np.zeros_like(z)
+        p.real = rw
+        zn = np.ones_like(z)
+        tmp = np.empty_like(z)
+
+        # projection on orthogonal trigonometric polynomials, by recurrence
+        thb = np.zeros(len(fr))
+        for n in range(nn2+1):
+            sn = np.einsum('ij,ij->i', p.real, p.real) + \
+                 np.einsum('ij,ij->i', p.imag, p.imag)
+            al = np.einsum('ij,ij->i', rwz, p)
+            sc = np.einsum('ij,ij->i', p.conj(), cf)
+
+            sn = np.maximum(sn, eps)
+            al = al/sn
+            thb += (sc.real**2 + sc.imag**2)/sn
+            if n == nn2:
+                break
+
+            # p = p*z - al*zn*conj(p)
+            np.conjugate(p, out=tmp)
+            tmp *= zn
+            tmp *= al[:,None]
+            p *= z
+            p -= tmp
+            zn *= z
+
+        th[start:start+nblock] = d2*thb/(d1*np.maximum(vrf-thb, MINVAR))
+
+    return th
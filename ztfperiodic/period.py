@@ -185,3 +185,226 @@ def CE_cupy(period, data, xbins=10, ybins=5):
         return np.sum(A)
     else:
         return np.PINF
+
+def get_phase_batch(time, periods, pdot=0.0):
+    """
+    Returns *time* transformed to phase-space for each of *periods*.
+
+    **Parameters**
+
+    time : array-like, shape = [n_samples]
+        The times to transform.
+    periods : array-like, shape = [n_periods]
+        The periods to phase by.
+    pdot : number, optional
+        Period derivative; times are warped as
+        t - 1/2 * (pdot / period) * t**2 before folding (default 0.0).
+
+    **Returns**
+
+    phase : array-like, shape = [n_periods, n_samples]
+        The phases of *time* for each of *periods*.
+    """
+    periods = np.asarray(periods, dtype=float)[:, np.newaxis]
+    time = np.asarray(time, dtype=float)[np.newaxis, :]
+    if pdot != 0:
+        time = time - 0.5 * (pdot / periods) * time**2
+    phase = np.mod(time, periods)
+    phase /= periods
+    return phase
+
+def CE_batch(periods, data, xbins=10, ybins=5, pdot=0.0, block_size=None):
+    """
+    Returns the conditional entropy periodogram of *data* for all of
+    *periods* at once.
+
+    Phase folding is vectorized over blocks of trial periods and the
+    2D (phase, magnitude) histograms of a whole block are built with a
+    single call to `np.bincount`, so that the per-period Python overhead
+    of calling `CE` in a loop goes away. The binning conventions match
+    `CE`: bins are half-open on [0, 1), so that magnitudes equal to 1 are
+    not counted, while the normalization uses all samples.
+
+    **Parameters**
+
+    periods : array-like, shape = [n_periods]
+        The periods to rephase *data* by.
+    data : array-like, shape = [n_samples, 2] or [n_samples, 3]
+        Array containing columns *time*, *mag*, and (optional) *error*.
+        Magnitudes are expected to be normalized to [0, 1].
+    xbins : int, optional
+        Number of phase bins (default 10).
+    ybins : int, optional
+        Number of magnitude bins (default 5).
+    pdot : number, optional
+        Period derivative used to warp the times (default 0.0).
+    block_size : int, optional
+        Number of periods folded at once. By default, this is chosen such
+        that a block holds about 2**21 phases.
+
+    **Returns**
+
+    entropies : array-like, shape = [n_periods]
+        The conditional entropy at each of *periods*.
+    """
+
+    periods = np.atleast_1d(np.asarray(periods, dtype=float))
+    data = np.ma.getdata(data)
+    t = np.asarray(data[:, 0], dtype=float)
+    m = np.asarray(data[:, 1], dtype=float)
+    size = len(t)
+
+    entropies = np.full(len(periods), np.inf)
+    if size == 0:
+        return entropies
+
+    if block_size is None:
+        block_size = max(1, 2**21 // size)
+
+    # magnitude bins do not depend on the period, so compute them once;
+    # samples outside of [0, 1) are dropped, as in fast_histogram
+    keep = (m >= 0) & (m < 1)
+    t = t[keep]
+    ybin = (m[keep] * ybins).astype(np.int64)
+    nbins = xbins * ybins
+
+    valid = np.where(periods > 0)[0]
+    for start in range(0, len(valid), block_size):
+        idx = valid[start:start+block_size]
+        nblock = len(idx)
+
+        phase = get_phase_batch(t, periods[idx], pdot=pdot)
+        xbin = (phase * xbins).astype(np.int64)
+        np.clip(xbin, 0, xbins-1, out=xbin)
+
+        flat = xbin * ybins + ybin[np.newaxis, :]
+        flat += (np.arange(nblock, dtype=np.int64) * nbins)[:, np.newaxis]
+        bins = np.bincount(flat.ravel(), minlength=nblock*nbins)
+        bins = bins.reshape(nblock, xbins, ybins) / size
+
+        # bins[i,j]/size * log(bins[i,:] / size / (bins[i,j]/size))
+        column_sums = np.sum(bins, axis=2, keepdims=True)
+        arg_positive = bins > 0
+        ratio = np.divide(column_sums, bins,
+                          out=np.ones_like(bins), where=arg_positive)
+        entropies[idx] = np.sum(bins * np.log(ratio), axis=(1, 2))
+
+    return entropies
+
+def AOV_batch(periods, data, xbins=10, pdot=0.0, block_size=None):
+    """
+    Returns the phase-binned analysis of variance periodogram of *data*
+    for all of *periods* at once (Schwarzenberg-Czerny 1989).
+
+    **Parameters**
+
+    periods : array-like, shape = [n_periods]
+        The periods to rephase *data* by.
+    data : array-like, shape = [n_samples, 2] or [n_samples, 3]
+        Array containing columns *time*, *mag*, and (optional) *error*.
+    xbins : int, optional
+        Number of phase bins (default 10).
+    pdot : number, optional
+        Period derivative used to warp the times (default 0.0).
+    block_size : int, optional
+        Number of periods folded at once.
+
+    **Returns**
+
+    aovs : array-like, shape = [n_periods]
+        The AOV statistic at each of *periods*.
+    """
+
+    periods = np.atleast_1d(np.asarray(periods, dtype=float))
+    data = np.ma.getdata(data)
+    t = np.asarray(data[:, 0], dtype=float)
+    m = np.asarray(data[:, 1], dtype=float)
+    size = len(t)
+
+    aovs = np.zeros(len(periods))
+    if size <= xbins:
+        return aovs
+
+    if block_size is None:
+        block_size = max(1, 2**21 // size)
+
+    avg = np.mean(m)
+    m2 = np.sum(m**2)
+
+    valid = np.where(periods > 0)[0]
+    for start in range(0, len(valid), block_size):
+        idx = valid[start:start+block_size]
+        nblock = len(idx)
+
+        phase = get_phase_batch(t, periods[idx], pdot=pdot)
+        xbin = (phase * xbins).astype(np.int64)
+        np.clip(xbin, 0, xbins-1, out=xbin)
+        xbin += (np.arange(nblock, dtype=np.int64) * xbins)[:, np.newaxis]
+        xbin = xbin.ravel()
+
+        n = np.bincount(xbin, minlength=nblock*xbins).reshape(nblock, xbins)
+        sum1 = np.bincount(xbin, weights=np.tile(m, nblock),
+                           minlength=nblock*xbins).reshape(nblock, xbins)
+        # sum over bins of n_i * mean_i**2, skipping empty bins
+        nmean2 = np.divide(sum1**2, n, out=np.zeros(sum1.shape), where=n>0)
+
+        s1 = np.sum(nmean2, axis=1) - size * avg**2
+        s2 = m2 - np.sum(nmean2, axis=1)
+        aovs[idx] = (s1 / s2) * (size - xbins) / (xbins - 1)
+
+    return aovs
+
+def LS_batch(periods, data, pdot=0.0, block_size=None):
+    """
+    Returns the normalized Lomb-Scargle periodogram of *data* for all of
+    *periods* at once (Scargle 1982).
+
+    **Parameters**
+
+    periods : array-like, shape = [n_periods]
+        The periods to evaluate.
+    data : array-like, shape = [n_samples, 2] or [n_samples, 3]
+        Array containing columns *time*, *mag*, and (optional) *error*.
+    pdot : number, optional
+        Period derivative used to warp the times (default 0.0).
+    block_size : int, optional
+        Number of periods evaluated at once.
+
+    **Returns**
+
+    powers : array-like, shape = [n_periods]
+        The Lomb-Scargle power at each of *periods*.
+    """
+
+    periods = np.atleast_1d(np.asarray(periods, dtype=float))
+    data = np.ma.getdata(data)
+    t = np.asarray(data[:, 0], dtype=float)
+    m = np.asarray(data[:, 1], dtype=float)
+    size = len(t)
+
+    powers = np.zeros(len(periods))
+    if size < 2:
+        return powers
+
+    if block_size is None:
+        block_size = max(1, 2**20 // size)
+
+    y = m - np.mean(m)
+    var = np.var(y, ddof=1)
+    if var == 0:
+        return powers
+
+    valid = np.where(periods > 0)[0]
+    for start in range(0, len(valid), block_size):
+        idx = valid[start:start+block_size]
+
+        omegat = 2 * np.pi * get_phase_batch(t, periods[idx], pdot=pdot)
+        tau = 0.5 * np.arctan2(np.sum(np.sin(2 * omegat), axis=1),
+                               np.sum(np.cos(2 * omegat), axis=1))
+        omegat -= tau[:, np.newaxis]
+        c, s = np.cos(omegat), np.sin(omegat)
+        yc, ys = np.dot(c, y), np.dot(s, y)
+        powers[idx] = (yc**2 / np.sum(c**2, axis=1) +
+                       ys**2 / np.sum(s**2, axis=1)) / (2 * var)
+
+    return powers
@@ -0,0 +1,186 @@
+"""
+CPU implementation of the periodfind interface.
+
+The classes in this module expose the same ``calc(times, mags, periods,
+period_dts, output=...)`` call as ``periodfind.ce.ConditionalEntropy``,
+``periodfind.aov.AOV`` and ``periodfind.ls.LombScargle`` and return the
+same statistics objects, so that the ECE, EAOV and ELS branches of
+`ztfperiodic.periodsearch.find_periods` can run on nodes without a GPU.
+Work is split into (light curve, frequency block) tasks which are spread
+over all cores with joblib.
+"""
+
+import numpy as np
+
+from ztfperiodic.period import CE_batch, AOV_batch, LS_batch
+
+
+class Statistic(object):
+    """Best period of a single light curve.
+
+    Attributes
+    ----------
+    params : tuple
+        (period, pdot) at the extremum of the periodogram.
+    significance : float
+        Distance of the extremum from the periodogram mean, in units of
+        its standard deviation.
+    """
+
+    def __init__(self, params, significance):
+        self.params = params
+        self.significance = significance
+
+
+class Periodogram(object):
+    """Full periodogram of a single light curve.
+
+    Attributes
+    ----------
+    data : array-like, shape = [n_periods, n_pdots]
+        The periodogram values.
+    params : tuple
+        (periods, pdots) at which the periodogram was evaluated.
+    """
+
+    def __init__(self, data, params):
+        self.data = data
+        self.params = params
+
+
+def _calc_block(func, time, mag, periods, pdots, kwargs):
+    out = np.empty((len(periods), len(pdots)), dtype=np.float32)
+    data = np.vstack((time, mag)).T
+    for jj, pdot in enumerate(pdots):
+        out[:, jj] = func(periods, data, pdot=pdot, **kwargs)
+    return out
+
+
+class _PeriodFinder(object):
+
+    # the statistic is best at its "min" or "max"
+    extremum = "max"
+
+    # ztfperiodic.period batch function evaluating the periodogram, and
+    # the names of the attributes passed to it as keyword arguments
+    kernel = None
+    kernel_kwargs = {}
+
+    def __init__(self, n_jobs=-1, n_blocks=None):
+        self.n_jobs = n_jobs
+        self.n_blocks = n_blocks
+
+    def _periodograms(self, times, mags, periods, period_dts):
+        from joblib import Parallel, delayed, cpu_count
+
+        n_jobs = self.n_jobs
+        if n_jobs < 0:
+            n_jobs = cpu_count() + 1 + n_jobs
+        n_jobs = max(1, n_jobs)
+
+        # cut the frequency grid so that there are several tasks per core
+        # even when only a handful of light curves are searched
+        if self.n_blocks is None:
+            n_blocks = int(np.ceil(4.0 * n_jobs / max(1, len(times))))
+        else:
+            n_blocks = self.n_blocks
+        n_blocks = int(np.clip(n_blocks, 1, len(periods)))
+        periods_split = np.array_split(periods, n_blocks)
+
+        func = self.kernel
+        kwargs = dict((key, getattr(self, attr))
+                      for key, attr in self.kernel_kwargs.items())
+        tasks = [(ii, block) for ii in range(len(times))
+                 for block in periods_split]
+        if n_jobs == 1:
+            res = [_calc_block(func, times[ii], mags[ii], block,
+                               period_dts, kwargs)
+                   for ii, block in tasks]
+        else:
+            res = Parallel(n_jobs=n_jobs)(
+                delayed(_calc_block)(func, times[ii], mags[ii], block,
+                                     period_dts, kwargs)
+                for ii, block in tasks)
+
+        return [np.concatenate(res[ii*n_blocks:(ii+1)*n_blocks], axis=0)
+                for ii in range(len(times))]
+
+    def calc(self, times, mags, periods, period_dts, output='stats'):
+        """Run the period search on a list of light curves.
+
+        Parameters
+        ----------
+        times : list of array-like
+            Times of each light curve, starting at zero.
+        mags : list of array-like
+            Magnitudes of each light curve, normalized to [0, 1].
+        periods : array-like
+            Trial periods.
+        period_dts : array-like
+            Trial period derivatives.
+        output : str, optional
+            'stats' returns one `Statistic` per light curve,
+            'periodogram' returns one `Periodogram` per light curve.
+
+        Returns
+        -------
+        results : list
+            One result object per light curve.
+        """
+
+        periods = np.asarray(periods, dtype=np.float64)
+        period_dts = np.atleast_1d(np.asarray(period_dts, dtype=np.float64))
+
+        if not output in ['stats', 'periodogram']:
+            raise ValueError("output must be either stats or periodogram")
+
+        data_out = []
+        pgrams = self._periodograms(times, mags, periods, period_dts)
+        for pgram in pgrams:
+            if output == 'periodogram':
+                data_out.append(Periodogram(pgram, (periods, period_dts)))
+                continue
+
+            if self.extremum == "min":
+                idx = np.argmin(pgram)
+            else:
+                idx = np.argmax(pgram)
+            significance = np.abs(np.mean(pgram)-pgram.flat[idx])/np.std(pgram)
+            ii, jj = np.unravel_index(idx, pgram.shape)
+            data_out.append(Statistic((periods[ii], period_dts[jj]),
+                                      significance))
+
+        return data_out
+
+
+class ConditionalEntropy(_PeriodFinder):
+    """Conditional entropy period finder (CPU)."""
+
+    extremum = "min"
+    kernel = staticmethod(CE_batch)
+    kernel_kwargs = {"xbins": "n_phase", "ybins": "n_mag"}
+
+    def __init__(self, n_phase=10, n_mag=10, n_jobs=-1, n_blocks=None):
+        super(ConditionalEntropy, self).__init__(n_jobs=n_jobs,
+                                                 n_blocks=n_blocks)
+        self.n_phase = n_phase
+        self.n_mag = n_mag
+
+
+class AOV(_PeriodFinder):
+    """Phase-binned analysis of variance period finder (CPU)."""
+
+    extremum = "max"
+    kernel = staticmethod(AOV_batch)
+    kernel_kwargs = {"xbins": "n_phase"}
+
+    def __init__(self, n_phase=10, n_jobs=-1, n_blocks=None):
+        super(AOV, self).__init__(n_jobs=n_jobs, n_blocks=n_blocks)
+        self.n_phase = n_phase
+
+
+class LombScargle(_PeriodFinder):
+    """Lomb-Scargle period finder (CPU)."""
+
+    extremum = "max"
+    kernel = staticmethod(LS_batch)
@@ -1,11 +1,9 @@
 
 import numpy as np
 
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-
-import ztfperiodic.utils
+from ztfperiodic.mhaov import aovmhw, refinement_grid
+from ztfperiodic.freqgrid import as_frequency_grid
+from ztfperiodic.freqgrid import FrequencyGrid, baseline_bins
 
 
 def find_periods(algorithm, lightcurves, freqs, batch_size=1,
@@ -17,11 +15,22 @@ def find_periods(algorithm, lightcurves, freqs, batch_size=1,
                  phase_bins=20, mag_bins=10,
                  doParallel=False,
                  Ncore=4):
-
-    if doRemoveTerrestrial and (freqs_to_remove is not None) and not (algorithm=="LS" or algorithm=="GCE_LS_AOV" or algorithm=="GCE_LS" or algorithm=="GCE_LS_AOV_x3"):
-        for pair in freqs_to_remove:
-            idx = np.where((freqs < pair[0]) | (freqs > pair[1]))[0]
-            freqs = freqs[idx]
+    """Best period and its significance for each light curve.
+
+    freqs is either an array of frequencies, whose freqs_to_remove windows
+    are masked if doRemoveTerrestrial, or a
+    `ztfperiodic.freqgrid.FrequencyGrid`, which carries its own alias
+    mask. The LS-based GPU algorithms run on the full grid and mask their
+    periodograms; the other algorithms run on the masked grid.
+    """
+
+    if not doRemoveTerrestrial:
+        freqs_to_remove = None
+    grid = as_frequency_grid(freqs, freqs_to_remove=freqs_to_remove)
+    if doGPU and algorithm in ["LS", "GCE_LS_AOV", "GCE_LS", "GCE_LS_AOV_x3"]:
+        freqs = grid.freqs
+    else:
+        freqs = grid.masked
 
     periods_best, significances = [], []
     pdots = np.zeros((len(lightcurves),))
@@ -75,7 +84,7 @@ def find_periods(algorithm, lightcurves, freqs, batch_size=1,
                                                   sigma=nfft_sigma)
     
             if doSaveMemory:
-                periods_best, significances = ls_proc.batched_run_const_nfreq(lightcurves, batch_size=batch_size, use_fft=True, samples_per_peak=spp, returnBestFreq=True, freqs = freqs, doRemoveTerrestrial=doRemoveTerrestrial, freqs_to_remove=freqs_to_remove)
+                periods_best, significances = ls_proc.batched_run_const_nfreq(lightcurves, batch_size=batch_size, use_fft=True, samples_per_peak=spp, returnBestFreq=True, freqs = freqs, doRemoveTerrestrial=grid.has_aliases, freqs_to_remove=grid.freqs_to_remove)
             else:
                 results = ls_proc.batched_run_const_nfreq(lightcurves,
                                                           batch_size=batch_size,
@@ -86,11 +95,9 @@ def find_periods(algorithm, lightcurves, freqs, batch_size=1,
     
                 for data, out in zip(lightcurves,results):
                     freqs, powers = out
-                    if doRemoveTerrestrial and (freqs_to_remove is not None):
-                        for pair in freqs_to_remove:
-                            idx = np.where((freqs < pair[0]) | (freqs > pair[1]))[0]
-                            freqs = freqs[idx]
-                            powers = powers[idx]
+                    if grid.has_aliases:
+                        keep = grid.mask_for(freqs)
+                        freqs, powers = freqs[keep], powers[keep]
 
                     copy = np.ma.copy(data).T
                     fap = fap_baluev(copy[:,0], copy[:,2], powers, np.max(freqs))
@@ -197,187 +204,14 @@ def find_periods(algorithm, lightcurves, freqs, batch_size=1,
                             pdots[jj] = pdot[kk]*1.0 
             pdots, periods_best, significances = pdots.flatten(), periods_best.flatten(), significances.flatten()
 
-        elif (algorithm == "ECE") or (algorithm == "EAOV") or (algorithm == "ELS"):
-            if algorithm == "ECE":
-                from periodfind.ce import ConditionalEntropy
-                #ce = ConditionalEntropy(phase_bins=phase_bins, mag_bins=mag_bins)
-                ce = ConditionalEntropy(phase_bins, mag_bins)
-            elif algorithm == "EAOV":
-                from periodfind.aov import AOV
-                aov = AOV(phase_bins)
-            elif algorithm == "ELS":
-                from periodfind.ls import LombScargle
-                ls = LombScargle()
-
-            if doUsePDot:
-                num_pdots = 10
-                max_pdot = 1e-10
-                min_pdot = 1e-12
-                pdots_to_test = -np.logspace(np.log10(min_pdot), np.log10(max_pdot), num_pdots)
-                pdots_to_test = np.append(0,pdots_to_test)
-                #pdots_to_test = np.array([-2.365e-11])
-            else:
-                pdots_to_test = np.array([0.0])
-
-            if doSingleTimeSegment:
-                tt = np.empty((0,1))
-                for lightcurve in lightcurves:
-                    tt = np.unique(np.append(tt, lightcurve[0]))
-
-            maxn = -np.inf
-            time_stack, mag_stack = [], []
-            for lightcurve in lightcurves:
-                if doSingleTimeSegment:
-                    xy, x_ind, y_ind = np.intersect1d(tt, lightcurve[0],
-                                                      return_indices=True)
-                    mag_array = 999*np.ones(tt.shape)
-                    magerr_array = 999*np.ones(tt.shape)
-                    mag_array[x_ind] = lightcurve[1][y_ind]
-                    magerr_array[x_ind] = lightcurve[2][y_ind]
-                    lightcurve = (tt, mag_array, magerr_array)
-                else:
-                    idx = np.argsort(lightcurve[0])
-                    tmin = np.min(lightcurve[0])
-                    lightcurve = (lightcurve[0][idx]-tmin,
-                                  lightcurve[1][idx],
-                                  lightcurve[2][idx])
-
-                lightcurve_stack = np.vstack((lightcurve[0],
-                                              lightcurve[1],
-                                              lightcurve[2])).T
-                time_stack.append(lightcurve[0].astype(np.float32))
-                lc = lightcurve[1]
-                lc = (lc - np.min(lc))/(np.max(lc)-np.min(lc))
-                mag_stack.append(lc.astype(np.float32))
-
-                if len(idx) > maxn:
-                    maxn = len(idx)
-
-            print("Number of lightcurves: %d" % len(time_stack))
-            print("Max length of lightcurves: %d" % maxn)
-            print("Batch size: %d" % batch_size)
-            print("Number of frequency bins: %d" % len(freqs))
-            print("Number of phase bins: %d" % phase_bins)
-            print("Number of magnitude bins: %d" % mag_bins)
-
-            periods = (1.0/freqs).astype(np.float32)
-            pdots_to_test = pdots_to_test.astype(np.float32)
-
-            periods_best = np.zeros((len(lightcurves),1))
-            significances = np.zeros((len(lightcurves),1))
-            pdots = np.zeros((len(lightcurves),1))
-
-            if algorithm == "ECE":
-                data_out = ce.calc(time_stack, mag_stack, periods, pdots_to_test)
-            elif algorithm == "EAOV":
-                data_out = aov.calc(time_stack, mag_stack, periods, pdots_to_test)
-            elif algorithm == "ELS":
-                data_out = ls.calc(time_stack, mag_stack, periods, pdots_to_test)
-
-            for ii, stat in enumerate(data_out):
-                if np.isnan(stat.significance):
-                    raise ValueError("Oops... significance  is nan... something went wrong")
-
-                periods_best[ii] = stat.params[0]
-                pdots[ii] = stat.params[1]
-                significances[ii] = stat.significance
-            pdots, periods_best, significances = pdots.flatten(), periods_best.flatten(), significances.flatten()
-
-        elif (algorithm == "ECE_periodogram") or (algorithm == "EAOV_periodogram") or (algorithm == "ELS_periodogram"):
-            if algorithm.split("_")[0] == "ECE":
-                from periodfind.ce import ConditionalEntropy
-                #ce = ConditionalEntropy(phase_bins=phase_bins, mag_bins=mag_bins)
-                ce = ConditionalEntropy(phase_bins, mag_bins)
-            elif algorithm.split("_")[0] == "EAOV":
-                from periodfind.aov import AOV
-                aov = AOV(phase_bins)
-            elif algorithm.split("_")[0] == "ELS":
-                from periodfind.ls import LombScargle
-                ls = LombScargle()
-
-            if doUsePDot:
-                num_pdots = 10
-                max_pdot = 1e-10
-                min_pdot = 1e-12
-                pdots_to_test = -np.logspace(np.log10(min_pdot), np.log10(max_pdot), num_pdots)
-                pdots_to_test = np.append(0,pdots_to_test)
-                #pdots_to_test = np.array([-2.365e-11])
-            else:
-                pdots_to_test = np.array([0.0])
-
-            if doSingleTimeSegment:
-                tt = np.empty((0,1))
-                for lightcurve in lightcurves:
-                    tt = np.unique(np.append(tt, lightcurve[0]))
-
-            maxn = -np.inf
-            time_stack, mag_stack = [], []
-            for lightcurve in lightcurves:
-                if doSingleTimeSegment:
-                    xy, x_ind, y_ind = np.intersect1d(tt, lightcurve[0],
-                                                      return_indices=True)
-                    mag_array = 999*np.ones(tt.shape)
-                    magerr_array = 999*np.ones(tt.shape)
-                    mag_array[x_ind] = lightcurve[1][y_ind]
-                    magerr_array[x_ind] = lightcurve[2][y_ind]
-                    lightcurve = (tt, mag_array, magerr_array)
-                else:
-                    idx = np.argsort(lightcurve[0])
-                    tmin = np.min(lightcurve[0])
-                    lightcurve = (lightcurve[0][idx]-tmin,
-                                  lightcurve[1][idx],
-                                  lightcurve[2][idx])
-
-                lightcurve_stack = np.vstack((lightcurve[0],
-                                              lightcurve[1],
-                                              lightcurve[2])).T
-                time_stack.append(lightcurve[0].astype(np.float32))
-                lc = lightcurve[1]
-                lc = (lc - np.min(lc))/(np.max(lc)-np.min(lc))
-                mag_stack.append(lc.astype(np.float32))
-
-                if len(idx) > maxn:
-                    maxn = len(idx)
-
-            print("Number of lightcurves: %d" % len(time_stack))
-            print("Max length of lightcurves: %d" % maxn)
-            print("Batch size: %d" % batch_size)
-            print("Number of frequency bins: %d" % len(freqs))
-            print("Number of phase bins: %d" % phase_bins)
-            print("Number of magnitude bins: %d" % mag_bins)
-
-            periods = (1.0/freqs).astype(np.float32)
-            pdots_to_test = pdots_to_test.astype(np.float32)
-
-            periods_best = []
-            significances = np.zeros((len(lightcurves),1))
-            pdots = np.zeros((len(lightcurves),1))
-
-            if algorithm.split("_")[0] == "ECE":
-                data_out = ce.calc(time_stack, mag_stack, periods, pdots_to_test, output='periodogram')
-            elif algorithm.split("_")[0] == "EAOV":
-                data_out = aov.calc(time_stack, mag_stack, periods, pdots_to_test, output='periodogram')
-            elif algorithm.split("_")[0] == "ELS":
-                data_out = ls.calc(time_stack, mag_stack, periods, pdots_to_test, output='periodogram')
-
-            for ii, stat in enumerate(data_out):
-                if algorithm.split("_")[0] == "ECE":
-                    significance = np.abs(np.mean(stat.data)-np.min(stat.data))/np.std(stat.data)
-                    period = periods[np.argmin(stat.data)]
-                elif algorithm.split("_")[0] == "EAOV":
-                    significance = np.abs(np.mean(stat.data)-np.min(stat.data))/np.std(stat.data)
-                    period = periods[np.argmin(stat.data)]
-                elif algorithm.split("_")[0] == "ELS":
-                    significance = np.abs(np.mean(stat.data)-np.max(stat.data))/np.std(stat.data)
-                    period = periods[np.argmax(stat.data)]
-
-                if np.isnan(significance):
-                    raise ValueError("Oops... significance  is nan... something went wrong")
-
-                periods_best.append({'period': period, 'data': stat.data})
-                pdots[ii] = pdots_to_test[0]
-                significances[ii] = significance
-            pdots, significances = pdots.flatten(), significances.flatten()
+        elif algorithm.split("_")[0] in ["ECE", "EAOV", "ELS"]:
+            periods_best, significances, pdots = find_periods_periodfind(
+                algorithm, lightcurves, grid,
+                doGPU=True,
+                doUsePDot=doUsePDot,
+                doSingleTimeSegment=doSingleTimeSegment,
+                phase_bins=phase_bins, mag_bins=mag_bins,
+                batch_size=batch_size)
 
         elif algorithm == "GCE_LS_AOV":
             nfreqs_to_keep = 100
@@ -386,7 +220,6 @@ def find_periods(algorithm, lightcurves, freqs, batch_size=1,
 
             from cuvarbase.lombscargle import LombScargleAsyncProcess, fap_baluev
             from gcex.gce import ConditionalEntropy
-            from ztfperiodic.pyaov.pyaov import aovw, amhw
 
             ce = ConditionalEntropy(phase_bins=phase_bins, mag_bins=mag_bins)
 
@@ -437,12 +270,9 @@ def find_periods(algorithm, lightcurves, freqs, batch_size=1,
 
             for jj, (lightcurve, entropies2) in enumerate(zip(lightcurves,results)):
                 for kk, entropies in enumerate(entropies2):
-                    freqs_tmp = np.copy(freqs)
-                    if doRemoveTerrestrial and (freqs_to_remove is not None):
-                        for pair in freqs_to_remove:
-                            idx = np.where((freqs_tmp < pair[0]) | (freqs_tmp > pair[1]))[0]
-                            freqs_tmp = freqs_tmp[idx]
-                            entropies = entropies[idx]
+                    freqs_tmp = grid.masked
+                    if grid.has_aliases:
+                        entropies = entropies[grid.mask]
                     significance = np.abs(np.mean(entropies)-entropies)/np.std(entropies)
                     idx = np.argsort(significance)[::-1]
 
@@ -462,11 +292,9 @@ def find_periods(algorithm, lightcurves, freqs, batch_size=1,
 
             for jj, (data, out) in enumerate(zip(lightcurves,results)):
                 freqs, powers = out
-                if doRemoveTerrestrial and (freqs_to_remove is not None):
-                    for pair in freqs_to_remove:
-                        idx = np.where((freqs < pair[0]) | (freqs > pair[1]))[0]
-                        freqs = freqs[idx]
-                        powers = powers[idx]
+                if grid.has_aliases:
+                    keep = grid.mask_for(freqs)
+                    freqs, powers = freqs[keep], powers[keep]
 
                 copy = np.ma.copy(data).T
                 fap = fap_baluev(copy[:,0], copy[:,2], powers, np.max(freqs))
@@ -476,8 +304,12 @@ def find_periods(algorithm, lightcurves, freqs, batch_size=1,
             ls_proc.finish()
 
             if doParallel:
-                from joblib import Parallel, delayed
-                res = Parallel(n_jobs=Ncore)(delayed(calc_AOV)(data, freqs_to_keep[jj], df) for jj, data in enumerate(lightcurves))
+                from ztfperiodic.lcbatch import map_batch
+                freqs_to_keep = [freqs_to_keep[jj] for jj in range(len(lightcurves))]
+                res = map_batch(calc_AOV_batch, lightcurves,
+                                args=[freqs_to_keep], kwargs={"df": df},
+                                Ncore=Ncore)
+                res = [x for piece in res for x in piece]
                 periods_best = [x[0] for x in res]
                 significances = [x[1] for x in res]
             else:
@@ -498,7 +330,6 @@ def find_periods(algorithm, lightcurves, freqs, batch_size=1,
 
             from cuvarbase.lombscargle import LombScargleAsyncProcess, fap_baluev
             from gcex.gce import ConditionalEntropy
-            from ztfperiodic.pyaov.pyaov import aovw, amhw
 
             ce = ConditionalEntropy(phase_bins=phase_bins, mag_bins=mag_bins)
 
@@ -560,12 +391,9 @@ def find_periods(algorithm, lightcurves, freqs, batch_size=1,
             
             for jj in entropies_all.keys():
                 entropies = np.median(entropies_all[jj], axis=0)
-                freqs_tmp = np.copy(freqs)
-                if doRemoveTerrestrial and (freqs_to_remove is not None):
-                    for pair in freqs_to_remove:
-                        idx = np.where((freqs_tmp < pair[0]) | (freqs_tmp > pair[1]))[0]
-                        freqs_tmp = freqs_tmp[idx]
-                        entropies = entropies[idx]
+                freqs_tmp = grid.masked
+                if grid.has_aliases:
+                    entropies = entropies[grid.mask]
                 significance = np.abs(np.mean(entropies)-entropies)/np.std(entropies)
                 idx = np.argsort(significance)[::-1]
 
@@ -600,11 +428,9 @@ def find_periods(algorithm, lightcurves, freqs, batch_size=1,
                 data = lightcurves[jj]
                 freqs = freqs_all[jj]
                 powers = np.median(powers_all[jj], axis=0)
-                if doRemoveTerrestrial and (freqs_to_remove is not None):
-                    for pair in freqs_to_remove:
-                        idx = np.where((freqs < pair[0]) | (freqs > pair[1]))[0]
-                        freqs = freqs[idx]
-                        powers = powers[idx]
+                if grid.has_aliases:
+                    keep = grid.mask_for(freqs)
+                    freqs, powers = freqs[keep], powers[keep]
 
                 copy = np.ma.copy(data).T
                 fap = fap_baluev(copy[:,0], copy[:,2], powers, np.max(freqs))
@@ -616,27 +442,7 @@ def find_periods(algorithm, lightcurves, freqs, batch_size=1,
                 if np.mod(jj,10) == 0:
                     print("%d/%d"%(jj,len(lightcurves)))
 
-                copy = np.ma.copy(data).T
-                copy[:,1] = (copy[:,1]  - np.min(copy[:,1])) \
-                   / (np.max(copy[:,1]) - np.min(copy[:,1]))
-
-                freqs, aovs = np.empty((0,1)), np.empty((0,1))
-                for ii, fr0 in enumerate(freqs_to_keep[jj]):
-                    err = copy[:,2]
-                    aov, frtmp, _ = amhw(copy[:,0], copy[:,1], err,
-                                         fr0=fr0-50*df,
-                                         fstop=fr0+50*df,
-                                         fstep=df/2.0,
-                                         nh2=4)
-                    idx = np.where(frtmp > 0)[0]
-
-                    aovs = np.append(aovs,aov[idx])
-                    freqs = np.append(freqs,frtmp[idx])
-
-                significance = np.abs(np.mean(aovs)-np.max(aovs))/np.std(aovs)
-                periods = 1./freqs
-                significance = np.max(aovs)
-                period = periods[np.argmax(aovs)]
+                period, significance = calc_AOV(data, freqs_to_keep[jj], df)
 
                 periods_best.append(period)
                 significances.append(significance)
@@ -702,12 +508,10 @@ def find_periods(algorithm, lightcurves, freqs, batch_size=1,
             for jj, (data, out, entropies2) in enumerate(zip(lightcurves, results1, results2)):
                 entropies = entropies2[0]
                 freqs1, powers = out
-                if doRemoveTerrestrial and (freqs_to_remove is not None):
-                    for pair in freqs_to_remove:
-                        idx = np.where((freqs1 < pair[0]) | (freqs1 > pair[1]))[0]
-                        freqs1 = freqs1[idx]
-                        powers = powers[idx]
-                        entropies = entropies[idx]
+                if grid.has_aliases:
+                    keep = grid.mask_for(freqs1)
+                    freqs1, powers = freqs1[keep], powers[keep]
+                    entropies = entropies[grid.mask]
 
                 #copy = np.ma.copy(data).T
                 #fap = fap_baluev(copy[:,0], copy[:,2], powers, np.max(freqs))
@@ -718,7 +522,7 @@ def find_periods(algorithm, lightcurves, freqs, batch_size=1,
                 #significance = significance2
                 idx = np.argmax(significance)
 
-                period = 1./freqs[idx]
+                period = 1./freqs1[idx]
                 significance = significance[idx]
 
                 periods_best.append(period)
@@ -729,6 +533,7 @@ def find_periods(algorithm, lightcurves, freqs, batch_size=1,
             from cuvarbase.lombscargle import fap_baluev
             from reikna import cluda
             from reikna.fft.fft import FFT
+            import ztfperiodic.utils
 
             T = 30.0/86400.0
             fs = 1.0/T
@@ -786,7 +591,7 @@ def find_periods(algorithm, lightcurves, freqs, batch_size=1,
 
     elif doCPU:
     
-        periods = 1/freqs
+        periods = grid.periods
         period_jobs=1
     
         if algorithm == "LS":
@@ -813,24 +618,32 @@ def find_periods(algorithm, lightcurves, freqs, batch_size=1,
                 significances.append(significance)
     
         elif algorithm == "CE":
-            from ztfperiodic.period import CE
+            from ztfperiodic.period import CE_batch
             for ii,data in enumerate(lightcurves):
-                if np.mod(ii,1) == 0:
+                if np.mod(ii,10) == 0:
                     print("%d/%d"%(ii,len(lightcurves)))
-    
+
                 copy = np.ma.copy(data).T
                 copy[:,1] = (copy[:,1]  - np.min(copy[:,1])) \
                    / (np.max(copy[:,1]) - np.min(copy[:,1]))
-                entropies = []
-                for period in periods:
-                    entropy = CE(period, data=copy, xbins=phase_bins, ybins=mag_bins)
-                    entropies.append(entropy)
+                entropies = CE_batch(periods, data=copy,
+                                     xbins=phase_bins, ybins=mag_bins)
                 significance = np.abs(np.mean(entropies)-np.min(entropies))/np.std(entropies)
                 period = periods[np.argmin(entropies)]
     
                 periods_best.append(period)
                 significances.append(significance)
     
+        elif algorithm.split("_")[0] in ["ECE", "EAOV", "ELS"]:
+            periods_best, significances, pdots = find_periods_periodfind(
+                algorithm, lightcurves, grid,
+                doGPU=False,
+                doUsePDot=doUsePDot,
+                doSingleTimeSegment=doSingleTimeSegment,
+                phase_bins=phase_bins, mag_bins=mag_bins,
+                batch_size=batch_size,
+                Ncore=Ncore if doParallel else 1)
+
         elif algorithm == "AOV":
             from ztfperiodic.pyaov.pyaov import aovw, amhw
             for ii,data in enumerate(lightcurves):
@@ -852,49 +665,263 @@ def find_periods(algorithm, lightcurves, freqs, batch_size=1,
                 significances.append(significance)
    
         elif algorithm == "AOV_cython":
-            from AOV_cython import aov as pyaov
-            for ii,data in enumerate(lightcurves):
-                if np.mod(ii,10) == 0:
-                    print("%d/%d"%(ii,len(lightcurves)))
+            try:
+                from ztfperiodic.aov_cython import aov_batch
+            except ImportError:
+                raise ImportError("AOV_cython needs the ztfperiodic.aov_cython "
+                                  "extension, which is not built; install "
+                                  "Cython and a C compiler and reinstall "
+                                  "ztfperiodic, or use -a AOV")
+            from ztfperiodic.lcbatch import LightcurveBatch
+
+            batch = LightcurveBatch.from_lists(lightcurves)
+            time, mag, magerr, lengths = batch.padded()
+            valid = np.arange(mag.shape[1])[None,:] < lengths[:,None]
+            magmin = np.min(np.where(valid, mag, np.inf), axis=1)
+            magmax = np.max(np.where(valid, mag, -np.inf), axis=1)
+            mag = (mag - magmin[:,None])/(magmax - magmin)[:,None]
+
+            # light curves are run in chunks to bound the periodogram memory
+            nchunk = max(1, int(2**24 // max(len(freqs), 1)))
+            for start in range(0, len(batch), nchunk):
+                stop = min(start + nchunk, len(batch))
+                print("%d/%d"%(start,len(batch)))
+
+                aov = aov_batch(time[start:stop], mag[start:stop],
+                                lengths[start:stop], freqs, r=10,
+                                n_jobs=Ncore if doParallel else 1)
+
+                significance = np.abs(np.mean(aov,axis=1)-np.max(aov,axis=1))/np.std(aov,axis=1)
+                period = 1.0/freqs[np.argmax(aov,axis=1)]
+
+                periods_best.extend(list(period))
+                significances.extend(list(significance))
+ 
+    return np.array(periods_best), np.array(significances), np.array(pdots)
 
-                copy = np.ma.copy(data).T
-                copy[:,1] = (copy[:,1]  - np.min(copy[:,1])) \
-                   / (np.max(copy[:,1]) - np.min(copy[:,1]))
+def lightcurve_baselines(lightcurves):
+    """Baseline (time span) of each light curve, nan if empty."""
+
+    if hasattr(lightcurves, 'time_max'):
+        return lightcurves.time_max() - lightcurves.time_min()
+
+    baselines = np.nan*np.ones(len(lightcurves))
+    for ii, lightcurve in enumerate(lightcurves):
+        if len(lightcurve[0]) > 0:
+            baselines[ii] = np.max(lightcurve[0]) - np.min(lightcurve[0])
+    return baselines
+
+def find_periods_baseline_bins(algorithm, lightcurves, fmin, fmax,
+                               samples_per_peak=10, freqs_to_remove=None,
+                               baseline_ratio=2.0, nbins=8,
+                               frequencyGridDir=None, **kwargs):
+    """find_periods with one frequency grid per bin of baseline.
+
+    The light curves are grouped in bins of baseline a factor
+    baseline_ratio wide, and each bin is searched over fmin to fmax with
+    df = 1/(samples_per_peak*baseline) for the longest baseline of the
+    bin, rather than of the whole job. Every light curve is thus sampled
+    at least as finely as its own baseline needs. The outputs are those
+    of find_periods, in the order of lightcurves.
+
+    freqs_to_remove windows are masked if doRemoveTerrestrial is passed
+    in kwargs; the grids are cached in frequencyGridDir if given.
+    """
+
+    if not kwargs.get("doRemoveTerrestrial", False):
+        freqs_to_remove = None
+
+    baselines = lightcurve_baselines(lightcurves)
+    bins = baseline_bins(baselines, ratio=baseline_ratio, nbins=nbins)
+
+    nlightcurves = len(baselines)
+    periods_best, significances, pdots = None, None, None
+    nfreqs = 0
+    for baseline, idx in bins:
+        if not np.isfinite(baseline):
+            # no light curve with two epochs: the job grid, fmin = 2/baseline
+            baseline = 2./fmin
+        grid = FrequencyGrid.cached(frequencyGridDir, fmin, fmax,
+                                    1./(samples_per_peak*baseline),
+                                    freqs_to_remove=freqs_to_remove)
+        print('Baseline bin %.2f days: %d lightcurves, %d frequencies' % (baseline, len(idx), len(grid.masked)))
+        nfreqs += len(idx)*len(grid.masked)
+
+        if hasattr(lightcurves, 'take'):
+            lightcurves_bin = lightcurves.take(idx)
+        else:
+            lightcurves_bin = [lightcurves[ii] for ii in idx]
+        out = find_periods(algorithm, lightcurves_bin, grid, **kwargs)
+
+        out = [np.asarray(x) for x in out]
+        if periods_best is None:
+            periods_best, significances, pdots = [
+                np.empty((nlightcurves,) + x.shape[1:], dtype=x.dtype)
+                for x in out]
+        periods_best[idx] = out[0]
+        significances[idx] = out[1]
+        pdots[idx] = out[2]
+
+    print('Frequencies evaluated: %d per lightcurve on average' % (nfreqs/max(nlightcurves, 1)))
+
+    if periods_best is None:
+        return np.array([]), np.array([]), np.array([])
+
+    return periods_best, significances, pdots
+
+def find_periods_periodfind(algorithm, lightcurves, freqs,
+                            doGPU=True,
+                            doUsePDot=False, doSingleTimeSegment=False,
+                            phase_bins=20, mag_bins=10,
+                            batch_size=1,
+                            Ncore=-1):
+    """Run the ECE, EAOV or ELS engines (and their _periodogram variants)
+    on the masked frequencies of freqs (an array or a FrequencyGrid).
+
+    With doGPU, the CUDA periodfind package is used; otherwise the
+    equivalent CPU implementation in ztfperiodic.periodfind_cpu,
+    parallelized over Ncore cores (-1 for all cores).
+    """
+
+    grid = as_frequency_grid(freqs)
+    freqs = grid.masked
+
+    engine = algorithm.split("_")[0]
+    doPeriodogram = algorithm.endswith("_periodogram")
 
-                aov = pyaov(freqs, copy[:,0], copy[:,1],
-                            np.mean(copy[:,1]),
-                            len(copy[:,0]), 10, len(freqs))
+    if doGPU:
+        if engine == "ECE":
+            from periodfind.ce import ConditionalEntropy
+            #ce = ConditionalEntropy(phase_bins=phase_bins, mag_bins=mag_bins)
+            finder = ConditionalEntropy(phase_bins, mag_bins)
+        elif engine == "EAOV":
+            from periodfind.aov import AOV
+            finder = AOV(phase_bins)
+        elif engine == "ELS":
+            from periodfind.ls import LombScargle
+            finder = LombScargle()
+    else:
+        if engine == "ECE":
+            from ztfperiodic.periodfind_cpu import ConditionalEntropy
+            finder = ConditionalEntropy(phase_bins, mag_bins, n_jobs=Ncore)
+        elif engine == "EAOV":
+            from ztfperiodic.periodfind_cpu import AOV
+            finder = AOV(phase_bins, n_jobs=Ncore)
+        elif engine == "ELS":
+            from ztfperiodic.periodfind_cpu import LombScargle
+            finder = LombScargle(n_jobs=Ncore)
+
+    if doUsePDot:
+        num_pdots = 10
+        max_pdot = 1e-10
+        min_pdot = 1e-12
+        pdots_to_test = -np.logspace(np.log10(min_pdot), np.log10(max_pdot), num_pdots)
+        pdots_to_test = np.append(0,pdots_to_test)
+        #pdots_to_test = np.array([-2.365e-11])
+    else:
+        pdots_to_test = np.array([0.0])
+
+    if doSingleTimeSegment:
+        tt = np.empty((0,1))
+        for lightcurve in lightcurves:
+            tt = np.unique(np.append(tt, lightcurve[0]))
+
+    maxn = -np.inf
+    time_stack, mag_stack = [], []
+    for lightcurve in lightcurves:
+        if doSingleTimeSegment:
+            xy, x_ind, y_ind = np.intersect1d(tt, lightcurve[0],
+                                              return_indices=True)
+            mag_array = 999*np.ones(tt.shape)
+            magerr_array = 999*np.ones(tt.shape)
+            mag_array[x_ind] = lightcurve[1][y_ind]
+            magerr_array[x_ind] = lightcurve[2][y_ind]
+            lightcurve = (tt, mag_array, magerr_array)
+        else:
+            idx = np.argsort(lightcurve[0])
+            tmin = np.min(lightcurve[0])
+            lightcurve = (lightcurve[0][idx]-tmin,
+                          lightcurve[1][idx],
+                          lightcurve[2][idx])
+
+        time_stack.append(lightcurve[0].astype(np.float32))
+        lc = lightcurve[1]
+        lc = (lc - np.min(lc))/(np.max(lc)-np.min(lc))
+        mag_stack.append(lc.astype(np.float32))
+
+        if len(lightcurve[0]) > maxn:
+            maxn = len(lightcurve[0])
+
+    print("Number of lightcurves: %d" % len(time_stack))
+    print("Max length of lightcurves: %d" % maxn)
+    print("Batch size: %d" % batch_size)
+    print("Number of frequency bins: %d" % len(freqs))
+    print("Number of phase bins: %d" % phase_bins)
+    print("Number of magnitude bins: %d" % mag_bins)
+
+    periods = grid.periods32
+    pdots_to_test = pdots_to_test.astype(np.float32)
+
+    significances = np.zeros((len(lightcurves),1))
+    pdots = np.zeros((len(lightcurves),1))
+
+    if doPeriodogram:
+        periods_best = []
+        data_out = finder.calc(time_stack, mag_stack, periods, pdots_to_test,
+                               output='periodogram')
+
+        # entropy is best at its minimum, AOV and LS at their maximum
+        extremum = getattr(finder, "extremum",
+                           "min" if engine == "ECE" else "max")
+        for ii, stat in enumerate(data_out):
+            data = np.asarray(stat.data)
+            if extremum == "min":
+                idx = np.argmin(data)
+            else:
+                idx = np.argmax(data)
+            significance = np.abs(np.mean(data)-data.flat[idx])/np.std(data)
+            period = periods[np.unravel_index(idx, data.shape)[0]]
 
-                significance = np.abs(np.mean(aov)-np.max(aov))/np.std(aov)
-                freq = freqs[np.argmax(aov)]
-                period = 1.0/freq
+            if np.isnan(significance):
+                raise ValueError("Oops... significance  is nan... something went wrong")
 
-                periods_best.append(period)
-                significances.append(significance)
- 
-    return np.array(periods_best), np.array(significances), np.array(pdots)
+            periods_best.append({'period': period, 'data': stat.data})
+            pdots[ii] = pdots_to_test[0]
+            significances[ii] = significance
+        pdots, significances = pdots.flatten(), significances.flatten()
+    else:
+        periods_best = np.zeros((len(lightcurves),1))
+        data_out = finder.calc(time_stack, mag_stack, periods, pdots_to_test)
+
+        for ii, stat in enumerate(data_out):
+            if np.isnan(stat.significance):
+                raise ValueError("Oops... significance  is nan... something went wrong")
+
+            periods_best[ii] = stat.params[0]
+            pdots[ii] = stat.params[1]
+            significances[ii] = stat.significance
+        pdots, periods_best, significances = pdots.flatten(), periods_best.flatten(), significances.flatten()
+
+    return periods_best, significances, pdots
 
 def calc_AOV(data, freqs_to_keep, df):
+    """Refine the candidate frequencies of a light curve with the
+    multiharmonic AOV periodogram, evaluated once on the union of the
+    windows +- 50*df around all candidates (step df/2)."""
+
     copy = np.ma.copy(data).T
     copy[:,1] = (copy[:,1]  - np.min(copy[:,1])) \
        / (np.max(copy[:,1]) - np.min(copy[:,1]))
 
-    freqs, aovs = np.empty((0,1)), np.empty((0,1))
-    for ii, fr0 in enumerate(freqs_to_keep):
-        err = copy[:,2]
-        aov, frtmp, _ = amhw(copy[:,0], copy[:,1], err,
-                             fr0=fr0-50*df,
-                             fstop=fr0+50*df,
-                             fstep=df/2.0,
-                             nh2=4)
-        idx = np.where(frtmp > 0)[0]
-
-        aovs = np.append(aovs,aov[idx])
-        freqs = np.append(freqs,frtmp[idx])
-
-    significance = np.abs(np.mean(aovs)-np.max(aovs))/np.std(aovs)
-    periods = 1./freqs
+    freqs = refinement_grid(freqs_to_keep, df, nwin=50, oversample=2)
+    aovs = aovmhw(copy[:,0], copy[:,1], copy[:,2], freqs, nh2=4)
+
     significance = np.max(aovs)
-    period = periods[np.argmax(aovs)]
+    period = 1./freqs[np.argmax(aovs)]
 
     return [period, significance]
+
+def calc_AOV_batch(lightcurves, freqs_to_keep, df):
+    """calc_AOV of each light curve, with its own frequencies to keep."""
+    return [calc_AOV(data, freqs, df)
+            for data, freqs in zip(lightcurves, freqs_to_keep)]
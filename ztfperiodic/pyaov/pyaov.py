@@ -6,19 +6,20 @@
 # Based on the wrapper scheme contributed by Ewald Zietsman <ewald.zietsman@gmail.com>
 
 import aov as _aov
-import matplotlib.pyplot as pl
 import numpy as np
-print("")
-print("Time Series Analysis Package (TSA)")
-print("by Alex Schwarzenberg-Czerny (C)2011")
-print("")
-print("Routines: amhw, aovw, atrw, covar, fgrid, fouw, normalize, peak,")
-print("pldat, plper, pspw, totals")
-print("For help type e.g.: help(pyaov.amhw)")
-print("")
-print("General Reference:")
-print("Schwarzenberg-Czerny, A., 1998, Baltic Astronomy, v.7, p.43-69")
-print("")
+
+def banner():
+    print("")
+    print("Time Series Analysis Package (TSA)")
+    print("by Alex Schwarzenberg-Czerny (C)2011")
+    print("")
+    print("Routines: amhw, aovw, atrw, covar, fgrid, fouw, normalize, peak,")
+    print("pldat, plper, pspw, totals")
+    print("For help type e.g.: help(pyaov.amhw)")
+    print("")
+    print("General Reference:")
+    print("Schwarzenberg-Czerny, A., 1998, Baltic Astronomy, v.7, p.43-69")
+    print("")
 
 def peak(f):
     '''
@@ -525,6 +526,8 @@ def pldat(time, value):
         Plot window. Close it to proceed further.
     '''
 
+    import matplotlib.pyplot as pl
+
     pl.figure(figsize=(9,9))
     
     pl.subplot(211)
@@ -553,6 +556,8 @@ def plper(frmax, time, value, freqs, th):
         Plot window. Close it to proceed further.
     '''
 
+    import matplotlib.pyplot as pl
+
     pl.figure(figsize=(9,9))
     
     if frmax>0. :   # plot phase folded data
@@ -573,6 +578,8 @@ def plper(frmax, time, value, freqs, th):
 # run. It will not run if you import this file.
 if __name__ == "__main__":
     
+    banner()
+
     # import aov as _aov
     # generate random data
     x, y, z = _aov.aov.test(100)
@@ -0,0 +1,176 @@
+"""
+Concurrent Kowalski queries.
+
+`QueryPool` holds several authenticated Kowalski connections and has the
+same `query(query=...)` method as a single `penquins.Kowalski` client, so
+it can be passed as `kow` to all of the loaders in `ztfperiodic.utils`.
+Each query borrows one connection, so that up to one query per connection
+runs at a time when the loaders are called from several threads, and
+`QueryPool.map` runs a list of independent queries concurrently.
+
+Failed queries are retried with exponential backoff and random jitter, so
+that many jobs hitting an overloaded server do not all retry at the same
+time. The pool also keeps the latency of every query, see
+`QueryPool.stats`.
+"""
+
+import time
+import random
+import queue
+import threading
+
+import numpy as np
+
+
+def backoff_time(cnt, backoff=1.0, max_backoff=60.0):
+    """Wait before retry number cnt+1: exponential, capped at
+    max_backoff, and scaled by a random factor between 0.5 and 1."""
+
+    return min(max_backoff, backoff*2**cnt)*random.uniform(0.5, 1.0)
+
+
+def query_with_retries(kow, qu, nquery=5, backoff=1.0, max_backoff=60.0):
+    """Run a query, retrying up to nquery times until it returns data.
+
+    Parameters
+    ----------
+    kow : penquins.Kowalski or QueryPool
+        Kowalski client.
+    qu : dict
+        Kowalski query.
+    nquery : int
+        Maximum number of attempts.
+    backoff : float
+        Wait in seconds before the first retry; doubled at every retry.
+    max_backoff : float
+        Maximum wait in seconds between two attempts.
+
+    Returns
+    -------
+    r : dict
+        Result of the last attempt (empty if all of them raised).
+    """
+
+    r = {}
+    for cnt in range(nquery):
+        try:
+            r = kow.query(query=qu)
+        except Exception as e:
+            print('Kowalski query failed: %s' % str(e))
+            r = {}
+        if (r is not None) and ("data" in r):
+            break
+        if cnt < nquery - 1:
+            time.sleep(backoff_time(cnt, backoff=backoff,
+                                    max_backoff=max_backoff))
+    if r is None:
+        r = {}
+    return r
+
+
+def connect(username, password, nquery=10, backoff=1.0, max_backoff=60.0):
+    """Authenticated Kowalski client, retrying up to nquery times."""
+
+    from penquins import Kowalski
+
+    for cnt in range(nquery):
+        try:
+            return Kowalski(username=username, password=password)
+        except Exception as e:
+            print('Kowalski connection failed: %s' % str(e))
+            if cnt < nquery - 1:
+                time.sleep(backoff_time(cnt, backoff=backoff,
+                                        max_backoff=max_backoff))
+
+    raise Exception('Kowalski connection failed...')
+
+
+class QueryPool(object):
+    """Pool of Kowalski connections shared by concurrent queries.
+
+    Parameters
+    ----------
+    connections : list
+        Authenticated Kowalski clients.
+    """
+
+    def __init__(self, connections):
+        self.connections = list(connections)
+        if len(self.connections) == 0:
+            raise ValueError('QueryPool needs at least one connection')
+
+        self._free = queue.Queue()
+        for kow in self.connections:
+            self._free.put(kow)
+
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.nfailed = 0
+
+    @classmethod
+    def connect(cls, username, password, nconnections=4, nquery=10):
+        """Pool of nconnections new Kowalski clients."""
+
+        return cls([connect(username, password, nquery=nquery)
+                    for ii in range(nconnections)])
+
+    @property
+    def nconnections(self):
+        return len(self.connections)
+
+    def query(self, query):
+        """Run a query on the next free connection (single attempt)."""
+
+        kow = self._free.get()
+        start = time.time()
+        try:
+            r = kow.query(query=query)
+        except Exception as e:
+            print('Kowalski query failed: %s' % str(e))
+            r = {}
+        finally:
+            self._free.put(kow)
+        latency = time.time() - start
+
+        with self._lock:
+            self.latencies.append(latency)
+            if (r is None) or (not "data" in r):
+                self.nfailed = self.nfailed + 1
+
+        return r
+
+    def map(self, queries, nquery=5):
+        """Run independent queries concurrently, one per connection,
+        each with retries; results are in the order of queries."""
+
+        if (self.nconnections == 1) or (len(queries) <= 1):
+            return [query_with_retries(self, qu, nquery=nquery)
+                    for qu in queries]
+
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=self.nconnections) as executor:
+            return list(executor.map(
+                lambda qu: query_with_retries(self, qu, nquery=nquery),
+                queries))
+
+    def stats(self):
+        """Number of queries (attempts), failures and latencies in s."""
+
+        with self._lock:
+            latencies = np.array(self.latencies)
+            nfailed = self.nfailed
+
+        stats = {"nqueries": len(latencies), "nfailed": nfailed}
+        if len(latencies) > 0:
+            stats["mean"] = np.mean(latencies)
+            stats["median"] = np.median(latencies)
+            stats["p90"] = np.percentile(latencies, 90)
+            stats["max"] = np.max(latencies)
+        return stats
+
+    def print_stats(self):
+        stats = self.stats()
+        print('Kowalski queries: %d (%d failed) on %d connections' % (
+              stats["nqueries"], stats["nfailed"], self.nconnections))
+        if stats["nqueries"] > 0:
+            print('Query latency: mean %.2f s, median %.2f s, 90%% %.2f s, max %.2f s' % (stats["mean"], stats["median"], stats["p90"], stats["max"]))
@@ -1,33 +1,37 @@
-
 import os, sys
+import json
+import hashlib
 import pandas as pd
 import numpy as np
 import tables
+import h5py
 import glob
 import time
 
-from scipy.interpolate import interpolate as interp
-
 import matplotlib
 matplotlib.use('Agg')
-import matplotlib.patches as patches
+matplotlib.rcParams.update({'font.size': 16})
+matplotlib.rcParams['contour.negative_linestyle'] = 'solid'
 
-import astropy.io.ascii as asci
 from astropy import units as u
 from astropy.time import Time
 from astropy.coordinates import SkyCoord, BarycentricTrueEcliptic, EarthLocation
 
-import requests
-import tqdm
-
-from astroquery.vizier import Vizier
-
-import matplotlib
-matplotlib.use('Agg')
-matplotlib.rcParams.update({'font.size': 16})
-matplotlib.rcParams['contour.negative_linestyle'] = 'solid'
-from matplotlib.colors import LogNorm
-import matplotlib.pyplot as plt
+from ztfperiodic.lazy import lazy_import
+from ztfperiodic.crossmatch import CatalogIndex
+from ztfperiodic.cadence import HC_CADENCE, next_gaps, thin_cadence
+from ztfperiodic.lccache import query_key, documents_to_columns
+from ztfperiodic.lccache import empty_columns, concatenate_columns
+from ztfperiodic.lccache import select_detections
+from ztfperiodic.querypool import QueryPool, query_with_retries
+
+# only needed by a few loaders, imported at first use
+interp = lazy_import('scipy.interpolate')
+patches = lazy_import('matplotlib.patches')
+asci = lazy_import('astropy.io.ascii')
+requests = lazy_import('requests')
+tqdm = lazy_import('tqdm')
+vizier = lazy_import('astroquery.vizier')
 
 LOGIN_URL = "https://irsa.ipac.caltech.edu/account/signon/login.do"
 meta_baseurl="https://irsa.ipac.caltech.edu/ibe/search/ztf/products/"
@@ -48,7 +52,7 @@ def gaia_query(ra_deg, dec_deg, rad_deg, maxmag=25,
     https://gea.esac.esa.int/archive/documentation/GDR2/Gaia_archive/chap_datamodel/sec_dm_main_tables/ssec_dm_gaia_source.html
     
     """
-    vquery = Vizier(columns=['Source', 'RA_ICRS', 'DE_ICRS',
+    vquery = vizier.Vizier(columns=['Source', 'RA_ICRS', 'DE_ICRS',
                              'e_RA_ICRS', 'e_DE_ICRS',
                              'phot_g_mean_mag','phot_r_mean_mag',
                              'BPmag', 'Gmag', 'RPmag',
@@ -89,7 +93,7 @@ def ps1_query(ra_deg, dec_deg, rad_deg, maxmag=25,
                 maxsources: maximum number of sources
     returns: astropy.table object
     """
-    vquery = Vizier(columns=['Source', 'RAJ2000', 'DEJ2000',
+    vquery = vizier.Vizier(columns=['Source', 'RAJ2000', 'DEJ2000',
                              'gmag','rmag','imag','zmag','ymag',
                              'e_gmag','e_rmag','e_imag','e_zmag','e_ymag'],
                     column_filters={"gmag":
@@ -120,7 +124,7 @@ def galex_query(ra_deg, dec_deg, rad_deg, maxmag=25,
                 maxsources: maximum number of sources
     returns: astropy.table object
     """
-    vquery = Vizier(columns=['Source', 'RAJ2000', 'DEJ2000',
+    vquery = vizier.Vizier(columns=['Source', 'RAJ2000', 'DEJ2000',
                              'FUVmag', 'NUVmag',
                              'e_FUVmag', 'e_NUVmag'],
                     column_filters={"FUVmag":
@@ -152,7 +156,7 @@ def sdss_query(ra_deg, dec_deg, rad_deg, maxmag=25,
                 maxsources: maximum number of sources
     returns: astropy.table object
     """
-    vquery = Vizier(columns=['Source', 'RA_ICRS', 'DE_ICRS',
+    vquery = vizier.Vizier(columns=['Source', 'RA_ICRS', 'DE_ICRS',
                              'umag', 'gmag', 'rmag', 'imag', 'zmag',
                              'e_umag', 'e_gmag', 'e_rmag', 'e_imag', 'e_zmag'],
                     column_filters={"gmag":
@@ -255,6 +259,109 @@ def get_catalog(data):
 
     return SkyCoord(ra=np.array(ras)*u.degree, dec=np.array(decs)*u.degree, frame='icrs')
 
+# catalogs of the lightcurve cone searches of get_kowalski
+LIGHTCURVE_CATALOGS = { "ZTF_sources_20200401": { "filter": "{}", "projection": "{'ra': 1, 'dec': 1, 'data.hjd': 1, 'data.mag': 1, 'data.magerr': 1, 'data.programid': 1, 'data.maglim': 1, 'data.ra': 1, 'data.dec': 1, 'data.catflags': 1, 'filter': 1}" }, "Gaia_DR2": { "filter": "{}", "projection": "{'parallax': 1, 'parallax_error': 1, 'phot_g_mean_mag': 1, 'phot_bp_mean_mag': 1, 'phot_rp_mean_mag': 1, 'phot_g_mean_mag_err': 1, 'phot_bp_mean_flux_over_error': 1, 'phot_rp_mean_flux_over_error': 1, 'ra': 1, 'dec': 1}"}, "ZTF_alerts": { "filter": "{}", "projection": "{'candidate.jd': 1,'candidate.fid': 1, 'candidate.magpsf': 1, 'candidate.sigmapsf': 1, 'candidate.magnr': 1, 'candidate.sigmagnr': 1, 'candidate.distnr': 1, 'candidate.fid': 1, 'candidate.programid': 1, 'candidate.maglim': 1, 'candidate.isdiffpos': 1, 'candidate.ra': 1, 'candidate.dec': 1}" } }
+
+def cone_search_query(radec, radius, catalogs):
+    """Kowalski cone search of the positions radec ({key: [ra, dec]})
+    with radius in arcsec"""
+
+    return { "query_type": "cone_search", "query": {"object_coordinates": {"radec": radec, "cone_search_radius": "%.2f"%radius, "cone_search_unit": "arcsec" }, "catalogs": catalogs } }
+
+def document_position(dat):
+    """Position of a Kowalski document: the candidate position of alerts,
+    the median of the detections of ZTF_sources and ra, dec otherwise"""
+
+    if 'candidate' in dat:
+        return dat["candidate"]["ra"], dat["candidate"]["dec"]
+    if 'ra' in dat:
+        return dat["ra"], dat["dec"]
+    ras = [d["ra"] for d in dat["data"] if "ra" in d]
+    decs = [d["dec"] for d in dat["data"] if "dec" in d]
+    if len(ras) == 0:
+        return np.nan, np.nan
+    return np.median(ras), np.median(decs)
+
+def cone_search_batch(kow, ras, decs, radii, catalogs, cache=None,
+                      nquery=10, batch_size=None):
+    """Cone searches around many positions, batch_size positions per
+    Kowalski query (all of them in one if None)
+
+    Each query uses the largest radius of its positions. The documents
+    returned are made unique by _id and assigned to every position within
+    its own radius with a CatalogIndex, so that overlapping cones share
+    their documents. The queries are independent and run concurrently if
+    kow is a QueryPool.
+
+    Parameters
+    ----------
+    kow : penquins.Kowalski or QueryPool
+    ras, decs : array-like
+        positions in degrees
+    radii : array-like
+        cone search radii in arcsec
+    catalogs : dict
+        catalogs of the query, with their filters and projections
+    batch_size : int
+        number of positions per query
+
+    Returns
+    -------
+    documents : dict
+        for each catalog, one list of documents per position (empty for
+        the positions of failed queries); None if all queries failed
+    """
+
+    ras = np.atleast_1d(np.asarray(ras, dtype=np.float64))
+    decs = np.atleast_1d(np.asarray(decs, dtype=np.float64))
+    # radii are sent with two decimals, as in the single cone searches
+    radii = np.round(np.broadcast_to(np.asarray(radii, dtype=np.float64),
+                                     ras.shape), 2)
+
+    if (batch_size is None) or (batch_size < 1):
+        batch_size = max(len(ras), 1)
+    starts = list(range(0, len(ras), batch_size))
+
+    qus = []
+    for start in starts:
+        stop = start + batch_size
+        radec = {str(ii): [ra, dec] for ii, (ra, dec) in
+                 enumerate(zip(ras[start:stop], decs[start:stop]))}
+        qus.append(cone_search_query(radec, np.max(radii[start:stop]),
+                                     catalogs))
+    rs = cached_queries(kow, qus, cache=cache, nquery = nquery)
+
+    if not any(["data" in r for r in rs]):
+        return None
+
+    documents = {catalog: [[] for ii in range(len(ras))]
+                 for catalog in catalogs}
+    for start, r in zip(starts, rs):
+        if not "data" in r:
+            print("Query for positions %d-%d failed... continuing." % (start, start+batch_size))
+            continue
+        stop = start + batch_size
+        for catalog in catalogs:
+            unique = {}
+            for key in r["data"][catalog]:
+                for dat in r["data"][catalog][key]:
+                    unique[str(dat["_id"])] = dat
+            datas = list(unique.values())
+            if len(datas) == 0:
+                continue
+
+            positions = np.array([document_position(dat) for dat in datas])
+            valid = np.where(np.isfinite(positions[:,0]))[0]
+            if len(valid) == 0:
+                continue
+            index = CatalogIndex(positions[valid,0], positions[valid,1])
+            idx1, idx2 = index.query_circle(ras[start:stop], decs[start:stop],
+                                            radii[start:stop]/3600.0)
+            for ii, jj in zip(idx1, idx2):
+                documents[catalog][start+ii].append(datas[valid[jj]])
+
+    return documents
+
 def get_kowalski_external(ra, dec, kow, radius = 5.0):
 
     qu = { "query_type": "cone_search", "query": {"object_coordinates": {"radec": {'test': [ra,dec]}, "cone_search_radius": "%.2f"%radius, "cone_search_unit": "arcsec" }, "catalogs": { "Gaia_DR2": { "filter": "{}", "projection": "{}"}, "AllWISE": { "filter": "{}", "projection": "{}" }, "PS1_DR1": { "filter": "{}", "projection": "{}"}, "GALEX": { "filter": "{}", "projection": "{}"} } } }
@@ -365,15 +472,17 @@ def get_kowalski_external(ra, dec, kow, radius = 5.0):
     return external
 
 def get_kowalski(ra, dec, kow, radius = 5.0, oid = None,
-                 program_ids = [1, 2,3], min_epochs = 1, name = None):
+                 program_ids = [1, 2,3], min_epochs = 1, name = None,
+                 cache = None):
 
     tmax = Time('2020-01-01T00:00:00', format='isot', scale='utc').jd
 
     #qu = { "query_type": "cone_search", "object_coordinates": { "radec": "[(%.5f,%.5f)]"%(ra,dec), "cone_search_radius": "%.2f"%radius, "cone_search_unit": "arcsec" }, "catalogs": { "ZTF_sources_20191101": { "filter": "{}", "projection": "{'data.hjd': 1, 'data.mag': 1, 'data.magerr': 1, 'data.programid': 1, 'data.maglim': 1, 'data.ra': 1, 'data.dec': 1, 'filter': 1}" } } }
-    qu = { "query_type": "cone_search", "query": {"object_coordinates": {"radec": {'test': [ra,dec]}, "cone_search_radius": "%.2f"%radius, "cone_search_unit": "arcsec" }, "catalogs": { "ZTF_sources_20200401": { "filter": "{}", "projection": "{'data.hjd': 1, 'data.mag': 1, 'data.magerr': 1, 'data.programid': 1, 'data.maglim': 1, 'data.ra': 1, 'data.dec': 1, 'data.catflags': 1, 'filter': 1}" }, "Gaia_DR2": { "filter": "{}", "projection": "{'parallax': 1, 'parallax_error': 1, 'phot_g_mean_mag': 1, 'phot_bp_mean_mag': 1, 'phot_rp_mean_mag': 1, 'phot_g_mean_mag_err': 1, 'phot_bp_mean_flux_over_error': 1, 'phot_rp_mean_flux_over_error': 1, 'ra': 1, 'dec': 1}"}, "ZTF_alerts": { "filter": "{}", "projection": "{'candidate.jd': 1,'candidate.fid': 1, 'candidate.magpsf': 1, 'candidate.sigmapsf': 1, 'candidate.magnr': 1, 'candidate.sigmagnr': 1, 'candidate.distnr': 1, 'candidate.fid': 1, 'candidate.programid': 1, 'candidate.maglim': 1, 'candidate.isdiffpos': 1, 'candidate.ra': 1, 'candidate.dec': 1}" } } } }
+    qu = cone_search_query({'test': [ra,dec]}, radius,
+                           LIGHTCURVE_CATALOGS)
 
     start = time.time()
-    r = database_query(kow, qu, nquery = 10)
+    r = cached_query(kow, qu, cache=cache, nquery = 10)
     end = time.time()
     loadtime = end - start
 
@@ -390,31 +499,33 @@ def get_kowalski(ra, dec, kow, radius = 5.0, oid = None,
     key = list(data3.keys())[0]
     data3 = data3[key]
 
+    print('Loaded %d lightcurves in %.5f seconds' % (len(data), loadtime))
+
+    return kowalski_lightcurves(data, data2, data3, program_ids, tmax,
+                                oid=oid, min_epochs=min_epochs, name=name)
+
+def kowalski_lightcurves(data, data2, data3, program_ids, tmax, oid=None,
+                         min_epochs=1, name=None):
+    """Lightcurves of the ZTF_sources, Gaia_DR2 and ZTF_alerts documents
+    of a cone search, as returned by get_kowalski"""
+
     cat2 = get_catalog(data2)
     cat3 = get_catalog(data3)
 
+    columns = decode_kowalski_sources(data, program_ids, tmax)
+    offsets = columns["offsets"]
+
     lightcurves = {}
-    for datlist in data:
-        objid = str(datlist["_id"])
+    for jj in range(len(columns["ids"])):
+        objid = str(columns["ids"][jj])
         if not oid is None:
             if not objid == str(oid):
                 continue
-        dat = datlist["data"]
-        filt = datlist["filter"]
-        hjd, mag, magerr, fid = [], [], [], []
-        ra, dec = [], []
-
-        for dic in dat:
-            if not dic["programid"] in program_ids: continue
-            if (dic["programid"]==1) and (dic["hjd"] > tmax): continue
-            if not dic["catflags"] == 0: continue
-
-            hjd.append(dic["hjd"])
-            mag.append(dic["mag"])
-            magerr.append(dic["magerr"])
-            ra.append(dic["ra"])
-            dec.append(dic["dec"])
-            fid.append(filt)
+        start, stop = offsets[jj], offsets[jj+1]
+        hjd, mag = columns["hjd"][start:stop], columns["mag"][start:stop]
+        magerr = columns["magerr"][start:stop]
+        ra, dec = columns["ra"][start:stop], columns["dec"][start:stop]
+        fid = np.full(stop-start, columns["filter"][jj])
         if len(hjd) < min_epochs: continue
 
         lightcurves[objid] = {}
@@ -435,8 +546,6 @@ def get_kowalski(ra, dec, kow, radius = 5.0, oid = None,
         else:
             lightcurves[objid]["name"] = name
 
-    print('Loaded %d lightcurves in %.5f seconds' % (len(data), loadtime))
-
     objids = []
     ras, decs, fids = [], [], []
     for objid in lightcurves.keys():
@@ -553,33 +662,72 @@ def get_kowalski(ra, dec, kow, radius = 5.0, oid = None,
 
     mags_alert, magerrs_alert = flux2mag(flux, fluxerr)
 
-    for hjd, mag, magerr, ra, dec, fid in zip(hjds_alert, mags_alert, magerrs_alert, ras_alert, decs_alert, fids_alert):
-
-        if np.isnan(mag):
-            continue
-        
-        idx = np.where(fid == fids)[0]
+    # nearest source of the same filter within 1 arcsec of each alert
+    match = np.full(len(mags_alert), -1, dtype=np.int64)
+    good = ~np.isnan(mags_alert)
+    for filt in np.unique(fids_alert[good]):
+        idx = np.where(fids == filt)[0]
         if len(idx) == 0:
             continue
-
-        dist = angular_distance(ra, dec, ras[idx], decs[idx])
-        dist = dist * 3600.0
-
-        if np.min(dist) > 1.0:
-            continue
- 
-        idy = np.argmin(dist)       
-        objid = objids[idx[idy]]
-
-        lightcurves[objid]["hjd"] = np.append(lightcurves[objid]["hjd"], hjd)
-        lightcurves[objid]["mag"] = np.append(lightcurves[objid]["mag"], mag)
-        lightcurves[objid]["magerr"] = np.append(lightcurves[objid]["magerr"], magerr)
-        lightcurves[objid]["ra"] = np.append(lightcurves[objid]["ra"], ra)
-        lightcurves[objid]["dec"] = np.append(lightcurves[objid]["dec"], dec)
-        lightcurves[objid]["fid"] = np.append(lightcurves[objid]["fid"], fid)
+        idy = np.where(good & (fids_alert == filt))[0]
+        index = CatalogIndex(ras[idx], decs[idx])
+        idx1, idx2 = index.query_nearest(ras_alert[idy], decs_alert[idy],
+                                         1.0/3600.0)
+        match[idy[idx1]] = idx[idx2]
+
+    # appended to each lightcurve at once, in the order of the alerts
+    order = np.argsort(match, kind='stable')
+    order = order[match[order] >= 0]
+    matched, starts = np.unique(match[order], return_index=True)
+    stops = np.append(starts[1:], len(order))
+    alert_columns = {"hjd": hjds_alert, "mag": mags_alert,
+                     "magerr": magerrs_alert, "ra": ras_alert,
+                     "dec": decs_alert, "fid": fids_alert}
+    for ii, start, stop in zip(matched, starts, stops):
+        objid = objids[ii]
+        sel = order[start:stop]
+        for key, values in alert_columns.items():
+            lightcurves[objid][key] = np.concatenate((lightcurves[objid][key],
+                                                      values[sel]))
   
     return lightcurves
 
+def get_kowalski_batch(ras, decs, kow, radii = 5.0, program_ids = [1,2,3],
+                       min_epochs = 1, names = None, cache = None,
+                       batch_size = None):
+    """get_kowalski for many positions, with one cone search query per
+    batch_size positions (run concurrently if kow is a QueryPool)
+
+    Returns one dictionary of lightcurves per position (empty if the
+    query failed)."""
+
+    tmax = Time('2020-01-01T00:00:00', format='isot', scale='utc').jd
+
+    start = time.time()
+    documents = cone_search_batch(kow, ras, decs, radii, LIGHTCURVE_CATALOGS,
+                                  cache=cache, nquery = 10,
+                                  batch_size = batch_size)
+    end = time.time()
+    loadtime = end - start
+
+    if documents is None:
+        print("Query for %d positions failed... returning." % len(ras))
+        return [{} for ii in range(len(ras))]
+
+    key1, key2, key3 = 'ZTF_sources_20200401', 'Gaia_DR2', 'ZTF_alerts'
+    print('Loaded %d positions in %.5f seconds' % (len(ras), loadtime))
+
+    lss = []
+    for ii in range(len(ras)):
+        name = None if names is None else names[ii]
+        lss.append(kowalski_lightcurves(documents[key1][ii],
+                                        documents[key2][ii],
+                                        documents[key3][ii],
+                                        program_ids, tmax,
+                                        min_epochs=min_epochs, name=name))
+
+    return lss
+
 def get_kowalski_objids(objids, kow, program_ids = [1,2,3], min_epochs = 1,
                         doRemoveHC=False, doExtinction=False, max_error = 2.0,
                         doHCOnly=False,
@@ -589,7 +737,8 @@ def get_kowalski_objids(objids, kow, program_ids = [1,2,3], min_epochs = 1,
                         doPercentile=False,
                         percmin = 10.0, percmax = 90.0,
                         doParallel = False,
-                        Ncore = 8):
+                        Ncore = 8,
+                        cache = None):
 
     baseline=0
     cnt=0
@@ -604,9 +753,27 @@ def get_kowalski_objids(objids, kow, program_ids = [1,2,3], min_epochs = 1,
     objids_split = np.array_split(objids, Ncatalog)
 
     data_out = []
-    if doParallel:
+    if isinstance(kow, QueryPool) and (kow.nconnections > 1):
+        # object sets are loaded by threads sharing the connections
+        from concurrent.futures import ThreadPoolExecutor
+        def load_objids(objids_tmp):
+            return get_kowalski_objid(objids_tmp, kow,
+                                      program_ids=program_ids,
+                                      min_epochs=min_epochs,
+                                      doRemoveHC=doRemoveHC,
+                                      doHCOnly=doHCOnly,
+                                      doExtinction=doExtinction,
+                                      doSigmaClipping=doSigmaClipping,
+                                      sigmathresh=sigmathresh,
+                                      doOutbursting=doOutbursting,
+                                      doPercentile=doPercentile,
+                                      percmin = percmin, percmax = percmax,
+                                      cache=cache)
+        with ThreadPoolExecutor(max_workers=kow.nconnections) as executor:
+            data_out = list(executor.map(load_objids, objids_split))
+    elif doParallel:
         from joblib import Parallel, delayed
-        data_out = Parallel(n_jobs=Ncore)(delayed(get_kowalski_objid)(objids_tmp,kow,program_ids=program_ids,min_epochs=min_epochs,doRemoveHC=doRemoveHC,doExtinction=doExtinction,doSigmaClipping=doSigmaClipping,sigmathresh=sigmathresh,doOutbursting=doOutbursting,doPercentile=doPercentile,percmin = percmin, percmax = percmax, doHCOnly=doHCOnly) for objids_tmp in objids_split)
+        data_out = Parallel(n_jobs=Ncore)(delayed(get_kowalski_objid)(objids_tmp,kow,program_ids=program_ids,min_epochs=min_epochs,doRemoveHC=doRemoveHC,doExtinction=doExtinction,doSigmaClipping=doSigmaClipping,sigmathresh=sigmathresh,doOutbursting=doOutbursting,doPercentile=doPercentile,percmin = percmin, percmax = percmax, doHCOnly=doHCOnly, cache=cache) for objids_tmp in objids_split)
     else:
         for oo in range(Ncatalog):
             if np.mod(oo, 10) == 0:
@@ -622,7 +789,8 @@ def get_kowalski_objids(objids, kow, program_ids = [1,2,3], min_epochs = 1,
                                       sigmathresh=sigmathresh,
                                       doOutbursting=doOutbursting,
                                       doPercentile=doPercentile,
-                                      percmin = percmin, percmax = percmax)
+                                      percmin = percmin, percmax = percmax,
+                                      cache=cache)
             data_out.append(data)
 
     for oo, data in enumerate(data_out):
@@ -651,7 +819,8 @@ def get_kowalski_objid(objids, kow, program_ids = [1,2,3], min_epochs = 1,
                        sigmathresh=5.0,
                        doOutbursting=False,
                        doPercentile=False,
-                       percmin = 10.0, percmax = 90.0):
+                       percmin = 10.0, percmax = 90.0,
+                       cache = None):
 
     baseline=0
     cnt=0
@@ -668,43 +837,41 @@ def get_kowalski_objid(objids, kow, program_ids = [1,2,3], min_epochs = 1,
     #                }
     #     }
 
-    qu = {"query_type":"find",
-          "query": {"catalog": 'ZTF_sources_20200401',
-                    "filter": {'_id': {'$in': objids.tolist()}}, 
-                    "projection": "{'_id':1,'data.programid':1,'data.hjd':1,'data.mag':1,'data.magerr':1,'data.ra':1,'data.dec':1,'filter':1,'data.catflags':1}"
-                    },
-          "kwargs": {'max_time_ms': 10000}
-         }
-    r = database_query(kow, qu, nquery = 10)
-
-    if not "data" in r:
-        print("Query for objid %d failed... continuing."%(objids))
-        return []
-
-    datas = r["data"]
-
-    for ii, data in enumerate(datas):
-        hjd, mag, magerr, ra, dec, fid = [], [], [], [], [], []
-        objid = data["_id"]
-        filt = data["filter"]
-        data = data["data"]
-        for dic in data:
+    columns, missing = empty_columns(), list(objids)
+    if cache is not None:
+        columns, missing = cache.find_sources(objids)
 
-            if not dic["programid"] in program_ids: continue
-            if (dic["programid"]==1) and (dic["hjd"] > tmax): continue
-            if not dic["catflags"] == 0: continue
-
-            hjd.append(dic["hjd"])
-            mag.append(dic["mag"])
-            magerr.append(dic["magerr"])
-            ra.append(dic["ra"])
-            dec.append(dic["dec"])
-            fid.append(filt)
+    if len(missing) > 0:
+        qu = {"query_type":"find",
+              "query": {"catalog": 'ZTF_sources_20200401',
+                        "filter": {'_id': {'$in': np.array(missing).tolist()}}, 
+                        "projection": "{'_id':1,'data.programid':1,'data.hjd':1,'data.mag':1,'data.magerr':1,'data.ra':1,'data.dec':1,'filter':1,'data.catflags':1}"
+                        },
+              "kwargs": {'max_time_ms': 10000}
+             }
+        r = database_query(kow, qu, nquery = 10)
 
-        hjd, mag, magerr = np.array(hjd),np.array(mag),np.array(magerr)
-        ra, dec = np.array(ra), np.array(dec)
+        if not "data" in r:
+            print("Query for objids %s failed... continuing."%(str(missing)))
+            return []
+
+        new_columns = documents_to_columns(r["data"])
+        if cache is not None:
+            cache.put_sources(query_key("objids", *sorted(missing)),
+                              new_columns)
+        columns = concatenate_columns([columns, new_columns])
+
+    columns = decode_kowalski_sources(columns, program_ids, tmax)
+    offsets = columns["offsets"]
+
+    for ii in range(len(columns["ids"])):
+        start, stop = offsets[ii], offsets[ii+1]
+        objid = int(columns["ids"][ii])
+        hjd, mag = columns["hjd"][start:stop], columns["mag"][start:stop]
+        magerr = columns["magerr"][start:stop]
+        ra, dec = columns["ra"][start:stop], columns["dec"][start:stop]
+        fid = np.full(stop-start, columns["filter"][ii])
 
-        fid = np.array(fid)
         idx = np.where(~np.isnan(mag) & ~np.isnan(magerr))[0]
         hjd, mag, magerr = hjd[idx], mag[idx], magerr[idx]
         fid = fid[idx]
@@ -721,29 +888,14 @@ def get_kowalski_objid(objids, kow, program_ids = [1,2,3], min_epochs = 1,
         ra, dec = ra[idx], dec[idx]
 
         if doRemoveHC:
-            idx = []
-            for ii, t in enumerate(hjd):
-                if ii == 0:
-                    idx.append(ii)
-                else:
-                    dt = hjd[ii] - hjd[idx[-1]]
-                    if dt >= 30.0*60.0/86400.0:
-                        idx.append(ii)
+            idx = np.where(thin_cadence(hjd))[0]
             if len(idx) == 0: continue 
             hjd, mag, magerr = hjd[idx], mag[idx], magerr[idx]
-            ra, decobj = ra[idx], dec[idx]
+            ra, dec = ra[idx], dec[idx]
             fid = fid[idx]
 
         elif doHCOnly:
-            idx = []
-            for ii, t in enumerate(hjd):
-                if ii == 0:
-                    idx.append(ii)
-                else:
-                    dt = hjd[ii] - hjd[idx[-1]]
-                    if dt >= 30.0*60.0/86400.0:
-                        idx.append(ii)
-            idx = np.setdiff1d(np.arange(len(hjd)), idx)
+            idx = np.where(~thin_cadence(hjd))[0]
             if len(idx) == 0: continue
             hjd, mag, magerr = hjd[idx], mag[idx], magerr[idx]
             fid = fid[idx]
@@ -791,7 +943,7 @@ def get_kowalski_objid(objids, kow, program_ids = [1,2,3], min_epochs = 1,
         radius = 5
         qu = { "query_type": "cone_search", "query": {"object_coordinates": { "radec": {'test': [np.median(ra),np.median(dec)]}, "cone_search_radius": "%.2f"%radius, "cone_search_unit": "arcsec" }, "catalogs": { "Gaia_DR2": { "filter": "{}", "projection": "{'parallax': 1, 'parallax_error': 1, 'phot_g_mean_mag': 1, 'phot_bp_mean_mag': 1, 'phot_rp_mean_mag': 1, 'phot_bp_mean_flux_over_error': 1, 'phot_rp_mean_flux_over_error': 1, 'ra': 1, 'dec': 1}"} } }}
 
-        r = database_query(kow, qu, nquery = 10)
+        r = cached_query(kow, qu, cache=cache, nquery = 10)
 
         coords = SkyCoord(ra=np.median(ra)*u.degree, 
                           dec=np.median(dec)*u.degree, frame='icrs')
@@ -867,42 +1019,50 @@ def get_kowalski_features_list(ras, decs, kow,
                                errs = None, names = None,
                                amaj=None, amin=None, phi=None,
                                featuresetname='f',
-                               dbname='ZTF_source_features_20191101'):
+                               dbname='ZTF_source_features_20191101',
+                               batch_size=200):
+
+    start = time.time()
 
     if errs is None:
         errs = 5.0*np.ones(ras.shape)
-    if names is None:
-        names = []
-        for ra, dec in zip(ras, decs):
-            ra_hex, dec_hex = convert_to_hex(ra*24/360.0,delimiter=''), convert_to_hex(dec,delimiter='')
-            if dec_hex[0] == "-":
-                objname = "ZTFJ%s%s"%(ra_hex[:4],dec_hex[:5])
-            else:
-                objname = "ZTFJ%s%s"%(ra_hex[:4],dec_hex[:4])
-            names.append(objname)
-
-    cnt = 0
-    ztf_ids, df_features = [], []
-    for name, ra, dec, err in zip(names, ras, decs, errs):
-        if amaj is not None:
-            ellipse = patches.Ellipse((ra, dec), amaj[cnt], amin[cnt],
-                                      angle=phi[cnt])
+    ras, decs = np.asarray(ras), np.asarray(decs)
+    errs = np.asarray(errs)
 
-        ids, features = get_kowalski_features_ind(ra, dec, kow,
-                                                  radius = err, oid = None,
-                                                  featuresetname=featuresetname,
-                                                  dbname=dbname)
-        if len(ids) == 0:
+    featuresetnames = get_featuresetnames(featuresetname)
+    catalogs = {dbname: {"filter": "{}", "projection": "{}"}}
+
+    # batch_size positions per cone search, matched back to each position;
+    # with a QueryPool, one query per connection runs at a time
+    group_size = batch_size*query_connections(kow)
+    datas = []
+    for ii in range(0, len(ras), group_size):
+        if ii > 0:
+            print('%d/%d'%(ii,len(ras)))
+        documents = cone_search_batch(kow, ras[ii:ii+group_size],
+                                      decs[ii:ii+group_size],
+                                      errs[ii:ii+group_size], catalogs,
+                                      batch_size=batch_size)
+        if documents is None:
+            print("Query for positions %d-%d failed... continuing." % (ii, ii+group_size))
             continue
+        for data in documents[dbname]:
+            datas.extend(data)
 
-        if cnt == 0:
-            ztf_ids = ids
-            df_features = features
-        else:
-            ztf_ids = ztf_ids.append(ids)
-            df_features = df_features.append(features)
+    if len(datas) == 0:
+        return [], []
 
-        cnt = cnt + 1
+    index = [str(data["_id"]) for data in datas]
+    ztf_ids = pd.Series([data["_id"] for data in datas], index=index,
+                        name="ztf_id")
+    df_features = pd.DataFrame({name: feature_column([data.get(name)
+                                                      for data in datas])
+                                for name in featuresetnames},
+                               index=index, columns=featuresetnames)
+
+    end = time.time()
+    loadtime = end - start
+    print('Loaded %d features in %.5f seconds' % (len(index), loadtime))
 
     return ztf_ids, df_features
 
@@ -916,7 +1076,8 @@ def get_kowalski_list(ras, decs, kow, program_ids = [1,2,3], min_epochs = 1,
                       sigmathresh=5.0,
                       doOutbursting=False,
                       doCrossMatch=False,
-                      crossmatch_radius=3.0):
+                      crossmatch_radius=3.0,
+                      cache=None, batch_size=200):
 
     baseline=0
     cnt=0
@@ -944,15 +1105,32 @@ def get_kowalski_list(ras, decs, kow, program_ids = [1,2,3], min_epochs = 1,
                 objname = "ZTFJ%s%s"%(ra_hex[:4],dec_hex[:4])
             names.append(objname)
 
-    for name, ra, dec, err in zip(names, ras, decs, errs):
+    # batch_size positions share one cone search query, and with a
+    # QueryPool one batch per connection is fetched at a time
+    ras, decs, errs = np.asarray(ras), np.asarray(decs), np.asarray(errs)
+    group_size = batch_size*query_connections(kow)
+    lss = []
+    for jj, (name, ra, dec, err) in enumerate(zip(names, ras, decs, errs)):
         if amaj is not None:
             ellipse = patches.Ellipse((ra, dec), amaj[cnt], amin[cnt],
                                       angle=phi[cnt]) 
 
         if np.mod(cnt,100) == 0:
             print('%d/%d'%(cnt,len(ras)))       
-        ls = get_kowalski(ra, dec, kow, radius = err, oid = None,
-                          program_ids = program_ids, name = name)
+        if batch_size > 1:
+            if np.mod(jj, group_size) == 0:
+                lss = get_kowalski_batch(ras[jj:jj+group_size],
+                                         decs[jj:jj+group_size], kow,
+                                         radii = errs[jj:jj+group_size],
+                                         program_ids = program_ids,
+                                         names = names[jj:jj+group_size],
+                                         cache = cache,
+                                         batch_size = batch_size)
+            ls = lss[np.mod(jj, group_size)]
+        else:
+            ls = get_kowalski(ra, dec, kow, radius = err, oid = None,
+                              program_ids = program_ids, name = name,
+                              cache = cache)
 
         if len(ls.keys()) == 0: continue
 
@@ -1005,15 +1183,7 @@ def get_kowalski_list(ras, decs, kow, program_ids = [1,2,3], min_epochs = 1,
             fid = fid[idx]
 
             if doRemoveHC:
-                idx = []
-                for ii, t in enumerate(hjd):
-                    if ii == 0:
-                        idx.append(ii)
-                    else:
-                        dt = hjd[ii] - hjd[idx[-1]]
-                        if dt >= 30.0*60.0/86400.0:
-                            idx.append(ii)
-                idx = np.array(idx)
+                idx = np.where(thin_cadence(hjd))[0]
                 hjd, mag, magerr = hjd[idx], mag[idx], magerr[idx]
                 raobj, decobj = raobj[idx], decobj[idx]
                 fid = fid[idx]
@@ -1185,9 +1355,7 @@ def get_simulated_list(ras, decs, min_epochs = 1, names = None,
             fid = fid[idx]
 
             if doRemoveHC:
-                dt = np.diff(hjd)
-                idx = np.setdiff1d(np.arange(len(hjd)),
-                                   np.where(dt < 30.0*60.0/86400.0)[0])
+                idx = np.where(~(next_gaps(hjd) < HC_CADENCE))[0]
                 hjd, mag, magerr = hjd[idx], mag[idx], magerr[idx]
                 raobj, decobj = raobj[idx], decobj[idx]
                 fid = fid[idx]
@@ -1304,29 +1472,238 @@ def crossmatch_lcs(ls, crossmatch_radius=3.0):
 
     return data
 
+def id_range_filter(id_start, id_end):
+    """Mongo condition on _id for id_start <= _id < id_end (None for no
+    bound)."""
+    cond = {}
+    if id_start is not None:
+        cond["$gte"] = int(id_start)
+    if id_end is not None:
+        cond["$lt"] = int(id_end)
+    return cond
+
+def id_boundaries(objids, num_batches):
+    """_id boundaries of num_batches batches of objids in _id order.
+
+    Batch nb holds the objects with
+    boundaries[nb] <= _id < boundaries[nb+1], in the same layout as
+    get_kowalski_id_boundaries.
+    """
+
+    objids = np.sort(np.asarray(objids, dtype=np.int64))
+    if len(objids) == 0:
+        return np.zeros(num_batches+1, dtype=np.int64)
+
+    batch_size = int(np.ceil(len(objids)/num_batches))
+    starts = np.arange(num_batches)*batch_size
+    boundaries = np.append(objids[np.minimum(starts, len(objids)-1)],
+                           objids[-1]+1)
+    # empty batches at the end start after the last object
+    boundaries[:-1][starts >= len(objids)] = objids[-1]+1
+
+    return boundaries
+
+def get_kowalski_nth_id(kow, catalog, filt, n, direction=1, cache=None):
+    """_id of the n-th document of filt in _id order (descending for
+    direction=-1), or None if there are not that many. The query only
+    reads the _id index."""
+
+    qu = {"query_type":"find",
+          "query": {"catalog": catalog,
+                    "filter": filt,
+                    "projection": {"_id": 1}},
+          "kwargs": {"sort": [["_id", direction]],
+                     "skip": int(n),
+                     "limit": 1}
+         }
+    r = cached_query(kow, qu, cache=cache, nquery = 10)
+    if not "data" in r:
+        raise Exception('Query for the _id boundaries of %s failed...' % catalog)
+    if len(r["data"]) == 0:
+        return None
+    return int(r["data"][0]["_id"])
+
+def get_kowalski_id_range(kow, catalog, filt, nlightcurves, num_batches, nb,
+                          cache=None):
+    """(id_start, id_end) of batch nb of num_batches of filt in _id order,
+    None for the open ends of the first and last batches.
+
+    The lookups skip nb*batch_size entries of the _id index, so they
+    should be done once per job; boundaries saved with the job manifest
+    (see get_kowalski_id_boundaries) avoid them altogether."""
+
+    batch_size = int(np.ceil(nlightcurves/num_batches))
+    id_start, id_end = None, None
+    if nb > 0:
+        id_start = get_kowalski_nth_id(kow, catalog, filt, nb*batch_size,
+                                       cache=cache)
+    if (nb+1)*batch_size < nlightcurves:
+        id_end = get_kowalski_nth_id(kow, catalog, filt, (nb+1)*batch_size,
+                                     cache=cache)
+    return id_start, id_end
+
+def get_kowalski_id_boundaries(kow, catalog, filt, nlightcurves, num_batches):
+    """_id boundaries of num_batches batches of filt, as id_boundaries.
+
+    Each boundary is found by skipping one batch from the previous one,
+    so that the whole collection is only walked once.
+    """
+
+    batch_size = int(np.ceil(nlightcurves/num_batches))
+    last = get_kowalski_nth_id(kow, catalog, filt, 0, direction=-1)
+    if last is None:
+        return np.zeros(num_batches+1, dtype=np.int64)
+    boundaries = [get_kowalski_nth_id(kow, catalog, filt, 0)]
+    for nb in range(1, num_batches):
+        filt_nb = dict(filt)
+        filt_nb["_id"] = dict(filt.get("_id", {}))
+        filt_nb["_id"]["$gte"] = int(boundaries[-1])
+        boundary = None
+        if boundaries[-1] <= last:
+            boundary = get_kowalski_nth_id(kow, catalog, filt_nb, batch_size)
+        if boundary is None:
+            boundary = last+1
+        boundaries.append(boundary)
+    boundaries.append(last+1)
+
+    return np.array(boundaries, dtype=np.int64)
+
+def get_kowalski_sub_boundaries(field, ccd, quadrant, kow,
+                                num_batches=1, nb=0, num_sub_batches=1,
+                                id_boundaries=None, cache=None):
+    """_id boundaries of the num_sub_batches pieces of batch nb of a
+    quadrant, as read by get_kowalski_bulk(..., sub_boundaries=...).
+
+    Meant to be looked up once per job: the batch range comes from
+    id_boundaries if given (otherwise from one get_kowalski_id_range
+    lookup), and the pieces are found walking the batch once. None if
+    the count query fails.
+    """
+
+    qu = {"query_type":"general_search","query":"db['ZTF_sources_20200401'].count_documents({'field':%d,'ccd':%d,'quad':%d})"%(field,ccd,quadrant)}
+    r = cached_query(kow, qu, cache=cache, nquery = 10)
+    if not "data" in r:
+        return None
+
+    nlightcurves = r['data']
+    batch_size = np.ceil(nlightcurves/num_batches).astype(int)
+    sub_batch_size = np.ceil(batch_size/num_sub_batches).astype(int)
+
+    filt = {'field': int(field), 'ccd': int(ccd), 'quad': int(quadrant)}
+    if id_boundaries is not None:
+        id_start, id_end = id_boundaries[nb], id_boundaries[nb+1]
+    else:
+        id_start, id_end = get_kowalski_id_range(kow, 'ZTF_sources_20200401',
+                                                 filt, nlightcurves,
+                                                 num_batches, nb, cache=cache)
+    id_filter = id_range_filter(id_start, id_end)
+    if id_filter:
+        filt['_id'] = id_filter
+
+    return get_kowalski_id_boundaries(kow, 'ZTF_sources_20200401', filt,
+                                      sub_batch_size*num_sub_batches,
+                                      num_sub_batches)
+
+def get_kowalski_baseline(field, ccd, quadrant, kow,
+                          program_ids = [2,3], min_epochs = 1,
+                          id_start=None, id_end=None, cache=None):
+    """Longest detection span of a source of a quadrant with
+    id_start <= _id < id_end, from a single aggregate query.
+
+    Only the detections get_kowalski_bulk keeps (catflags == 0, program
+    ids, tmax) of sources with at least min_epochs of them are used, so
+    this is the baseline of the light curves of the range, or an upper
+    bound of it when they are clipped further. None if the query fails.
+    """
+
+    tmax = Time('2020-01-01T00:00:00', format='isot', scale='utc').jd
+
+    filt = {'field': int(field), 'ccd': int(ccd), 'quad': int(quadrant)}
+    id_filter = id_range_filter(id_start, id_end)
+    if id_filter:
+        filt['_id'] = id_filter
+
+    keep = {"$and": [{"$in": ["$$d.programid", [int(x) for x in program_ids]]},
+                     {"$eq": ["$$d.catflags", 0]},
+                     {"$or": [{"$ne": ["$$d.programid", 1]},
+                              {"$lte": ["$$d.hjd", tmax]}]}]}
+    pipeline = [{"$match": filt},
+                {"$project": {"hjd": {"$map": {
+                    "input": {"$filter": {"input": "$data", "as": "d",
+                                          "cond": keep}},
+                    "as": "d", "in": "$$d.hjd"}}}}]
+    if min_epochs > 1:
+        pipeline.append({"$match": {"hjd.%d" % (min_epochs-1):
+                                    {"$exists": True}}})
+    pipeline.append({"$group": {"_id": None,
+                                "baseline": {"$max": {"$subtract":
+                                    [{"$max": "$hjd"}, {"$min": "$hjd"}]}}}})
+
+    qu = {"query_type":"aggregate",
+          "query": {"catalog": 'ZTF_sources_20200401',
+                    "pipeline": pipeline}
+         }
+    r = cached_query(kow, qu, cache=cache, nquery = 10)
+    if not "data" in r:
+        return None
+    if (len(r["data"]) == 0) or (r["data"][0].get("baseline") is None):
+        return 0.0
+    return float(r["data"][0]["baseline"])
+
+def id_boundaries_file(quadrant_file):
+    """File of the _id boundaries saved alongside a job manifest."""
+    return os.path.splitext(quadrant_file)[0] + "_boundaries.h5"
+
+def save_id_boundaries(filename, boundaries):
+    """Save a dict of _id boundaries (e.g. keyed by field_ccd_quadrant)."""
+    with h5py.File(filename, 'a') as hf:
+        for key in boundaries:
+            if key in hf:
+                del hf[key]
+            hf.create_dataset(key, data=np.asarray(boundaries[key],
+                                                   dtype=np.int64))
+
+def load_id_boundaries(filename):
+    """Dict of the _id boundaries in filename."""
+    with h5py.File(filename, 'r') as hf:
+        return {key: hf[key][:] for key in hf.keys()}
+
 def get_kowalski_bulk(field, ccd, quadrant, kow,
                       program_ids = [2,3], min_epochs = 1, max_error = 2.0,
                       num_batches=1, nb=0,
+                      num_sub_batches=1, sub_nb=0,
                       doRemoveHC=False, doHCOnly=False,
                       doSigmaClipping=False,
                       sigmathresh=5.0,
                       doOutbursting=False,
                       doAlias=False,
                       doPercentile=False,
-                      percmin = 10.0, percmax = 90.0):
+                      percmin = 10.0, percmax = 90.0,
+                      id_boundaries=None, sub_boundaries=None,
+                      cache=None):
+    """Light curves of batch nb of a quadrant.
+
+    Batches are _id ranges. With boundaries given (e.g. from the job
+    manifest, see id_boundaries), reading a batch costs the same for any
+    nb; otherwise they are looked up on the _id index, which skips
+    nb*batch_size index entries. Sub-batch sub_nb is the _id range
+    sub_boundaries[sub_nb:sub_nb+2] if given (see
+    get_kowalski_sub_boundaries, looked up once for all sub-batches),
+    otherwise it is read with skip/limit within the batch.
+    """
 
     tmax = Time('2020-01-01T00:00:00', format='isot', scale='utc').jd
 
     qu = {"query_type":"general_search","query":"db['ZTF_sources_20200401'].count_documents({'field':%d,'ccd':%d,'quad':%d})"%(field,ccd,quadrant)}
 
     start = time.time()
-    r = database_query(kow, qu, nquery = 10)
+    r = cached_query(kow, qu, cache=cache, nquery = 10)
     end = time.time()
     loadtime = end - start
 
     if not "data" in r:
         print("Query for field: %d, CCD: %d, quadrant %d failed... returning."%(field, ccd, quadrant))
-        return [], [], [], []
+        return [], [], [], [], [], [], [], 0
 
     if doAlias:
         magerrdir = "/home/michael.coughlin/ZTF/ztfperiodic/input"
@@ -1341,6 +1718,31 @@ def get_kowalski_bulk(field, ccd, quadrant, kow,
     nlightcurves = r['data']
     batch_size = np.ceil(nlightcurves/num_batches).astype(int)
 
+    # batch nb can itself be read in num_sub_batches pieces
+    batch_start = nb*batch_size
+    batch_end = min((nb+1)*batch_size, nlightcurves)
+    sub_batch_size = np.ceil(batch_size/num_sub_batches).astype(int)
+    skip = sub_nb*sub_batch_size
+    limit = min(sub_batch_size, batch_end - batch_start - skip)
+
+    filt = {'field': int(field), 'ccd': int(ccd), 'quad': int(quadrant)}
+    if (limit > 0) and (sub_boundaries is not None):
+        id_start, id_end = sub_boundaries[sub_nb], sub_boundaries[sub_nb+1]
+        skip = 0
+        filt['_id'] = id_range_filter(id_start, id_end)
+    elif limit > 0:
+        if id_boundaries is not None:
+            id_start, id_end = id_boundaries[nb], id_boundaries[nb+1]
+        else:
+            id_start, id_end = get_kowalski_id_range(kow,
+                                                     'ZTF_sources_20200401',
+                                                     filt, nlightcurves,
+                                                     num_batches, nb,
+                                                     cache=cache)
+        id_filter = id_range_filter(id_start, id_end)
+        if id_filter:
+            filt['_id'] = id_filter
+
     baseline=0
     cnt=0
     names = []
@@ -1352,54 +1754,57 @@ def get_kowalski_bulk(field, ccd, quadrant, kow,
     for nb in [nb]:
         print("Querying batch number %d/%d..."%(nb, num_batches))
 
-        qu = {"query_type":"general_search","query":"db['ZTF_sources_20200401'].find({'field':%d,'ccd':%d,'quad':%d},{'_id':1,'data.programid':1,'data.hjd':1,'data.mag':1,'data.magerr':1,'data.ra':1,'data.dec':1,'filter':1,'data.catflags':1}).skip(%d).limit(%d)"%(field,ccd,quadrant,int(nb*batch_size),int(batch_size))}
-        r = database_query(kow, qu, nquery = 10)
-
-        if not "data" in r:
-            print("Query for batch number %d/%d failed... continuing."%(nb, num_batches))
+        # limit(0) means no limit, so empty pieces are skipped
+        if limit <= 0:
             continue
 
-        #qu = {"query_type":"general_search","query":"db['ZTF_sources_20200401'].find_one({})"}
-        #r = kow.query(query=qu)
+        datas = None
+        if cache is not None:
+            sources_key = query_key("sources", field, ccd, quadrant,
+                                    id_start, id_end, int(skip), int(limit))
+            datas = cache.get_sources(sources_key)
+
+        if datas is None:
+            # with a QueryPool, the batch is read in one piece per
+            # connection, concurrently
+            npieces = 1
+            if isinstance(kow, QueryPool):
+                npieces = min(kow.nconnections, int(limit))
+            piece_size = int(np.ceil(limit/npieces))
+            qus = []
+            for piece_skip in range(int(skip), int(skip+limit), piece_size):
+                piece_limit = min(piece_size, int(skip+limit) - piece_skip)
+                qu = {"query_type":"general_search","query":"db['ZTF_sources_20200401'].find(%s,{'_id':1,'data.programid':1,'data.hjd':1,'data.mag':1,'data.magerr':1,'data.ra':1,'data.dec':1,'filter':1,'data.catflags':1}).sort([('_id',1)]).skip(%d).limit(%d)"%(str(filt),piece_skip,piece_limit)}
+                qus.append(qu)
+            rs = database_queries(kow, qus, nquery = 10)
+
+            if not all(["data" in r for r in rs]):
+                print("Query for batch number %d/%d failed... continuing."%(nb, num_batches))
+                continue
 
-        datas = r["data"]
+            #qu = {"query_type":"general_search","query":"db['ZTF_sources_20200401'].find_one({})"}
+            #r = kow.query(query=qu)
+
+            datas = documents_to_columns([doc for r in rs for doc in r["data"]])
+            if cache is not None:
+                cache.put_sources(sources_key, datas)
+
+        columns = decode_kowalski_sources(datas, program_ids, tmax)
+        offsets = columns["offsets"]
+        nobjects = len(columns["ids"])
 
         if doHCOnly:
-            tt = np.empty((0,1))
-            for data in datas:
-                hjd = []
-                data = data["data"]
-                for dic in data:
-                    if not dic["programid"] in program_ids: continue
-                    if (dic["programid"]==1) and (dic["hjd"] > tmax): continue
-                    if not dic["catflags"] == 0: continue
-
-                    hjd.append(dic["hjd"])
-                hjd = np.array(hjd)
-                tt = np.unique(np.append(tt,hjd))
-            magmat = np.nan*np.ones((len(tt),len(datas))) # (nepoch x nsources)
-
-        for ii, data in enumerate(datas):
-            hjd, mag, magerr, ra, dec, fid = [], [], [], [], [], []
-            objid = data["_id"]
-            filt = data["filter"]
-            data = data["data"]
-            for dic in data:
-                if not dic["programid"] in program_ids: continue
-                if (dic["programid"]==1) and (dic["hjd"] > tmax): continue
-                if not dic["catflags"] == 0: continue
-
-                hjd.append(dic["hjd"])
-                mag.append(dic["mag"])
-                magerr.append(dic["magerr"])
-                ra.append(dic["ra"])
-                dec.append(dic["dec"])
-                fid.append(filt)
+            tt = np.unique(columns["hjd"])
+            magmat = np.nan*np.ones((len(tt),nobjects)) # (nepoch x nsources)
 
-            hjd, mag, magerr = np.array(hjd),np.array(mag),np.array(magerr)
-            ra, dec = np.array(ra), np.array(dec)
+        for ii in range(nobjects):
+            start, stop = offsets[ii], offsets[ii+1]
+            objid = int(columns["ids"][ii])
+            hjd, mag = columns["hjd"][start:stop], columns["mag"][start:stop]
+            magerr = columns["magerr"][start:stop]
+            ra, dec = columns["ra"][start:stop], columns["dec"][start:stop]
+            fid = np.full(stop-start, columns["filter"][ii])
 
-            fid = np.array(fid)
             idx = np.where(~np.isnan(mag) & ~np.isnan(magerr))[0]
             hjd, mag, magerr = hjd[idx], mag[idx], magerr[idx]
             fid = fid[idx]
@@ -1422,22 +1827,12 @@ def get_kowalski_bulk(field, ccd, quadrant, kow,
                 magerr[:] = errors
 
             if doRemoveHC:
-                idx = []
-                for ii, t in enumerate(hjd):
-                    if ii == 0:
-                        idx.append(ii)
-                    else:
-                        dt = hjd[ii] - hjd[idx[-1]]
-                        if dt >= 30.0*60.0/86400.0:
-                            idx.append(ii)
-                idx = np.array(idx).astype(int)
+                idx = np.where(thin_cadence(hjd))[0]
                 hjd, mag, magerr = hjd[idx], mag[idx], magerr[idx]
                 ra, dec = ra[idx], dec[idx]
                 fid = fid[idx]
             elif doHCOnly:
-                dt = np.diff(hjd)
-                idx = np.setdiff1d(np.arange(len(hjd)),
-                                   np.where(dt >= 30.0*60.0/86400.0)[0])
+                idx = np.where(~(next_gaps(hjd) >= HC_CADENCE))[0]
                 hjd, mag, magerr = hjd[idx], mag[idx], magerr[idx]
                 fid = fid[idx]
                 ra, dec = ra[idx], dec[idx]
@@ -1680,43 +2075,48 @@ def get_kowalski_features_ind(ra, dec, kow, radius = 5.0, oid = None,
 
     return df_features["ztf_id"], df_features[featuresetnames]
 
-def get_kowalski_features_objids(objids, kow, featuresetname='f',
-                                 dbname='ZTF_source_features_20191101'):
+def feature_column(values):
+    """Column of feature values, with missing values set to 0"""
 
-    start = time.time()
+    try:
+        column = np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        column = None
+    if (column is None) or (column.ndim != 1):
+        # array valued features (e.g. dmdt) stay one object per row
+        column = np.empty(len(values), dtype=object)
+        for ii, value in enumerate(values):
+            column[ii] = 0 if value is None else value
+        return column
 
-    featuresetnames = get_featuresetnames(featuresetname)
+    column[np.isnan(column)] = 0
+    return column
 
-    features = {}    
-    for ii, objid in enumerate(objids):
-        if (ii > 0) and (np.mod(ii,100) == 0):
-            print('Loading %d/%d...' % (ii, len(objids)))
 
-        qu = {"query_type":"find",
-              "query": {"catalog": dbname,
-                        "filter": {"_id": int(objid)},
-                        "projection": {}},
-             }
-        r = database_query(kow, qu, nquery = 10)
+def get_kowalski_features_objids(objids, kow, featuresetname='f',
+                                 dbname='ZTF_source_features_20191101',
+                                 batch_size=1000, Nthreads=4):
 
-        if not "data" in r:
-            print("Query for objid %d failed... continuing."%(objid))
-            continue
- 
-        if len(r["data"]) == 0: continue
+    start = time.time()
 
-        datlist = r["data"][0]
-        datlist["ztf_id"] = datlist["_id"]
-        del datlist["_id"]
+    featuresetnames = get_featuresetnames(featuresetname)
 
-        df_series = pd.Series(datlist).fillna(0)
-        features[objid] = df_series
+    # only the requested features are sent back
+    projection = {name: 1 for name in featuresetnames}
+    documents = find_objids(kow, dbname, objids, projection=projection,
+                            batch_size=batch_size, Nthreads=Nthreads)
 
-    if not features:
+    index = unique_found(objids, documents)
+    if len(index) == 0:
         return [], []
+    datas = [documents[int(objid)] for objid in index]
 
-    df_features = pd.DataFrame.from_dict(features, orient='index',
-                                         columns=df_series.index)
+    ztf_ids = pd.Series([data["_id"] for data in datas], index=index,
+                        name="ztf_id")
+    df_features = pd.DataFrame({name: feature_column([data.get(name)
+                                                      for data in datas])
+                                for name in featuresetnames},
+                               index=index, columns=featuresetnames)
 
     end = time.time()
     loadtime = end - start
@@ -1724,57 +2124,43 @@ def get_kowalski_features_objids(objids, kow, featuresetname='f',
     if len(objids) > 1:
         print('Loaded %d features in %.5f seconds' % (len(objids), loadtime))
 
-    return df_features["ztf_id"], df_features[featuresetnames]
+    return ztf_ids, df_features
 
 
 def get_kowalski_classifications_objids(objids, kow,
                                         dbname='ZTF_source_classifications_20191101',
-                                        version='d11_dnn_v2_20200627'):
+                                        version='d11_dnn_v2_20200627',
+                                        batch_size=1000, Nthreads=4):
 
-    classifications = {}
-    for ii, objid in enumerate(objids):
-        if (ii > 0) and (np.mod(ii,100) == 0):
-            print('Loading %d/%d...' % (ii, len(objids)))
+    documents = find_objids(kow, dbname, objids, projection={},
+                            batch_size=batch_size, Nthreads=Nthreads)
 
-        qu = {"query_type":"find",
-              "query": {"catalog": dbname,
-                        "filter": {"_id": int(objid)},
-                        "projection": {}},
-             }
-        r = database_query(kow, qu, nquery = 10)
-
-        if not "data" in r:
-            print("Query for objid %d failed... continuing."%(objid))
-            continue
-
-        if len(r["data"]) == 0: continue
-
-        datlist = r["data"][0]
+    index = unique_found(objids, documents)
+    if len(index) == 0:
+        return []
 
-        datas = {}
+    # one value per classification and object, for the requested version
+    values = {}
+    for ii, objid in enumerate(index):
+        datlist = documents[int(objid)]
         for datkey in datlist.keys():
-            if datkey == "_id":
-                datas["_id"] = datlist["_id"]
-                continue
+            if datkey == "_id": continue
             for dat in datlist[datkey]:
                 if "version" in dat.keys() and dat["version"] == version:
-                    datas[datkey] = dat["value"]
+                    if not datkey in values:
+                        values[datkey] = [None]*len(index)
+                    values[datkey][ii] = dat["value"]
 
-        datas["ztf_id"] = datas["_id"]
-        del datas["_id"]
-        df_series = pd.Series(datas).fillna(0)
-        classifications[objid] = df_series
-
-    if not classifications:
-        return []
-
-    df_classifications = pd.DataFrame.from_dict(classifications, orient='index',
-                                                columns=df_series.index)
+    columns = {datkey: feature_column(values[datkey]) for datkey in values}
+    columns["ztf_id"] = [documents[int(objid)]["_id"] for objid in index]
+    df_classifications = pd.DataFrame(columns, index=index,
+                                      columns=list(values.keys()) + ["ztf_id"])
 
     return df_classifications
 
 def get_kowalski_features(kow, num_batches=1, nb=0, featuresetname='f',
-                          dbname='ZTF_source_features_20191101'):
+                          dbname='ZTF_source_features_20191101',
+                          id_boundaries=None):
 
     featuresetnames = get_featuresetnames(featuresetname)
 
@@ -1810,13 +2196,31 @@ def get_kowalski_features(kow, num_batches=1, nb=0, featuresetname='f',
         print("Querying batch number %d/%d..."%(nb, num_batches))
 
         start = time.time()
+        # batches are _id ranges; without saved boundaries, only the start
+        # of the batch is looked up (skipping nb*batch_size index entries)
+        # and the limit ends it, which needs the documents in _id order
+        if id_boundaries is not None:
+            id_start, id_end = id_boundaries[nb], id_boundaries[nb+1]
+        else:
+            id_start, id_end = None, None
+            if nb > 0:
+                id_start = get_kowalski_nth_id(kow, dbname, {},
+                                               nb*batch_size)
+                if id_start is None:
+                    print("Batch number %d/%d is empty... returning."%(nb, num_batches))
+                    return pd.Series([], name="ztf_id", dtype=np.int64), pd.DataFrame(columns=featuresetnames)
+        filt = {}
+        id_filter = id_range_filter(id_start, id_end)
+        if id_filter:
+            filt['_id'] = id_filter
+
         #qu = {"query_type":"general_search","query":"db['%s'].find({}).skip(%d).limit(%d)"%(dbname, int(nb*batch_size),int(batch_size))}
         qu = {"query_type":"find",
               "query": {"catalog": dbname,
-                        "filter": {},
+                        "filter": filt,
                         "projection": {}},
-              "kwargs": {"skip": int(nb*batch_size),
-                        "limit": int(batch_size)}
+              "kwargs": {"sort": [["_id", 1]],
+                         "limit": int(batch_size)}
              }
                        
         r = database_query(kow, qu, nquery = 10)
@@ -1844,8 +2248,7 @@ def get_kowalski_features(kow, num_batches=1, nb=0, featuresetname='f',
 
 def split_lightcurve(hjd, mag, magerr, fid, min_epochs):
 
-    dt = np.diff(hjd)
-    idy = np.where(dt > 1e-2)[0]
+    idy = np.where(next_gaps(hjd) > 1e-2)[0]
     ddy = np.diff(idy)
     idz = np.where(ddy >= min_epochs)[0]
 
@@ -1946,11 +2349,19 @@ def find_matchfile(matchfileDir, objid = 10593142036566):
     return filename
 
 
-def get_matchfile(f, min_epochs = 1, doRemoveHC=False, doHCOnly=False,
-                  Ncatalog = 1, Ncatindex = 0):
+def read_matchfile(f, min_epochs = 1, Ncatalog = 1, Ncatindex = 0):
     """
-    Read matchfile (hdf file) light curves given the filename
-    e.g.: f = '/path/to/fr000551-000600/ztf_000593_zr_c04_q3_match.pytable'
+    Read a matchfile (hdf file) once and group its detections by source,
+    for the sources of batch Ncatindex of Ncatalog.
+
+    The detections are sorted by (matchid, hjd) with the offsets of each
+    matchid, so that matchfile_lightcurves builds any subset of the light
+    curves with slices, e.g. one chunk of a streamed job at a time.
+
+    Returns
+    -------
+    matches : dict
+        matchids of the batch and the grouped arrays of its sources.
     """
     bands = {'g': 1, 'r': 2, 'i': 3, 'z': 4, 'J': 5}
     fsplit = f.split("/")[-1].replace(".pytable","").split("_")
@@ -1969,15 +2380,76 @@ def get_matchfile(f, min_epochs = 1, doRemoveHC=False, doHCOnly=False,
         exposures = pd.DataFrame.from_records(store.root.matches.exposures.read_where(('(((programid>1) | ((programid==1) & (obsmjd<58484))| (programpi=="TESS")))')))
         exposures = pd.DataFrame.from_records(store.root.matches.exposures.read_where(('programid>0')))
         merged = srcdata.merge(exposures, on="expid")
+    del srcdata
 
     matchids = sources[:]['matchid'].values
     matchids_split = np.array_split(matchids, Ncatalog)
     matchids = matchids_split[Ncatindex]
 
+    # epochs of the high-cadence trend of doHCOnly
+    tt = np.unique(merged.obshjd.values)
+
+    # group the detections once: sort by (matchid, hjd) and keep the
+    # offsets of each matchid, so that every light curve is a slice;
+    # only the detections of the batch are kept
+    merged = merged[(merged.catflags == 0).values &
+                    np.isin(merged.matchid.values, matchids)]
+    det_matchid = merged.matchid.values
+    det_hjd = merged.obshjd.values
+    det_mag = merged.mag.values
+    det_magerr = merged.magerr.values
+    del merged
+    order = np.lexsort((det_hjd, det_matchid))
+    det_matchid = det_matchid[order]
+    det_hjd, det_mag, det_magerr = det_hjd[order], det_mag[order], det_magerr[order]
+    det_ids, det_start, det_counts = np.unique(det_matchid, return_index=True,
+                                               return_counts=True)
+
+    src_order = np.argsort(sources.matchid.values, kind="stable")
+
+    return {"filt": filt, "matchids": matchids, "tt": tt,
+            "src_matchid": sources.matchid.values[src_order],
+            "src_ra": sources.ra.values[src_order],
+            "src_dec": sources.dec.values[src_order],
+            "det_ids": det_ids, "det_start": det_start,
+            "det_counts": det_counts, "det_hjd": det_hjd,
+            "det_mag": det_mag, "det_magerr": det_magerr}
+
+
+def matchfile_baseline(matches, min_epochs = 1):
+    """
+    Longest detection span of a source of read_matchfile, without reading
+    the light curves: the baseline of get_matchfile for the whole batch
+    (an upper bound of it with doRemoveHC or doHCOnly).
+    """
+
+    enough = matches["det_counts"] >= max(min_epochs, 1)
+    if not np.any(enough):
+        return 0.0
+    start = matches["det_start"][enough]
+    stop = start + matches["det_counts"][enough] - 1
+    return float(np.max(matches["det_hjd"][stop] - matches["det_hjd"][start]))
+
+
+def matchfile_lightcurves(matches, matchids, min_epochs = 1,
+                          doRemoveHC=False, doHCOnly=False):
+    """
+    Light curves of the given matchids from the grouped detections of
+    read_matchfile, in the format of get_matchfile.
+    """
+
+    filt = matches["filt"]
+    src_matchid = matches["src_matchid"]
+    src_ra, src_dec = matches["src_ra"], matches["src_dec"]
+    det_ids = matches["det_ids"]
+    det_start, det_counts = matches["det_start"], matches["det_counts"]
+    det_hjd = matches["det_hjd"]
+    det_mag, det_magerr = matches["det_mag"], matches["det_magerr"]
+
     if doHCOnly:
-        tt = np.unique(np.sort(merged.obshjd.values))
+        tt = matches["tt"]
         magmat = np.nan*np.ones((len(tt),len(matchids))) # (nepoch x nsources)
-        
+
     baseline = 0
     names = []
     lightcurves, coordinates, filters, ids = [], [], [], []
@@ -1988,33 +2460,27 @@ def get_matchfile(f, min_epochs = 1, doRemoveHC=False, doHCOnly=False,
         if np.mod(ii,100) == 0:
             print("Reading ID %d/%d" % (ii, len(matchids)))
  
-        df = merged[merged['matchid'] == k]
-        df=df[df.catflags == 0]
-        df2=sources[:][sources[:].matchid == k]
-
-        RA=df2.ra.values[0]
-        Dec=df2.dec.values[0]
-        mag = df.mag.values.astype(np.float32)+17.0
-        magerr=df.magerr.values.astype(np.float32)/1000.0
-        obsHJD = df.obshjd
-        hjd = obsHJD.values
+        jj = np.searchsorted(src_matchid, k)
+        RA=src_ra[jj]
+        Dec=src_dec[jj]
 
-        idx = np.argsort(hjd)
-        hjd, mag, magerr = hjd[idx], mag[idx], magerr[idx]
+        jj = np.searchsorted(det_ids, k)
+        if (jj < len(det_ids)) and (det_ids[jj] == k):
+            start, stop = det_start[jj], det_start[jj] + det_counts[jj]
+        else:
+            start, stop = 0, 0
+        mag = det_mag[start:stop].astype(np.float32)+17.0
+        magerr = det_magerr[start:stop].astype(np.float32)/1000.0
+        hjd = det_hjd[start:stop]
 
         if doRemoveHC:
-            dt = np.diff(hjd)
-            idx = np.setdiff1d(np.arange(len(hjd)),
-                               np.where(dt < 30.0*60.0/86400.0)[0])
+            idx = np.where(~(next_gaps(hjd) < HC_CADENCE))[0]
             hjd, mag, magerr = hjd[idx], mag[idx], magerr[idx]
         elif doHCOnly:
-            dt = np.diff(hjd)
-            idx = np.setdiff1d(np.arange(len(hjd)),
-                               np.where(dt >= 30.0*60.0/86400.0)[0])
+            idx = np.where(~(next_gaps(hjd) >= HC_CADENCE))[0]
             hjd, mag, magerr = hjd[idx], mag[idx], magerr[idx]
 
-            dt = np.diff(hjd)
-            idy = np.where(dt > 1e-2)[0]
+            idy = np.where(next_gaps(hjd) > 1e-2)[0]
             ddy = np.diff(idy)
             if len(ddy) > 0:
                 idpeak = np.argmax(ddy)
@@ -2079,6 +2545,24 @@ def get_matchfile(f, min_epochs = 1, doRemoveHC=False, doHCOnly=False,
     return lightcurves, coordinates, filters, ids, absmags, bp_rps, names, baseline
 
 
+def get_matchfile(f, min_epochs = 1, doRemoveHC=False, doHCOnly=False,
+                  Ncatalog = 1, Ncatindex = 0,
+                  Nsubcatalog = 1, Nsubcatindex = 0):
+    """
+    Read matchfile (hdf file) light curves given the filename
+    e.g.: f = '/path/to/fr000551-000600/ztf_000593_zr_c04_q3_match.pytable'
+
+    Jobs reading several chunks of a matchfile should call read_matchfile
+    once and matchfile_lightcurves per chunk instead.
+    """
+
+    matches = read_matchfile(f, min_epochs=min_epochs,
+                             Ncatalog=Ncatalog, Ncatindex=Ncatindex)
+    matchids = np.array_split(matches["matchids"], Nsubcatalog)[Nsubcatindex]
+    return matchfile_lightcurves(matches, matchids, min_epochs=min_epochs,
+                                 doRemoveHC=doRemoveHC, doHCOnly=doHCOnly)
+
+
 def get_matchfile_original(f):
     lightcurves, coordinates = [], []
     baseline = 0
@@ -2124,18 +2608,224 @@ def get_matchfile_original(f):
     return lightcurves, coordinates, baseline
 
 
+def append_catalog(filename, data, create=False):
+    """Append rows to the datasets of an HDF5 catalog file
+
+    Datasets are created on first use with an unlimited first axis, so that
+    a catalog can be written one chunk of objects at a time; the rows
+    written before a crash remain readable.
+
+    Parameters
+    ----------
+    filename : str
+        HDF5 file
+    data : dict
+        dataset name -> array of rows; byte strings are stored as
+        variable length strings
+    create : bool
+        truncate the file before writing
+
+    """
+
+    with h5py.File(filename, 'w' if create else 'a') as hf:
+        for key, value in data.items():
+            value = np.asarray(value)
+            dtype = value.dtype
+            if dtype.kind in ['S', 'O']:
+                dtype = h5py.string_dtype(encoding='ascii')
+                value = value.astype(object)
+
+            if key not in hf:
+                hf.create_dataset(key, data=value, dtype=dtype,
+                                  maxshape=(None,) + value.shape[1:],
+                                  chunks=(1024,) + value.shape[1:])
+            else:
+                dset = hf[key]
+                nrows = dset.shape[0]
+                dset.resize(nrows + value.shape[0], axis=0)
+                dset[nrows:] = value
+
+
 def database_query(kow, qu, nquery = 5):
-    r = {}
-    cnt = 0
-    while cnt < nquery:
-        r = kow.query(query=qu)
-        if (r is not None) and ("data" in r):
-            break
-        time.sleep(5)        
-        cnt = cnt + 1
+    # retries with exponential backoff, see ztfperiodic.querypool
+    return query_with_retries(kow, qu, nquery=nquery)
+
+def database_queries(kow, qus, nquery = 5):
+    """Results of independent queries, run concurrently if kow is a
+    QueryPool."""
+    if isinstance(kow, QueryPool):
+        return kow.map(qus, nquery=nquery)
+    return [database_query(kow, qu, nquery=nquery) for qu in qus]
+
+def query_connections(kow):
+    """Number of queries kow can run at a time."""
+    if isinstance(kow, QueryPool):
+        return kow.nconnections
+    return 1
+
+
+def find_objids(kow, dbname, objids, projection={}, batch_size=1000,
+                Nthreads=4):
+    """Documents of a Kowalski catalog for a list of objids
+
+    Parameters
+    ----------
+    kow : penquins.Kowalski
+    dbname : str
+        catalog to query
+    objids : list
+        object ids (_id) to look up
+    projection : dict
+        projection of the find queries
+    batch_size : int
+        number of objids per $in query
+    Nthreads : int
+        number of queries run concurrently
+
+    Returns
+    -------
+    documents : dict
+        documents of the objids found, keyed by _id
+    """
+
+    objids = [int(objid) for objid in objids]
+    batches = [objids[ii:ii+batch_size]
+               for ii in range(0, len(objids), batch_size)]
+
+    def query_batch(batch):
+        qu = {"query_type":"find",
+              "query": {"catalog": dbname,
+                        "filter": {"_id": {"$in": batch}},
+                        "projection": projection},
+             }
+        r = database_query(kow, qu, nquery = 10)
+        if (r is None) or (not "data" in r):
+            print("Query for objids %d-%d failed... continuing." % (batch[0],
+                                                                    batch[-1]))
+            return []
+        return r["data"]
+
+    if (Nthreads > 1) and (len(batches) > 1):
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=Nthreads)
+        results = executor.map(query_batch, batches)
+    else:
+        executor = None
+        results = map(query_batch, batches)
+
+    documents = {}
+    for ii, data in enumerate(results):
+        if (ii > 0) and (np.mod(ii,10) == 0):
+            print('Loading %d/%d...' % (ii*batch_size, len(objids)))
+        for document in data:
+            documents[int(document["_id"])] = document
+
+    if executor is not None:
+        executor.shutdown()
+
+    return documents
+
+
+def unique_found(objids, documents):
+    """objids found in documents, in order and without repeats"""
+
+    index, seen = [], set()
+    for objid in objids:
+        key = int(objid)
+        if (key in documents) and (not key in seen):
+            index.append(objid)
+            seen.add(key)
+    return index
+
+
+def decode_kowalski_sources(datas, program_ids, tmax):
+    """Decode ZTF_sources documents and apply the detection cuts of the
+    Kowalski loaders
+
+    Parameters
+    ----------
+    datas : list or dict
+        documents returned by Kowalski, or detections already decoded
+        with ztfperiodic.lccache.documents_to_columns
+    program_ids : list
+        program ids to keep
+    tmax : float
+        program id 1 detections after tmax (HJD) are removed
+
+    Returns
+    -------
+    columns : dict
+        decoded detections with catflags == 0 from the requested programs;
+        objects left without detections have zero length
+    """
+
+    if not isinstance(datas, dict):
+        datas = documents_to_columns(datas)
+
+    programid = datas["programid"]
+    keep = np.isin(programid, program_ids)
+    keep &= ~((programid == 1) & (datas["hjd"] > tmax))
+    keep &= datas["catflags"] == 0
+
+    return select_detections(datas, keep)
+
+
+# catalogs that grow every night: their responses are never cached
+LIVE_CATALOGS = ["ZTF_alerts"]
+
+def cached_query(kow, qu, cache=None, nquery = 5):
+    """database_query, served from a LightcurveCache when possible
+
+    Queries of the LIVE_CATALOGS always go to Kowalski; in cone searches
+    mixing live and static catalogs, only the static part is cached."""
+
+    if cache is None:
+        return database_query(kow, qu, nquery = nquery)
+
+    query = qu.get("query", {})
+    if query.get("catalog") in LIVE_CATALOGS:
+        return database_query(kow, qu, nquery = nquery)
+
+    catalogs = query.get("catalogs", {})
+    live = [catalog for catalog in catalogs if catalog in LIVE_CATALOGS]
+    if len(live) > 0:
+        static = [catalog for catalog in catalogs if not catalog in live]
+        qu_live = dict(qu, query=dict(query, catalogs={catalog: catalogs[catalog] for catalog in live}))
+        r = database_query(kow, qu_live, nquery = nquery)
+        if (len(static) == 0) or (not "data" in r):
+            return r
+        qu_static = dict(qu, query=dict(query, catalogs={catalog: catalogs[catalog] for catalog in static}))
+        r_static = cached_query(kow, qu_static, cache=cache, nquery = nquery)
+        if not "data" in r_static:
+            return r_static
+        data = dict(r_static["data"])
+        data.update(r["data"])
+        return dict(r, data=data)
+
+    key = "query_%s" % hashlib.md5(json.dumps(qu, sort_keys=True).encode()).hexdigest()
+    r = cache.get_response(key)
+    if r is None:
+        r = database_query(kow, qu, nquery = nquery)
+        if "data" in r:
+            cache.put_response(key, r)
     return r
 
 
+def cached_queries(kow, qus, cache=None, nquery = 5):
+    """cached_query of independent queries, run concurrently (one per
+    connection) if kow is a QueryPool."""
+
+    if (query_connections(kow) == 1) or (len(qus) <= 1):
+        return [cached_query(kow, qu, cache=cache, nquery = nquery)
+                for qu in qus]
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=query_connections(kow)) as executor:
+        return list(executor.map(
+            lambda qu: cached_query(kow, qu, cache=cache, nquery = nquery),
+            qus))
+
+
 def BJDConvert(mjd, RA, Dec):
     times=mjd
     t = Time(times,format='mjd',scale='utc')
@@ -2219,7 +2909,7 @@ def mag2flux(mag,dmag=[],flux_0 = 3631.0):
     # converts magnitude to flux in Jy
     flux = flux_0 * 10**(-0.4*mag)
 
-    if dmag==[]:
+    if np.size(dmag) == 0:
         return flux
     else:
         dflux_p = (flux_0 * 10**(-0.4*(mag-dmag)) - flux)